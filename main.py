@@ -2,9 +2,14 @@ import sys
 import pandas as pd
 import os
 import time
-from source.processing import process_dataframe, detect_separator
+from source.processing import process_dataframe, process_in_chunks, process_cmbd, detect_separator, read_entity, read_lab_tests, read_conversion_file
 from source.utils.column_casts import column_casts
-from source.utils.valid_entities import VALID_ENTITIES
+from source.utils.valid_entities import VALID_ENTITIES, STREAMABLE_ENTITIES, LAB_OPTIONS
+from source.utils.output import OutputWriter
+from source.utils.mesures_info import read_range_table
+
+# Rows read at once when Primaria outliers are removed without --chunksize
+OUTLIERS_CHUNKSIZE = 500_000
 
 def main():
     """Main function to prepare PADRIS data based on entity type."""
@@ -15,8 +20,123 @@ def main():
     if report:
         args.remove('--report')
 
+    # Support an optional `--chunksize <rows>` option to stream the input file
+    chunksize = None
+    if '--chunksize' in args:
+        idx = args.index('--chunksize')
+        try:
+            chunksize = int(args[idx + 1])
+        except (IndexError, ValueError):
+            print("⚠️ --chunksize requires a number of rows.")
+            sys.exit(1)
+        del args[idx:idx + 2]
+
+    # Support an optional `--lab-cache` flag to reuse the cleaning of lab results and units between runs
+    lab_cache = '--lab-cache' in args
+    if lab_cache:
+        args.remove('--lab-cache')
+
+    # Support an optional `--pyarrow` flag to parse the input file with the pyarrow engine
+    engine = None
+    if '--pyarrow' in args:
+        args.remove('--pyarrow')
+        engine = 'pyarrow'
+
+    # Support an optional `--memory-budget <GB>` option to stop Laboratori processing before running out of memory
+    memory_budget = None
+    if '--memory-budget' in args:
+        idx = args.index('--memory-budget')
+        try:
+            memory_budget = int(float(args[idx + 1]) * 1024**3)
+        except (IndexError, ValueError):
+            print("⚠️ --memory-budget requires a number of GB.")
+            sys.exit(1)
+        del args[idx:idx + 2]
+
+    # Support an optional `--partition-by-year` flag to write Parquet or Feather output in one directory per year
+    partition_by_year = '--partition-by-year' in args
+    if partition_by_year:
+        args.remove('--partition-by-year')
+
+    # Support an optional `--compression <codec>` option for Parquet or Feather output
+    compression = None
+    if '--compression' in args:
+        idx = args.index('--compression')
+        if idx + 1 >= len(args):
+            print("⚠️ --compression requires a codec (e.g. snappy, zstd, lz4).")
+            sys.exit(1)
+        compression = args[idx + 1]
+        del args[idx:idx + 2]
+
+    # Support an optional `--ranges <file>` option with the codes and valid ranges of Mesures (CSV or JSON)
+    range_table = None
+    if '--ranges' in args:
+        idx = args.index('--ranges')
+        if idx + 1 >= len(args):
+            print("⚠️ --ranges requires a CSV or JSON file with the codes and valid ranges.")
+            sys.exit(1)
+        range_table = args[idx + 1]
+        del args[idx:idx + 2]
+
+    # Support an optional `--wide` flag to write Mesures as one row per individual and date with the BMI
+    wide = '--wide' in args
+    if wide:
+        args.remove('--wide')
+
+    # Support an optional `--height-tolerance <days>` option: maximum days between a weight and the height used for its BMI
+    height_tolerance = None
+    if '--height-tolerance' in args:
+        idx = args.index('--height-tolerance')
+        try:
+            height_tolerance = int(args[idx + 1])
+        except (IndexError, ValueError):
+            print("⚠️ --height-tolerance requires a number of days.")
+            sys.exit(1)
+        del args[idx:idx + 2]
+
+    # Support an optional `--remove-outliers <mortalitat>` option to remove Primaria diagnostics not coherent with the CIE references or the death date
+    remove_outliers = None
+    if '--remove-outliers' in args:
+        idx = args.index('--remove-outliers')
+        if idx + 1 >= len(args):
+            print("⚠️ --remove-outliers requires the path to the processed Mortalitat file.")
+            sys.exit(1)
+        remove_outliers = args[idx + 1]
+        del args[idx:idx + 2]
+
+    # Support an optional `--surrogate-ids <assegurats>` option to write the individual id as its int32 surrogate in the patient index
+    surrogate_ids = None
+    if '--surrogate-ids' in args:
+        idx = args.index('--surrogate-ids')
+        if idx + 1 >= len(args):
+            print("⚠️ --surrogate-ids requires the path to the processed Assegurats file.")
+            sys.exit(1)
+        surrogate_ids = args[idx + 1]
+        del args[idx:idx + 2]
+
+    # Support an optional `--patient-attributes <assegurats>` option to add the attributes of each individual from the patient index
+    patient_attributes = None
+    if '--patient-attributes' in args:
+        idx = args.index('--patient-attributes')
+        if idx + 1 >= len(args):
+            print("⚠️ --patient-attributes requires the path to the processed Assegurats file.")
+            sys.exit(1)
+        patient_attributes = args[idx + 1]
+        del args[idx:idx + 2]
+
+    # Support an optional `--workers <n>` option to clean lab data in several processes
+    workers = None
+    if '--workers' in args:
+        idx = args.index('--workers')
+        try:
+            workers = int(args[idx + 1])
+        except (IndexError, ValueError):
+            print("⚠️ --workers requires a number of processes.")
+            sys.exit(1)
+        del args[idx:idx + 2]
+
     if len(args) not in [3, 4, 5]:
-        print("Usage: python3 main.py <inpath> <outpath> <entity> [lab_option|episodis] [lab_conversion] [--report]")
+        print("Usage: python3 main.py <inpath> <outpath> <entity> [lab_option|episodis] [lab_conversion|procediments] [--report] [--chunksize <rows>] [--workers <n>] [--lab-cache] [--memory-budget <GB>] [--pyarrow] [--compression <codec>] [--partition-by-year] [--ranges <file>] [--wide] [--height-tolerance <days>] [--remove-outliers <mortalitat>] [--surrogate-ids <assegurats>] [--patient-attributes <assegurats>]")
         sys.exit(1)
 
     inpath, outpath, entity = args[0], args[1], args[2]
@@ -24,28 +144,150 @@ def main():
     lab_option = None
     lab_conversion = None
     episodis = None
+    procediments = None
 
-    if entity == 'Laboratori' and 'filter' in args:
+    if entity == 'Laboratori' and len(args) > 3:
+        # Laboratori options need the conversion file: stop here instead of processing the raw data without them
+        if args[3] not in LAB_OPTIONS:
+            print(f"⚠️ '{args[3]}' is not a Laboratori option. Use one of: {', '.join(sorted(LAB_OPTIONS))}.")
+            sys.exit(1)
+        if len(args) != 5:
+            print(f"⚠️ Laboratori option '{args[3]}' requires the path to the conversion file: <inpath> <outpath> Laboratori {args[3]} <lab_conversion>.")
+            sys.exit(1)
         lab_option = args[3]
         lab_conversion =  args[4]
     elif entity in ['Diagnostics', 'Procediments'] and len(args) == 4:
         episodis = args[3]
+    elif entity == 'CMBD' and len(args) == 5:
+        # Diagnostics as inpath, then the Episodis and Procediments files of the same delivery
+        episodis, procediments = args[3], args[4]
 
     if not os.path.exists(inpath):
         print(f"❌ Input path '{inpath}' does not exist.")
         sys.exit(1)
 
+    if entity not in VALID_ENTITIES:
+        print(f"⚠️ '{entity}' is not a recognized entity.")
+        sys.exit(1)
+
+    if entity == 'CMBD' and procediments is None:
+        print("⚠️ 'CMBD' requires the Episodis and Procediments files: <diagnostics> <outpath> CMBD <episodis> <procediments>.")
+        sys.exit(1)
+
+    if lab_conversion is not None and not os.path.exists(lab_conversion):
+        print(f"❌ Conversion file '{lab_conversion}' does not exist.")
+        sys.exit(1)
+
+    if procediments is not None and not os.path.exists(procediments):
+        print(f"❌ Input path '{procediments}' does not exist.")
+        sys.exit(1)
+
+    try:
+        OutputWriter(outpath, compression, partition_by_year) # Check the output format and options before reading the input
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    if workers and entity not in ['Laboratori', 'CMBD']:
+        print("⚠️ --workers is only available for 'Laboratori' and 'CMBD'.")
+        sys.exit(1)
+
+    if (wide or height_tolerance is not None) and entity != 'Mesures':
+        print("⚠️ --wide and --height-tolerance are only available for 'Mesures'.")
+        sys.exit(1)
+
+    if remove_outliers:
+        if entity != 'Primaria':
+            print("⚠️ --remove-outliers is only available for 'Primaria'.")
+            sys.exit(1)
+        if not os.path.exists(remove_outliers):
+            print(f"❌ Input path '{remove_outliers}' does not exist.")
+            sys.exit(1)
+        # Primaria is streamed so that the memory does not depend on its size
+        chunksize = chunksize or OUTLIERS_CHUNKSIZE
+
+    for patient_index in [surrogate_ids, patient_attributes]:
+        if patient_index is not None and not os.path.exists(patient_index):
+            print(f"❌ Input path '{patient_index}' does not exist.")
+            sys.exit(1)
+
+    if range_table:
+        if entity != 'Mesures':
+            print("⚠️ --ranges is only available for 'Mesures'.")
+            sys.exit(1)
+        try:
+            range_table = read_range_table(range_table) # Check the table before reading the input
+        except (OSError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+
+    if lab_cache:
+        if entity != 'Laboratori':
+            print("⚠️ --lab-cache is only available for 'Laboratori'.")
+            sys.exit(1)
+        # The cache file is kept next to the output file
+        lab_cache = os.path.join(os.path.dirname(os.path.abspath(outpath)), "lab_cleaning_cache.sqlite")
+    else:
+        lab_cache = None
+
+    if chunksize:
+        if entity not in STREAMABLE_ENTITIES:
+            print(f"⚠️ '{entity}' cannot be processed in chunks. Entities allowed: {', '.join(sorted(STREAMABLE_ENTITIES))}.")
+            sys.exit(1)
+
+        ### CHUNKED PROCESSING ###
+        print(f"Processing input in chunks of {chunksize} rows...")
+        process_in_chunks(
+            inpath,
+            outpath,
+            entity,
+            column_casts,
+            chunksize,
+            lab_option=lab_option,
+            lab_conversion=lab_conversion,
+            report=report,
+            workers=workers,
+            lab_cache=lab_cache,
+            memory_budget=memory_budget,
+            compression=compression,
+            partition_by_year=partition_by_year,
+            range_table=range_table,
+            wide=wide,
+            height_tolerance=height_tolerance,
+            remove_outliers=remove_outliers,
+            surrogate_ids=surrogate_ids,
+            patient_attributes=patient_attributes )
+        return
+
+    if entity == 'CMBD':
+        ### DIAGNOSTICS AND PROCEDIMENTS ###
+        process_cmbd(
+            inpath,
+            procediments,
+            episodis,
+            outpath,
+            column_casts,
+            report=report,
+            workers=workers,
+            engine=engine,
+            compression=compression,
+            partition_by_year=partition_by_year,
+            surrogate_ids=surrogate_ids,
+            patient_attributes=patient_attributes )
+        return
+
     try:
         print("Reading input...")
         sep = detect_separator(inpath)
-        df = pd.read_csv(inpath, sep= sep, low_memory=False)
+        if lab_option == 'clean_filter':
+            # Read the conversion file first and keep only its tests while reading
+            lab_conversion = read_conversion_file(lab_conversion)
+            df = read_lab_tests(inpath, sep, lab_conversion)
+        else:
+            df = read_entity(inpath, sep, entity, lab_option, engine)
     except Exception as e:
         raise ValueError("⚠️ Failed to read input file. Ensure it's a CSV with '|' separator.") from e
 
-    if entity not in VALID_ENTITIES:
-        print(f"⚠️ '{entity}' is not a recognized entity.")
-        sys.exit(1)
-
     ### DATAFRAME PROCESSING ###
     print("Processing dataframe...")
     
@@ -57,7 +299,18 @@ def main():
         lab_option=lab_option,
         lab_conversion=lab_conversion,
         episodis=episodis,
-        report=report )
+        report=report,
+        workers=workers,
+        lab_cache=lab_cache,
+        memory_budget=memory_budget,
+        compression=compression,
+        partition_by_year=partition_by_year,
+        range_table=range_table,
+        wide=wide,
+        height_tolerance=height_tolerance,
+        remove_outliers=remove_outliers,
+        surrogate_ids=surrogate_ids,
+        patient_attributes=patient_attributes )
 
 if __name__ == "__main__":
     start_time = time.time()
@@ -31,8 +31,8 @@ class Assegurats(CommonData):
 
     def process(self):
         """ Function to process Assegurats data."""
-        self.df = self.unify_missing()
-        self.df = self.cast_columns()
-        self.df = self._add_year_col('data_defuncio')
+        self._run_step('unify_missing', self.unify_missing)
+        self._run_step('cast_columns', self.cast_columns)
+        self._run_step('add_year_col', self._add_year_col, 'data_defuncio')
         
         return self.df
\ No newline at end of file
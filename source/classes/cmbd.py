@@ -1,6 +1,8 @@
 # Class for the CMBD tables from PADRIS
 from source.classes.common import CommonData
 import pandas as pd
+from source.utils.harmonizer import LabelHarmonizer
+from source.utils.natural_keys import NATURAL_KEYS, duplicated_key
 
 class Episodis(CommonData):
     """
@@ -35,13 +37,14 @@ class Episodis(CommonData):
     def process(self):
         """ Function to process Episodis data."""
         self._check_if_episodis()
-        self.df = self.unify_missing()
-        self.df = self.cast_columns()
+        self._run_step('unify_missing', self.unify_missing)
+        self._run_step('cast_columns', self.cast_columns)
 
         if 'data_alta' in self.df.columns:
-            self.df['any_referencia'] = pd.to_numeric(self.df['data_alta'].dt.year, errors='coerce')
+            with self.profile('add_year_col'):
+                self.df['any_referencia'] = pd.to_numeric(self.df['data_alta'].dt.year, errors='coerce')
 
-        self.df = self._fix_inconsistencies()
+        self._run_step('fix_inconsistencies', self._fix_inconsistencies)
 
         return self.df
 
@@ -51,7 +54,7 @@ class DiagnosticsProcediments(CommonData):
     This class will deal with the processes related to the Diagnostics table from PADRIS.
     """
 
-    def __init__(self, df, column_casts, entity_name, episodis_df):
+    def __init__(self, df, column_casts, entity_name, episodis_index):
         """
         Constructor for the DiagnosticsProcediments class. 
         
@@ -59,10 +62,10 @@ class DiagnosticsProcediments(CommonData):
             df (pd.DataFrame): DataFrame to be processed.
             column_casts (dict): Dictionary of columns and their target data types.
             entity_name (str): Name of the entity, either "Diagnostics" or "Procediments".
-            episodis_df (pd.DataFrame): DataFrame containing episodis data.
+            episodis_index (EpisodiIndex): Individual id and year of each episode of the Episodis file.
         """
         super().__init__(df, column_casts)
-        self.episodis = episodis_df
+        self.episodis = episodis_index
         self.entity_name = entity_name
 
     def _check_if_DP(self):
@@ -93,9 +96,30 @@ class DiagnosticsProcediments(CommonData):
         """ Return the label column ('dx' or 'px') based on entity_name. """
         return 'dx' if self.entity_name == "Diagnostics" else 'px'
 
-    def _get_most_frequent(self, group):
-        """ Get the most frequent value in a group. """
-        return group.mode().iloc[0] if not group.mode().empty else None
+    def _label_harmonizer(self):
+        """ Return an empty LabelHarmonizer for the label column grouped by code and catalog. """
+        label_col = self._get_label_column()
+        return LabelHarmonizer([f"{label_col}_c", f"catalegcim_{label_col}"], label_col)
+
+    def _merge_episodes(self):
+        """
+        Add the individual id and year (any_referencia) of the episode of each row from the episodi index.
+        Same result as pd.merge(episodis, self.df, on="episodi_id", how="right") without reading and merging the Episodis file:
+        a row with several episodes is repeated and a row without one is kept with missing values.
+        Unlike pd.merge, a row without episodi_id is not matched with the episodes without episodi_id: it has no episode.
+        """
+        rows, episodes = self.episodis.match(self.df['episodi_id'])
+        data = self.df.iloc[rows].reset_index(drop=True)
+        id_col = self.episodis.id_col
+
+        # Episodis columns first, then the data columns. Columns in both get the suffixes of pd.merge: _x (Episodis) and _y (data)
+        shared = {id_col, 'any_referencia'} & set(data.columns)
+        merged = {f"{id_col}_x" if id_col in shared else id_col: self.episodis.patient_ids(episodes),
+                  'episodi_id': data['episodi_id'],
+                  'any_referencia_x' if 'any_referencia' in shared else 'any_referencia': self.episodis.years(episodes)}
+        merged.update({f"{col}_y" if col in shared else col: values for col, values in data.items() if col != 'episodi_id'})
+
+        return pd.DataFrame(merged, copy=False)
 
     def _fix_inconsistencies(self):
         """ 
@@ -106,10 +130,10 @@ class DiagnosticsProcediments(CommonData):
         catalogs = self._get_catalog_mapping()
 
         #Identify the individual identificator in the episodis dataframe
-        id_col = self.episodis.columns[0]
+        id_col = self.episodis.id_col
 
-        # Merge the episodis dataframe with the main df
-        merged = pd.merge(self.episodis, self.df, on="episodi_id", how="right")
+        # Add the individual id and year of each episode
+        merged = self._merge_episodes()
 
         # Remove incorrect mappings based on year and catalog
         remove_condition = (
@@ -129,11 +153,18 @@ class DiagnosticsProcediments(CommonData):
         # Group by label columns and find the most common label
         group_cols = [f"{label_col}_c", f"catalegcim_{label_col}"]
         if all(col in fixed_merged.columns for col in group_cols):
-            most_common_label = self.df.groupby(group_cols)[label_col].agg(self._get_most_frequent)
-            fixed_merged[label_col] = fixed_merged.set_index(group_cols).index.map(most_common_label.to_dict())
-
-        # Remove duplicates
-        fixed_merged.drop_duplicates(inplace=True)
+            fixed_merged[label_col] = self._label_harmonizer().update(self.df).apply(fixed_merged)
+
+        # Remove duplicates: rows with the same natural key (episode, position, code and catalog) keep the first one
+        key = [col for col in NATURAL_KEYS.get(self.entity_name, []) if col in fixed_merged.columns]
+        if key and len(key) == len(NATURAL_KEYS[self.entity_name]):
+            duplicated = duplicated_key(fixed_merged, key)
+        else:
+            print(f"Warning: Key columns of '{self.entity_name}' not found: duplicates are removed comparing whole rows.")
+            key = list(fixed_merged.columns)
+            duplicated = fixed_merged.duplicated().to_numpy()
+        self.duplicates = (key, int(duplicated.sum()))
+        fixed_merged = fixed_merged[~duplicated]
         
         return fixed_merged
 
@@ -141,8 +172,8 @@ class DiagnosticsProcediments(CommonData):
         """ Process Diagnostics or Procediments data. """
         self._check_if_DP()
         self._check_entity()
-        self.df = self.unify_missing()
-        self.df = self._fix_inconsistencies()
-        self.df = self.cast_columns()
+        self._run_step('unify_missing', self.unify_missing)
+        self._run_step('fix_inconsistencies', self._fix_inconsistencies)
+        self._run_step('cast_columns', self.cast_columns)
         
         return self.df
\ No newline at end of file
@@ -1,20 +1,67 @@
 # Common class to all data in the project
 
+import time
 import pandas as pd
 import numpy as np
+from contextlib import contextmanager
+from source.utils.dates import DateParser
+from source.utils.memory import MemoryTracker, current_rss
+from source.utils.profiling import StepProfiler
 
 
 class CommonData:
     """ This class will deal with the processes common among all PADRIS data."""
+    category_threshold = 0.5 # compact(): text columns with fewer distinct values than this share of rows become categories
     
     def __init__(self, df, column_casts,):
         """ Constructor for the CommonData class. """
         self.df = df
         self.column_casts = column_casts
+        self.dates = DateParser() # Replaced by a shared one when a file is processed in chunks
+        self.profiler = StepProfiler() # Same
+        self.memory = MemoryTracker()
+        self.compaction = None
+        self.duplicates = None # (key columns, rows removed) if duplicates are removed
+
+    @contextmanager
+    def profile(self, step):
+        """ Profile the processing step run inside the with block (time, rows and memory) and check the memory budget after it."""
+        rows_in, memory_before, start = len(self.df), current_rss(), time.perf_counter()
+        yield
+        memory_after = current_rss()
+        self.profiler.record(step, time.perf_counter() - start, rows_in, len(self.df),
+                             memory_after - memory_before if memory_before is not None else None)
+        self.memory.check(step)
+
+    def _run_step(self, step, function, *args):
+        """ Run a processing step that returns the new self.df and profile it."""
+        with self.profile(step):
+            self.df = function(*args)
+
+        return self.df
 
     def unify_missing(self):
-        """ Replace various representations of missing values with a unified version."""
-        self.df = self.df.replace([pd.NA, np.nan, 'nan', 'NaN', ''], pd.NA)
+        """ 
+        Replace various representations of missing values with a unified version.
+        Same as df.replace([pd.NA, np.nan, 'nan', 'NaN', ''], pd.NA) in one pass per column: only text and float columns can hold them.
+        Returns a new dataframe.
+        """
+        df = self.df.copy()
+        for i, (col, values) in enumerate(self.df.items()):
+            if values.dtype == object:
+                missing = values.isna() | values.isin(['nan', 'NaN', ''])
+            elif isinstance(values.dtype, np.dtype) and values.dtype.kind == 'f':
+                missing = values.isna()
+            elif isinstance(values.dtype, np.dtype):
+                continue # Integer, boolean and date columns cannot hold these values
+            else:
+                df.isetitem(i, values.replace([pd.NA, np.nan, 'nan', 'NaN', ''], pd.NA))
+                continue
+
+            if missing.any():
+                df.isetitem(i, values.astype(object).where(~missing, pd.NA))
+
+        self.df = df
         return self.df
     
     def cast_columns(self):
@@ -23,10 +70,11 @@ class CommonData:
             if col in self.df.columns:  # Check if column exists
                 try:
                     if dtype == 'datetime64[ns]':  # Special case for dates
-                        self.df[col] = pd.to_datetime(self.df[col], errors='coerce', dayfirst=False)
+                        self.df[col] = self.dates.parse(col, self.df[col])
                         self.df[col] = self.df[col].dt.tz_localize(None)  # Remove timezone
                     elif dtype in ['float', 'float64']:
-                        self.df[col] = pd.to_numeric(self.df[col], errors='coerce')
+                        # Always float: to_numeric alone gives integers when every value is one (e.g. in a chunk)
+                        self.df[col] = pd.to_numeric(self.df[col], errors='coerce').astype('float64')
                     else:
                         self.df[col] = self.df[col].astype(dtype)
                 except Exception as e:
@@ -36,3 +84,41 @@ class CommonData:
         return self.df
         
         
+
+    def compact(self):
+        """
+        Reduce the memory of the processed data without changing its values:
+        text columns with few distinct values become categories and nullable integers (Int64)
+        use the smallest integer type that holds their range (Int8, Int16 or Int32).
+        The memory of the compacted columns before (estimated from their distinct values) and after is kept in self.compaction (bytes).
+        Only one-pass runs compact the data (process_dataframe): the types would depend on the values of each chunk.
+        """
+        df = self.df.copy(deep=False)
+        before, after = 0, 0
+        for i, (col, values) in enumerate(self.df.items()):
+            if values.dtype == object:
+                codes, uniques = pd.factorize(values)
+                if len(uniques) > self.category_threshold * len(values) or pd.api.types.infer_dtype(uniques, skipna=True) != 'string':
+                    continue # Many distinct values, or not only text
+                # Same as values.astype('category') (sorted categories) without hashing the column again
+                order = np.argsort(uniques)
+                positions = np.empty(len(order), dtype=np.intp)
+                positions[order] = np.arange(len(order))
+                compacted = pd.Series(pd.Categorical.from_codes(np.where(codes >= 0, positions[codes], -1), categories=uniques[order]),
+                                      index=values.index, name=col)
+                # Rows share the same string objects: the text column holds one pointer per row plus each distinct string
+                before += values.memory_usage(index=False) + compacted.cat.categories.memory_usage(deep=True)
+            elif isinstance(values.dtype, pd.Int64Dtype):
+                compacted = pd.to_numeric(values, downcast='integer')
+                if compacted.dtype == values.dtype:
+                    continue
+                before += values.memory_usage(index=False)
+            else:
+                continue
+
+            after += compacted.memory_usage(deep=True, index=False)
+            df.isetitem(i, compacted)
+
+        self.compaction = (before, after)
+        self.df = df
+        return self.df
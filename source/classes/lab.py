@@ -4,20 +4,31 @@ from source.classes.lab_processing.clean_lab import *
 from source.classes.lab_processing.filter_lab import *
 from source.classes.lab_processing.patterns import *
 from source.classes.lab_processing.convert import conversion_factors_dict
+from source.utils.harmonizer import LabelHarmonizer
+from source.utils.parallel import run_sharded
+from source.utils.memory import MemoryTracker, select_columns
+import pandas as pd
 import warnings
 
 class Lab(CommonData):
     """
     This class will deal with the processes related to the lab table from PADRIS.
     """
+    # Raw columns needed to count the test names
+    label_columns = ['lab_prova_c', 'lab_prova']
+    # Raw columns used by the processing (besides the individual id, the first column)
+    raw_columns = ["Any_prova", "Data_prova", "peticio_id", "lab_prova_c", "lab_prova", "lab_resultat", "unitat_mesura", "ref_min", "ref_max"]
+    # Output names of the raw columns that are renamed
+    output_names = {"Any_prova": "any", "Data_prova": "data", "lab_resultat": "resultat", "lab_prova_c": "codi_prova", "lab_prova":"prova"}
 
-    def __init__(self, df, column_casts):
-        """ Constructor for the LAB class. """
+    def __init__(self, df, column_casts, memory = None):
+        """ Constructor for the LAB class. `memory` (MemoryTracker) records the memory after each step and applies the memory budget."""
         super().__init__(df, column_casts)
+        self.memory = memory if memory is not None else MemoryTracker()
 
     def _check_if_lab(self):
         """Check if the columns correspond to a Laboratori file; if not, raise an error."""
-        required_cols = {"Any_prova", "Data_prova", "peticio_id", "lab_prova_c", "lab_prova", "lab_resultat", "unitat_mesura", "ref_min", "ref_max"}
+        required_cols = set(self.raw_columns)
         if not required_cols.issubset(self.df.columns):
             raise ValueError("⚠️ The data does not correspond with a Laboratori file or it does not have the corresponding columns.")
         
@@ -31,44 +42,138 @@ class Lab(CommonData):
         """ Prepare the lab data for processing. """
         #Identify  the individual identifier column
         id_col = self.df.columns[0]
+
+        # Text view of the cleaning comments, only built for the output
+        self.df['comentari'] = comentari_text(self.df['comentari_flags'])
         
-        self.df = self.df[[id_col,'peticio_id','Any_prova','Data_prova','lab_prova_c','lab_prova','lab_resultat','unitat_mesura','ref_min','ref_max','clean_result','clean_unit','comentari','comentari_unitat','num_type']]
-        self.df = self.df.rename(columns={"Any_prova": "any", "Data_prova": "data", "lab_resultat": "resultat", "lab_prova_c": "codi_prova", "lab_prova":"prova"})
+        # Select the output columns without copying them (the rest are dropped)
+        self.df = select_columns(self.df, [id_col,'peticio_id','Any_prova','Data_prova','lab_prova_c','lab_prova','lab_resultat','unitat_mesura','ref_min','ref_max','clean_result','clean_unit','comentari','comentari_unitat','num_type'])
+        self.df = self.df.rename(columns=self.output_names, copy=False)
 
         return self.df
 
+    def _drop_unused_columns(self):
+        """ Keep only the individual id (first column) and the raw columns used by the processing, without copying them."""
+        id_col = self.df.columns[0]
+
+        return select_columns(self.df, [col for col in self.df.columns if col == id_col or col in self.raw_columns])
+
+
+    def count_labels(self, harmonizer = None):
+        """ Add the test name counts of this data to a LabelHarmonizer (first pass when reading in chunks)."""
+        if harmonizer is None:
+            harmonizer = LabelHarmonizer('lab_prova_c', 'lab_prova')
+        self.df = self.unify_missing()
+
+        return harmonizer.update(self.df)
+
+    def _read_conversion(self, lab_conversion):
+        """ Return the conversion dataframe. `lab_conversion` can be the path to the conversion file or the dataframe already read."""
+        if isinstance(lab_conversion, pd.DataFrame): # Already read
+            return lab_conversion
+        return read_conversion_file(lab_conversion) # Read the conversion file
 
-    def process(self):
-        """ Function to process Assegurats data."""
+    def _clean(self, harmonizer = None, cache = None):
+        """ Clean and standardize the lab data (base processing without the final cast). `cache` is an optional CleaningCache."""
         warnings.filterwarnings("ignore", category=UserWarning, message=".*match groups.*") # Ignore warnings.
 
         self._check_if_lab()
-        self.df = self.unify_missing() # Unify missing values to be pd.NA
-        self.df = self._fill_missing() # Fill missing values in the lab_resultat col with nocalc
-
-        # Process the lab data
-        self.df = clear_typos(self.df) # Clear typos in the lab data
-        self.df = handle_extra_variables(self.df, patterns_common_words, numeric_patterns)
-        self.df = classify_numeric_results(self.df, numeric_patterns) # Classify numeric results
-        self.df = standardize_numeric_results(self.df) # Standardize numeric results
-        self.df = standardize_unit(self.df, unit_patterns) # Standardize units
-        self.df = standardize_name(self.df) # Standardize names
-        self.df = standardize_reference_values(self.df) # Standardize reference values
-        self.df = standardize_peticio_id(self.df) # Standardize peticio_id
-        self.df = self._prepare_lab_data()
-        self.df = self.cast_columns()
+        self.df = self._drop_unused_columns() # Drop the raw columns that are not used as soon as possible
+        # The cleaning adds columns of about the size of the input: stop now if they would not fit in the memory budget
+        self.memory.check('start', int(self.df.memory_usage(deep=True).sum()) if self.memory.budget else 0)
+
+        # After unify_missing the data is a new dataframe, so the next steps modify it in place instead of copying it
+        self._run_step('unify_missing', self.unify_missing) # Unify missing values to be pd.NA
+        self._run_step('fill_missing', self._fill_missing) # Fill missing values in the lab_resultat col with nocalc
+
+        # Process the lab data: results and units are cleaned once per distinct value
+        self._run_step('clean_results', clean_distinct_results, self.df, patterns_common_words, numeric_patterns, cache) # Clear typos, handle extra variables, classify and standardize results
+        self._run_step('standardize_units', standardize_distinct_units, self.df, unit_patterns, cache) # Standardize units
+        self._run_step('standardize_name', standardize_name, self.df, harmonizer) # Standardize names
+        self._run_step('standardize_reference_values', standardize_reference_values, self.df, False) # Standardize reference values
+        self._run_step('standardize_peticio_id', standardize_peticio_id, self.df, False) # Standardize peticio_id
+        self._run_step('prepare_lab_data', self._prepare_lab_data)
+
+        return self.df
+
+    def _filter_tests(self, conversion):
+        """ Keep only the raw lab data of the tests in the conversion dataframe."""
+        self._check_if_lab()
+        conversion = match_codi_dtype(conversion, self.df['lab_prova_c'])
+
+        return filter_lab_codi(self.df, conversion, 'lab_prova_c')
+
+    def _convert(self, conversion, unit_factors = None):
+        """ 
+        Filter cleaned lab data with the conversion file and convert the results to the reference unit.
+        `unit_factors` is the table of build_unit_factors when it was built once for all the chunks.
+        """
+        conversion = match_codi_dtype(conversion, self.df['codi_prova'])
+        self._run_step('filter_tests', filter_lab_codi, self.df, conversion) # Filter the interesting tests with the conversion file 
+        self._run_step('convert_units', convert_reference_unit, self.df, conversion, conversion_factors_dict, unit_factors) # Convert to reference unit
+        self._run_step('prepare_lab_unified', prepare_lab_unified, self.df, False) # Prepare the dataframe
+
+        return self.df
+
+    def process(self, harmonizer = None, cache = None):
+        """ 
+        Function to process Lab data.
+        `harmonizer` (LabelHarmonizer) can be given when the test names were counted on the whole file (chunked reading).
+        `cache` (CleaningCache) reuses the cleaning of results and units seen in previous runs.
+        """
+        self.df = self._clean(harmonizer, cache)
+        self._run_step('cast_columns', self.cast_columns)
 
         return self.df
     
-    def filter_lab(self, lab_conversion):
-        """ Filter lab data based on codi_prova from the conversion file.  And unify the units. """
+    def filter_lab(self, lab_conversion, unit_factors = None):
+        """ 
+        Filter lab data based on codi_prova from the conversion file.  And unify the units. 
+        The lab data must be already processed. `lab_conversion` can be the path to the conversion file or the conversion dataframe.
+        `unit_factors` can be given when it was built once for all the chunks (see build_unit_factors).
+        """
         #self._check_if_lab()
-        conversion = read_conversion_file(lab_conversion) # Read the conversion file
+        conversion = self._read_conversion(lab_conversion)
+        self.df = self._convert(conversion, unit_factors)
+        self._run_step('cast_columns', self.cast_columns)
+
+        return self.df
+
+    def process_and_filter(self, lab_conversion, harmonizer = None, cache = None, unit_factors = None):
+        """ 
+        Filter-first processing of raw lab data: keep only the tests in the conversion file,
+        then clean, standardize and convert them to the reference unit.
+        `lab_conversion` can be the path to the conversion file or the conversion dataframe.
+        `unit_factors` can be given when it was built once for all the chunks (see build_unit_factors).
+        """
+        conversion = self._read_conversion(lab_conversion)
+        self._run_step('filter_raw_tests', self._filter_tests, conversion) # Drop the tests not in the conversion file before cleaning
+        self.df = self._clean(harmonizer, cache)
+        self.df = self._convert(conversion, unit_factors)
+        self._run_step('cast_columns', self.cast_columns)
 
-        self.df = filter_lab_codi(self.df, conversion) # Filter the interesting tests with the conversion file 
-        self.df = convert_reference_unit(self.df, conversion, conversion_factors_dict) # Convert to reference unit
-        self.df = prepare_lab_unified(self.df) # Prepare the dataframe
+        return self.df
+
+    def process_in_parallel(self, workers, lab_conversion = None, harmonizer = None, cache = None, unit_factors = None):
+        """ 
+        Same as process (or process_and_filter if lab_conversion is given), cleaning the data in `workers` processes.
+        Rows are split by lab_prova_c, so all the rows of a test code (and its name harmonization) are in the same process.
+        `unit_factors` can be given when it was built once for all the chunks (see build_unit_factors).
+        """
+        conversion = None
+        if lab_conversion is not None:
+            conversion = self._read_conversion(lab_conversion)
+            self._run_step('filter_raw_tests', self._filter_tests, conversion)
+
+        self._check_if_lab()
+        self._run_step('clean_in_workers', run_sharded, self.df, 'lab_prova_c', workers, _clean_shard, self.column_casts, harmonizer, cache)
+        if conversion is not None:
+            self.df = self._convert(conversion, unit_factors)
+        self._run_step('cast_columns', self.cast_columns)
+
+        return self.df
 
-        self.df = self.cast_columns()
 
-        return self.df
\ No newline at end of file
+def _clean_shard(df, column_casts, harmonizer = None, cache = None):
+    """ Clean one shard of raw lab data in a worker process (see Lab.process_in_parallel)."""
+    return Lab(df, column_casts)._clean(harmonizer, cache)
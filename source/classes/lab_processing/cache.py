@@ -0,0 +1,102 @@
+################################################
+# Persistent cache of the cleaning of distinct lab results and units
+
+import os
+import hashlib
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# Files with the cleaning rules: if any of them changes, the cache is rebuilt.
+_RULES_FILES = ['patterns.py', 'clean_lab.py', 'classifier.py']
+
+def cleaning_version():
+    """ Hash of the cleaning rules (patterns and cleaning code) used to invalidate the cache."""
+    digest = hashlib.sha256()
+    for name in _RULES_FILES:
+        with open(os.path.join(os.path.dirname(__file__), name), 'rb') as file:
+            digest.update(file.read())
+
+    return digest.hexdigest()
+
+
+class CleaningCache:
+    """
+    SQLite cache that maps each raw lab result and unit already seen to its cleaning outputs,
+    so that only new values go through the regular expressions.
+    The cache is keyed by cleaning_version(): when patterns.py (or the cleaning code) changes, it is emptied.
+    """
+    # Cleaning outputs stored for each table
+    tables = {
+        'results': ['clean_result', 'num_type', 'comentari_flags', 'unit'],
+        'units': ['clean_unit', 'comentari_unitat'],
+    }
+
+    def __init__(self, path):
+        """ Constructor for the CleaningCache class. `path` is the SQLite file (created if it does not exist)."""
+        self.path = path
+        self.version = cleaning_version()
+        self._connection = None
+        self._known = {}
+        self._connect()
+
+    def __getstate__(self):
+        """ Only the path and version are sent to worker processes; each one opens its own connection."""
+        return {'path': self.path, 'version': self.version, '_connection': None, '_known': {}}
+
+    def _connect(self):
+        """ Open the SQLite file and empty it if it was built with other cleaning rules."""
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            with self._connection as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+                if row is None or row[0] != self.version:
+                    for table in self.tables:
+                        connection.execute(f"DROP TABLE IF EXISTS {table}")
+                    connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.version,))
+                for table, columns in self.tables.items():
+                    connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (raw TEXT PRIMARY KEY, {', '.join(columns)})")
+
+        return self._connection
+
+    def _table(self, table):
+        """ Cached outputs of a table indexed by the raw value (read once)."""
+        if table not in self._known:
+            known = pd.read_sql_query(f"SELECT * FROM {table}", self._connect()).set_index('raw').astype(object)
+            self._known[table] = known.where(known.notna(), pd.NA)
+
+        return self._known[table]
+
+    def _store(self, table, values, outputs):
+        """ Add the outputs of new raw values to the cache."""
+        columns = self.tables[table]
+        rows = [(value, *[None if pd.isna(output) else output.item() if isinstance(output, np.generic) else output for output in row])
+                for value, row in zip(values, outputs[columns].itertuples(index=False))]
+        with self._connect() as connection:
+            connection.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({', '.join(['?'] * (len(columns) + 1))})", rows)
+
+        new = pd.DataFrame(outputs[columns].to_numpy(dtype=object), index=pd.Index(values, name='raw'), columns=columns)
+        self._known[table] = pd.concat([self._table(table), new])
+
+    def clean(self, table, values, clean):
+        """
+        Return the cleaning outputs of the distinct `values` (one row per value, in the same order).
+        Text values found in the cache are taken from it; the rest are cleaned with clean(values) and the text ones stored.
+        """
+        columns = self.tables[table]
+        values = np.asarray(values, dtype=object)
+        known = self._table(table)
+
+        is_text = np.array([isinstance(value, str) for value in values], dtype=bool)
+        found = is_text & pd.Index(values).isin(known.index)
+
+        result = pd.DataFrame(index=range(len(values)), columns=columns, dtype=object)
+        if found.any():
+            result.loc[found, columns] = known.loc[values[found], columns].to_numpy(dtype=object)
+        if (~found).any():
+            new = clean(values[~found]).reset_index(drop=True)
+            result.loc[~found, columns] = new[columns].to_numpy(dtype=object)
+            self._store(table, values[~found][is_text[~found]], new[is_text[~found]])
+
+        return result
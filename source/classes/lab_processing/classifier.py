@@ -0,0 +1,109 @@
+################################################
+# Compiled classifier for lab results
+
+import re
+import numpy as np
+import pandas as pd
+from source.classes.lab_processing.patterns import cleaning_comments
+
+
+class ResultClassifier:
+    """
+    Handle the extra variables of the lab results (interpretative flags, units, signs, percents and exponents)
+    and classify the numeric results (n1, n2, n3, n4, other) in a single scan.
+    Every regex is compiled once from patterns.py and the rules are applied in order, so later patterns override earlier ones.
+    """
+
+    def __init__(self, patterns_common_words, numeric_patterns):
+        """
+        Constructor for the ResultClassifier class.
+
+        Args:
+            patterns_common_words (dict): Flags and the patterns that detect them.
+            numeric_patterns (dict): Numeric patterns (n1, n2, n3, n4, other, exponent, units).
+        """
+        # Step 1: Interpretative flags (positive, negative, normal, etc.)
+        self.flags = [(flag, re.compile(pattern, re.IGNORECASE))
+                      for flag, patterns in patterns_common_words.items() for pattern in patterns]
+        self.only_letters = re.compile(r'^[a-zA-Z]+$')
+
+        # Step 2: Units adjacent to numbers. Units are extracted case sensitive, as str.extract does.
+        adjacent_units1 = r'^(' + numeric_patterns['n1'] + r')\s*(' + numeric_patterns['units']  + r')$'
+        adjacent_units2 = r'^(' + numeric_patterns['units'] + r')\s*(' + numeric_patterns['n1'] + r')$'
+        self.units_after = re.compile(adjacent_units1, re.IGNORECASE)
+        self.units_after_extract = re.compile(adjacent_units1)
+        self.units_before = re.compile(adjacent_units2, re.IGNORECASE)
+        self.units_before_extract = re.compile(adjacent_units2)
+
+        # Steps 3 to 5: Sign, percent and exponents
+        self.sign = re.compile(rf"^\+\s*({numeric_patterns['n1']})$")
+        self.percent = re.compile(rf"^({numeric_patterns['n1']}) *(%)$")
+        self.exponent = re.compile(rf"^({numeric_patterns['exponent']})$")
+
+        # Numeric types
+        self.num_types = [(num_type, re.compile(f"^{numeric_patterns[num_type]}$"))
+                          for num_type in ['n1', 'n2', 'n3', 'n4', 'other']]
+
+    def classify_value(self, value):
+        """
+        Classify one result already cleared of typos.
+        Returns (clean_result, comentari_flags, has_unit, unit, num_type); unit is only meaningful if has_unit.
+        """
+        comentari = 0
+        has_unit, unit = False, None
+
+        if isinstance(value, str):
+            for flag, pattern in self.flags:
+                if pattern.search(value):
+                    comentari |= cleaning_comments['literal']
+                    value = flag
+            if comentari == 0 and self.only_letters.match(value):
+                comentari |= cleaning_comments['literal']
+
+            if self.units_after.search(value):
+                extracted = self.units_after_extract.search(value)
+                has_unit, unit = True, extracted.group(3) if extracted else float('nan')
+                comentari |= cleaning_comments['units']
+                value = self.units_after.sub(r'\1', value)
+
+            if self.units_before.search(value):
+                extracted = self.units_before_extract.search(value)
+                has_unit, unit = True, extracted.group(1) if extracted else float('nan')
+                comentari |= cleaning_comments['units']
+                value = self.units_before.sub(r'\2', value)
+
+            if self.sign.search(value):
+                comentari |= cleaning_comments['flag']
+                value = self.sign.sub(r'\1', value)
+
+            if self.percent.search(value):
+                extracted = self.percent.search(value)
+                has_unit, unit = True, extracted.group(3)
+                comentari |= cleaning_comments['percent']
+                value = self.percent.sub(r'\1', value)
+
+            if self.exponent.search(value):
+                comentari |= cleaning_comments['exponents']
+
+        num_type = pd.NA
+        for name, pattern in self.num_types:
+            if pattern.match(str(value)):
+                num_type = name
+
+        return value, comentari, has_unit, unit, num_type
+
+    def classify(self, df):
+        """
+        Handle the extra variables and classify the numeric results of df['clean_result'] in one scan.
+        Adds comentari_flags (cleaning comment bits) and num_type and replaces unitat_mesura where the unit was found in the result.
+        """
+        results = [self.classify_value(value) for value in df['clean_result']]
+        columns = list(zip(*results)) if results else [[]] * 5
+
+        df['clean_result'] = pd.Series(columns[0], index=df.index, dtype=object)
+        df['comentari_flags'] = np.array(columns[1], dtype=np.uint8)
+        has_unit = pd.Series(columns[2], index=df.index, dtype=bool)
+        df['unitat_mesura'] = df['unitat_mesura'].mask(has_unit, pd.Series(columns[3], index=df.index, dtype=object))
+        df['num_type'] = pd.Series(columns[4], index=df.index, dtype=object)
+
+        return df
@@ -4,59 +4,68 @@
 import re
 import pandas as pd
 import numpy as np
+from source.utils.harmonizer import LabelHarmonizer
+from source.classes.lab_processing.classifier import ResultClassifier
+from source.classes.lab_processing.patterns import cleaning_comments
 
 # -----------------------------------------
 # ----- General functions
-def standardize_number(value):
-    """ Standardizes the format of numeric values in the lab data."""
-    if not isinstance(value, str):
-        return value  # If value is not a string, return it as is
+def _round_number(value):
+    """ Transform a standardized string to numeric and round it to 4 decimal places (None if it is not a number)."""
+    try:
+        return round(float(value), 4)
+    except ValueError:
+        return None
+
+def standardize_number_series(values, numeric = False):
+    """ 
+    Standardizes the format of numeric values in the lab data (Spanish-formatted numbers, decimal commas, leading zeros,
+    rounded to 4 decimal places) with vectorized string methods. Each distinct value is standardized once.
+    Non-string values are kept as they are.
+    If numeric is True, floats are returned instead of strings (NaN if the value is not a number).
+    """
+    if values.dtype != object:
+        return pd.to_numeric(values, errors='coerce') if numeric else values
+
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    distinct = pd.Series(uniques, dtype=object)
+    is_str = distinct.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+    text = distinct[is_str]
 
     # Step 1: Apply specific rules for Spanish-formatted numbers.
-    # Mask 1: Remove commas in strings with two or more commas
-    if re.search(r'\d{1,3},0{3},0{3}', value):  # Matches '1,000,000' or similar
-        value = re.sub(r',', '', value)
-
-    # Mask 2: Remove commas in '10,000' or '100,000'
-    elif re.search(r'10{1,2},000', value):  # Matches '10,000' or '100,000'
-        value = re.sub(r',', '', value)
-
+    # Mask 1 and 2: Remove commas in '1,000,000', '10,000', '100,000' or similar
+    thousands = text.str.contains(r'\d{1,3},0{3},0{3}') | text.str.contains(r'10{1,2},000')
+    text = text.where(~thousands, text.str.replace(',', '', regex=False))
     # Mask 3: Adjust values like ',1234' to '0,1234'
-    if re.match(r'^[,\.]\d+', value):
-        value = '0' + value.replace(',', '.')
+    leading = text.str.match(r'^[,\.]\d+')
+    text = text.where(~leading, '0' + text.str.replace(',', '.', regex=False))
 
     # Step 2: Transform commas to dots for decimal numbers (e.g., '1,23' -> '1.23')
-    value = re.sub(r',', '.', value)
+    text = text.str.replace(',', '.', regex=False)
 
     # Step 3: Remove leading zeros unless it's a decimal (e.g., '01.23' -> '1.23')
-    value = re.sub(r'^0+(\.\d+)', r'0\1', value)  # Ensure '0.x' is kept
-    value = re.sub(r'^0+(\d)', r'\1', value)  # Remove leading zeros before digits
+    text = text.str.replace(r'^0+(\.\d+)', r'0\1', regex=True)
+    text = text.str.replace(r'^0+(\d)', r'\1', regex=True)
 
     # Step 4: Transform to numeric and round to 4 decimal places
-    try:
-        value = round(float(value), 4)
-    except ValueError:
-        pass  # If conversion fails, keep the original value
+    rounded = [_round_number(value) for value in text]
 
-    return str(value)
+    if numeric:
+        result = pd.to_numeric(distinct.where(~is_str), errors='coerce').to_numpy(dtype=float)
+        result[is_str] = [np.nan if value is None else value for value in rounded]
+    else:
+        result = distinct.to_numpy(dtype=object)
+        result[is_str] = [value if number is None else str(number) for value, number in zip(text, rounded)]
 
-def standardize_n2(value):
-    """ Standardizes the format of numeric values of num_type n2 in the lab data."""
-    # Ensure there are no spaces in the value
-    value = re.sub(r" ", "", value)
+    return pd.Series(result[codes], index=values.index)
 
-    # Step 1: Extract the non numerical parts:
-    non_numerical = re.findall("[<>=]", value)
-    numerical = re.sub("[<>=]", "", value)
+def standardize_n2_series(values):
+    """ Standardizes the format of numeric values of num_type n2 (e.g. '<0,5' -> '<0.5'): the signs are kept and the number is standardized."""
+    values = values.str.replace(' ', '', regex=False)
+    non_numerical = values.str.findall('[<>=]').str.join('')
+    numerical = values.str.replace('[<>=]', '', regex=True)
 
-    # Step 2: Standardize numbers
-    standardized_value = list(standardize_number(numerical))
-
-    # Add all together and generate the result
-    result = non_numerical + standardized_value
-    result = "".join(result)
-    
-    return result
+    return non_numerical + standardize_number_series(numerical)
 
 # -----------------------------------------
 # ----- Step 1: Clear typos
@@ -71,109 +80,14 @@ def clear_typos(df):
     return df
 
 # -----------------------------------------
-# ----- Step 2: Handle extra variables in the result
-def handle_extra_variables(df, patterns_common_words, numeric_patterns):
-    """Cleans df['clean_result'] by handling flags, units, and interpretative comments."""
-    # Ensure 'comentari' column exists:
-    if 'comentari' not in df.columns:
-        df['comentari'] = pd.NA
-
-    def add_cleaning_comment(mask, comment):
-        """Helper function to add a cleaning comment."""
-        # Only update rows where the comment is not already present
-        df.loc[mask, 'comentari'] = df.loc[mask, 'comentari'].apply(
-            lambda x: f"{x}, {comment}".strip(', ') if pd.notna(x) and comment not in x else comment if pd.isna(x) else x
-        )
-
-    # Step 1: Handle interpretative flags (positive, negative, normal, etc.)
-    for flag, patterns in patterns_common_words.items():
-        for pattern in patterns:
-            # Use str.extract to directly capture matching groups
-            mask_literal = df['clean_result'].str.contains(pattern, na=False, flags=re.IGNORECASE, regex=True) # Filter dataframe to only include rows where the pattern is found
-
-            # Update the cleaning_comments column for affected rows
-            add_cleaning_comment(mask_literal, 'literal')
-
-            # Apply the replacement to the clean_result column only for rows that match the pattern
-            df.loc[mask_literal, 'clean_result'] = flag
-    # Handle all those cases in which there are no numeric values but are not already flagged as literal
-    mask_else_literal = (df["comentari"].isna()) & (df['clean_result'].str.match(r'^[a-zA-Z]+$', na=False)) # Filter dataframe to only include rows where the pattern is found
-    add_cleaning_comment(mask_else_literal, 'literal') # Add a comment to the 'comentari' column.
-
-    # Step 2: Handle units and flags adjacent to numbers
-    adjacent_units1 = r'^(' + numeric_patterns['n1'] + r')\s*(' + numeric_patterns['units']  + r')$'
-    adjacent_units2 = r'^(' + numeric_patterns['units'] + r')\s*(' + numeric_patterns['n1'] + r')$'
-
-    # Case 1: Units after the result
-    mask_units_after = df['clean_result'].str.contains(adjacent_units1, na=False, flags=re.IGNORECASE, regex=True) #Filter dataframe to only include rows where the pattern is found.
-    unit_extracted = df.loc[mask_units_after, 'clean_result'].str.extract(adjacent_units1) # Extract parts from the matched string.
-    add_cleaning_comment(mask_units_after, 'units') # Add a comment to the 'comentari' column.
-    df.loc[mask_units_after, 'clean_result'] = df.loc[mask_units_after, 'clean_result'].str.replace(
-        adjacent_units1, r'\1', flags=re.IGNORECASE, regex=True
-    ) # Replace the matched string with the first group of the extracted string.
-    
-    # Fix: Use str.extract to get the correct unit for unitat_mesura
-    df.loc[mask_units_after, 'unitat_mesura'] = unit_extracted[2] # Assign the third group of the extracted string to the 'unitat_mesura' column.
-
-    # Case 2: Units before the result
-    mask_units_before = df['clean_result'].str.contains(adjacent_units2, na=False, flags=re.IGNORECASE, regex=True) #Filter dataframe to only include rows where the pattern is found.
-    unit_extracted = df.loc[mask_units_before, 'clean_result'].str.extract(adjacent_units2) # Extract parts from the matched string.
-    add_cleaning_comment(mask_units_before, 'units') # Add a comment to the 'comentari' column.
-    df.loc[mask_units_before, 'clean_result'] = df.loc[mask_units_before, 'clean_result'].str.replace(
-        adjacent_units2, r'\2', flags=re.IGNORECASE, regex=True
-    ) # Replace the matched string with the first group of the extracted string
-    
-    # Fix: Use str.extract to get the correct unit for unitat_mesura
-    df.loc[mask_units_before, 'unitat_mesura'] = unit_extracted[0]
-
-    # Step 3: Handle positive
-    for sign, _ in [("\\+", "positive")]:
-        pattern = rf"^{sign}\s*({numeric_patterns['n1']})$" # Define the pattern to match.
-        mask_sign = df['clean_result'].str.contains(pattern, na=False, regex=True) # Filter dataframe to only include rows where the pattern is found.
-        add_cleaning_comment(mask_sign, 'flag') # Add a comment to the 'comentari' column.
-        df.loc[mask_sign, 'clean_result'] = df.loc[mask_sign, 'clean_result'].str.replace(
-            pattern, r'\1', regex=True
-        ) # Replace the matched string with the first group of the extracted string.
-
-    # Step 4: Handle percent
-    percent_pattern = rf"^({numeric_patterns['n1']}) *(%)$" # Define the pattern to match.
-    mask_percent = df['clean_result'].str.contains(percent_pattern, na=False, regex=True) # Filter dataframe to only include rows where the pattern is found.
-    percent_result = df.loc[mask_percent, 'clean_result'].str.extract(percent_pattern) # Extract parts from the matched string.
-    add_cleaning_comment(mask_percent, 'percent')
-    df.loc[mask_percent, 'clean_result'] = df.loc[mask_percent, 'clean_result'].str.replace(
-        percent_pattern, r'\1', regex=True
-    ) # Replace the matched string with the first group of the extracted string.
-    df.loc[mask_percent, 'unitat_mesura'] = percent_result[2]
-
-    # Step 5: Handle exponents
-    exponent_pattern = rf"^({numeric_patterns['exponent']})$" # Define the pattern to match.
-    mask_exponent = df['clean_result'].str.contains(exponent_pattern, na=False, regex=True) # Filter dataframe to only include rows where the pattern is found.
-    add_cleaning_comment(mask_exponent, 'exponents') # Add comment
-    # Extract base number and exponent separately
-    # extracted = df.loc[mask_exponent, 'clean_result'].str.extract(exponent_pattern)
-    # Apply standardization to the base number (n1)
-    # df.loc[mask_exponent, 'clean_result'] = extracted[0].apply(standardize_number) + extracted[2] # Clean the number and add the exponent
-    
-    # Clean up stray characters from exponents
-    #df['clean_result'] = df['clean_result'].str.replace(r"[\*\^]", "", regex=True)
-
-    return df
-
-# -----------------------------------------
-# ----- Step 3: Classify the numeric result
-def classify_numeric_results(df,  numeric_patterns):
-    """ Classifies numeric results into n1, n2, n3, and n4 scales based on patterns."""
-    # Ensure 'comentari' column exists:
-    if 'num_type' not in df.columns:
-        df['num_type'] = pd.NA
-
-    for num_type in ['n1', 'n2', 'n3', 'n4', 'other']:
-        # Assign the scale type based on the numeric patterns
-        df['num_type'] = df['num_type'].where(
-            ~df['clean_result'].astype(str).str.match(f"^{numeric_patterns[num_type]}$"), num_type
-        )
+# ----- Steps 2 and 3: Handle extra variables in the result and classify the numeric result
+# Both run in a single scan of each distinct result (see ResultClassifier)
+def comentari_text(flags):
+    """ Build the 'comentari' text ('literal', 'units, percent', ...) from the cleaning comment bits."""
+    texts = np.array([", ".join(comment for comment, bit in cleaning_comments.items() if code & bit) or pd.NA
+                      for code in range(2 ** len(cleaning_comments))], dtype=object)
 
-    return df
+    return pd.Series(texts[flags.to_numpy()], index=flags.index)
 
 # -----------------------------------------
 # ----- Step 4: Standardize numeric results based in classification
@@ -182,7 +96,7 @@ def standardize_numeric_results(df):
 
     # Step 1: Harmonize n1 results.
     mask_n1 = (df['num_type'] == 'n1') # Create a mask for the conditions
-    df.loc[mask_n1, 'clean_result'] = df.loc[mask_n1, 'clean_result'].apply(standardize_number) # Apply transformation using the mask (vectorized)
+    df.loc[mask_n1, 'clean_result'] = standardize_number_series(df.loc[mask_n1, 'clean_result']) # Apply transformation using the mask (vectorized)
 
     # Step 2: Harmonize n2, n3, n4 results.
     # Create the mask for the conditions
@@ -191,18 +105,16 @@ def standardize_numeric_results(df):
     for num_type in num_types:
         mask = df['num_type'] == num_type
         # Apply transformation using the mask (vectorized)
-        df.loc[mask, 'clean_result'] = df.loc[mask, 'clean_result'].apply(
-            lambda x: re.sub(r" ", "", re.sub(r"/", ":", x))
-        )
+        df.loc[mask, 'clean_result'] = df.loc[mask, 'clean_result'].str.replace("/", ":", regex=False).str.replace(" ", "", regex=False)
         if num_type == 'n2':
             # Apply the specific transformation for n2
-            df.loc[mask, 'clean_result'] = df.loc[mask, 'clean_result'].apply(standardize_n2)
+            df.loc[mask, 'clean_result'] = standardize_n2_series(df.loc[mask, 'clean_result'])
     
     # Step 3: Check that n3 results are plausible: first number must be lower than second.
     mask_n3 = df['num_type'] == 'n3'
     # Extract the first and second numbers using vectorized string methods for 'n3' rows
-    df.loc[mask_n3, 'first_number'] = df.loc[mask_n3, 'clean_result'].str.extract(r"^([0-9]+)-")[0].apply(standardize_number)
-    df.loc[mask_n3, 'second_number'] = df.loc[mask_n3, 'clean_result'].str.extract(r"-([0-9]+)$")[0].apply(standardize_number)
+    df.loc[mask_n3, 'first_number'] = standardize_number_series(df.loc[mask_n3, 'clean_result'].str.extract(r"^([0-9]+)-")[0], numeric=True)
+    df.loc[mask_n3, 'second_number'] = standardize_number_series(df.loc[mask_n3, 'clean_result'].str.extract(r"-([0-9]+)$")[0], numeric=True)
 
     # Convert the extracted values to numeric, replacing non-numeric entries with NaN
     df['first_number'] = pd.to_numeric(df['first_number'], errors='coerce')
@@ -236,33 +148,89 @@ def standardize_unit(df, unit_patterns):
 
     return df
 
+# -----------------------------------------
+# ----- Steps 1-5 on distinct values
+# Marks the distinct results whose unit was not taken from the result itself.
+_KEEP_UNIT = "__keep_unitat_mesura__"
+
+def _clean_results(values, patterns_common_words, numeric_patterns):
+    """ Run steps 1 to 4 on distinct lab results. Returns clean_result, num_type, comentari_flags and unit (_KEEP_UNIT if the unit was not in the result)."""
+    distinct = pd.DataFrame({'lab_resultat': values, 'unitat_mesura': _KEEP_UNIT})
+
+    distinct = clear_typos(distinct) # Clear typos in the lab data
+    # Handle extra variables and classify numeric results in a single scan
+    distinct = ResultClassifier(patterns_common_words, numeric_patterns).classify(distinct)
+    distinct = standardize_numeric_results(distinct) # Standardize numeric results
+
+    return distinct.rename(columns={'unitat_mesura': 'unit'})[['clean_result', 'num_type', 'comentari_flags', 'unit']]
+
+def clean_distinct_results(df, patterns_common_words, numeric_patterns, cache = None):
+    """ 
+    Run steps 1 to 4 once per distinct lab_resultat and broadcast the outputs back to the rows.
+    Steps 2 and 3 are done together by the compiled ResultClassifier. If a CleaningCache is given, only results not seen in previous runs are cleaned.
+    Adds clean_result, comentari_flags and num_type, and replaces unitat_mesura where the unit was found in the result.
+    """
+    codes, uniques = pd.factorize(df['lab_resultat'], use_na_sentinel=False)
+    clean = lambda values: _clean_results(values, patterns_common_words, numeric_patterns)
+    distinct = clean(uniques) if cache is None else cache.clean('results', uniques, clean)
+
+    # Broadcast the distinct values back to the rows with the integer codes
+    for col in ['clean_result', 'num_type']:
+        df[col] = distinct[col].to_numpy(dtype=object)[codes]
+    df['comentari_flags'] = distinct['comentari_flags'].to_numpy(dtype=np.uint8)[codes]
+    keep_unit = distinct['unit'].eq(_KEEP_UNIT).to_numpy(dtype=bool)[codes]
+    df['unitat_mesura'] = df['unitat_mesura'].where(keep_unit, distinct['unit'].to_numpy(dtype=object)[codes])
+
+    return df
+
+def standardize_distinct_units(df, unit_patterns, cache = None):
+    """ 
+    Run step 5 (standardize_unit) once per distinct unitat_mesura and broadcast clean_unit and comentari_unitat back to the rows.
+    If a CleaningCache is given, only units not seen in previous runs are standardized.
+    """
+    codes, uniques = pd.factorize(df['unitat_mesura'], use_na_sentinel=False)
+    clean = lambda values: standardize_unit(pd.DataFrame({'unitat_mesura': values}), unit_patterns)
+    distinct = clean(uniques) if cache is None else cache.clean('units', uniques, clean)
+
+    for col in ['clean_unit', 'comentari_unitat']:
+        df[col] = distinct[col].to_numpy(dtype=object)[codes]
+
+    return df
+
 # -----------------------------------------
 # ----- Step 5: Standardize test name for each code.
-def standardize_name(df):
-    """ The same lab test code can have multiple literals, we are going to keep only the most common one."""
-    df['lab_prova'] = df.groupby('lab_prova_c')['lab_prova'].transform(lambda x: x.mode()[0] if not x.mode().empty else x.iloc[0])
+def standardize_name(df, harmonizer = None):
+    """ 
+    The same lab test code can have multiple literals, we are going to keep only the most common one.
+    If a LabelHarmonizer already holding the counts of the whole file is given, it is used instead of counting df.
+    """
+    if harmonizer is None:
+        harmonizer = LabelHarmonizer('lab_prova_c', 'lab_prova').update(df)
+    df['lab_prova'] = harmonizer.apply(df)
 
     return df
 
 # -----------------------------------------
 # ----- Step 6: Reference values
-def standardize_reference_values(df):
-    """ Standardizes the reference values in the lab data."""
-    df = df.copy()
+def standardize_reference_values(df, copy = True):
+    """ Standardizes the reference values in the lab data. With copy = False df is modified in place."""
+    if copy:
+        df = df.copy()
     mask_min = df['ref_min'].notna() # Create a mask for the conditions
     mask_max = df['ref_max'].notna() # Create a mask for the conditions
     
-    df.loc[mask_min, 'ref_min'] = df.loc[mask_min, 'ref_min'].apply(standardize_number) # Apply transformation using the mask (vectorized)
-    df.loc[mask_max, 'ref_max'] = df.loc[mask_max, 'ref_max'].apply(standardize_number) # Apply transformation using the mask (vectorized)
+    df.loc[mask_min, 'ref_min'] = standardize_number_series(df.loc[mask_min, 'ref_min']) # Apply transformation using the mask (vectorized)
+    df.loc[mask_max, 'ref_max'] = standardize_number_series(df.loc[mask_max, 'ref_max']) # Apply transformation using the mask (vectorized)
 
 
     return df
 
 # -----------------------------------------
 # ----- Step 7: Standardize peticio_id
-def standardize_peticio_id(df):
-    """ Standardizes the peticio_id in the lab data."""
-    df = df.copy()
+def standardize_peticio_id(df, copy = True):
+    """ Standardizes the peticio_id in the lab data. With copy = False df is modified in place."""
+    if copy:
+        df = df.copy()
     # Remove hypens from "peticio_id"
     df["peticio_id"] = df["peticio_id"].str.replace(r"-", "")
     df["peticio_id"] = df["peticio_id"].str.replace(r"\.0", "", regex = True)
@@ -3,6 +3,9 @@
 import pandas as pd
 import numpy as np
 import openpyxl
+from source.classes.lab_processing.patterns import unit_patterns
+from source.utils.memory import select_columns
+from source.utils.text import as_text
 
 def read_conversion_file(lab_conversion):
     """ Read file with lab variables conversion."""
@@ -17,37 +20,139 @@ def read_conversion_file(lab_conversion):
         print(f"File not found: {lab_conversion}")
 
 
-def filter_lab_codi(df, conversion):
-    """ Filter lab data based on codi_prova from the conversion file. """
-    df = df.copy()
+def match_codi_dtype(conversion, codes):
+    """ Make codi_prova of the conversion file comparable with the lab test codes when these were read as text."""
+    if codes.dtype == object and conversion['codi_prova'].dtype != object:
+        conversion = conversion.assign(codi_prova=conversion['codi_prova'].astype(str))
 
-    df = df[df['codi_prova'].isin(list(conversion['codi_prova'].values))]
+    return conversion
+
+def filter_lab_codi(df, conversion, codi_col = 'codi_prova'):
+    """ Filter lab data based on codi_prova from the conversion file. Use codi_col = 'lab_prova_c' for raw lab data."""
+    df = df[df[codi_col].isin(list(conversion['codi_prova'].values))] # Selecting the rows already returns a new dataframe
 
     return df
 
-def apply_conversion(row):
-    """Apply conversion factor to the clean_result value and round to 2 decimals."""
-    value = row['clean_result']
-    factor = row['factor']
-    
-    if pd.isna(value) or pd.isna(factor):
-        return pd.NA
+def _eval_factor(code, value):
+    """ Evaluate a compiled factor expression on a single value (NaN if it fails)."""
+    try:
+        return float(eval(code, {}, {'value': value}))
+    except Exception:
+        return np.nan
+
+def compile_factor(factor):
+    """ 
+    Compile a conversion factor once into a function that converts an array of values.
+    Arithmetic expressions (e.g. 'value*88.4') are evaluated on the whole array; expressions that call
+    functions (e.g. 'round(value, 1)') are evaluated once per value. Returns None if the factor is not valid.
+    """
+    if pd.isna(factor):
+        return None
+
+    # Handle expression-based factors
+    if isinstance(factor, str) and 'value' in factor:
+        try:
+            code = compile(factor, '<factor>', 'eval')
+        except SyntaxError:
+            return None
+
+        def convert(values):
+            if set(code.co_names) <= {'value'}: # Only arithmetic on value
+                try:
+                    with np.errstate(all='ignore'):
+                        return np.broadcast_to(np.asarray(eval(code, {}, {'value': values}), dtype=float), values.shape)
+                except Exception:
+                    pass
+            return np.array([_eval_factor(code, float(value)) for value in values], dtype=float)
+
+        return convert
 
     try:
-        # Handle expression-based factors
-        if isinstance(factor, str) and 'value' in factor:
-            result = eval(factor.replace('value', str(value)))
-        else:
-            result = value * float(factor)
-        return round(result, 2)
-    except Exception as e:
-        return pd.NA
-    
-def convert_reference_unit(df, conversion, conversion_factors_dict):
-    """ Convert units to the reference unit."""
+        factor = float(factor)
+    except (TypeError, ValueError):
+        return None
 
-    df = df.copy()
-    df = df.rename(columns = {'clean_unit': 'from_unit'}) # Rename the clean_unit column to from_unit
+    def convert(values):
+        with np.errstate(all='ignore'):
+            return values * factor
+
+    return convert
+
+def apply_conversion(values, factors):
+    """ 
+    Apply the conversion factors to the values and round to 2 decimals.
+    Each distinct factor is compiled once and applied to all its values at once.
+    """
+    values = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+    codes, distinct_factors = pd.factorize(factors)
+
+    converted = np.full(len(values), np.nan)
+    for code, factor in enumerate(distinct_factors):
+        convert = compile_factor(factor)
+        if convert is not None:
+            rows = codes == code
+            converted[rows] = convert(values[rows])
+    converted[~np.isfinite(converted) | np.isnan(values)] = np.nan # Missing values, divisions by zero and overflows
+
+    # Round once per distinct result, with the same rounding as round()
+    codes, distinct_results = pd.factorize(converted)
+    rounded = np.array([round(float(result), 2) for result in distinct_results] + [np.nan])
+
+    return pd.Series(rounded[codes], index=factors.index, dtype='Float64')
+
+def _unit_edges(conversion_factors_dict, conversion = None):
+    """ List the (from_unit, to_unit, factor) links between units: explicit factors first, then their inverses."""
+    edges = [(from_unit, to_unit, float(factor)) for (from_unit, to_unit), factor in conversion_factors_dict.items()]
+    if conversion is not None:
+        for from_unit, to_unit, factor in conversion[['from_unit', 'to_unit', 'factor']].itertuples(index=False):
+            factor = pd.to_numeric(factor, errors='coerce') # Expression-based factors can not be chained
+            if pd.notna(from_unit) and pd.notna(to_unit) and pd.notna(factor):
+                edges.append((from_unit, to_unit, float(factor)))
+
+    return edges + [(to_unit, from_unit, 1 / factor) for from_unit, to_unit, factor in edges if factor != 0]
+
+def _factors_to(to_unit, edges):
+    """ Search the unit graph backwards from to_unit and return the factor from each reachable unit to to_unit (fewest steps first)."""
+    incoming = {}
+    for from_unit, unit, factor in edges:
+        incoming.setdefault(unit, []).append((from_unit, factor))
+
+    factors = {to_unit: 1.0}
+    queue = [to_unit]
+    for unit in queue:
+        for from_unit, factor in incoming.get(unit, []):
+            if from_unit not in factors:
+                factors[from_unit] = factor * factors[unit]
+                queue.append(from_unit)
+
+    return factors
+
+def build_unit_factors(conversion, conversion_factors_dict):
+    """ 
+    Precompute the factor from every unit to the reference unit (to_unit) of each test in the conversion file.
+    Units are linked by conversion_factors_dict and by the numeric factors of the same test in the conversion file,
+    and factors are chained along the path with fewest steps (e.g. ng/mL -> ug/mL -> mg/dL).
+    Returns a table with one row per codi_prova (as text, see as_text) and one column per unit (NaN if the unit can not be converted).
+    It is built once per run and reused for every chunk (see convert_reference_unit).
+    """
+    units = list(dict.fromkeys(list(unit_patterns) + [unit for edge in _unit_edges(conversion_factors_dict, conversion) for unit in edge[:2]]))
+    tests = conversion.dropna(subset=['codi_prova', 'to_unit']).groupby('codi_prova', sort=False)
+
+    unit_factors = pd.DataFrame(np.nan, index=pd.Index(list(tests.groups), name='codi_prova'), columns=units)
+    for codi, test_conversion in tests:
+        factors = _factors_to(test_conversion['to_unit'].iloc[0], _unit_edges(conversion_factors_dict, test_conversion))
+        unit_factors.loc[codi, list(factors)] = list(factors.values())
+    unit_factors.index = pd.Index(as_text(unit_factors.index.to_series()).to_numpy(), name='codi_prova') # Same key for codes read as numbers or text
+
+    return unit_factors
+
+def convert_reference_unit(df, conversion, conversion_factors_dict, unit_factors = None):
+    """ 
+    Convert units to the reference unit.
+    `unit_factors` is the table of build_unit_factors for the conversion file, built once when the data is processed in chunks (built here if None).
+    """
+
+    df = df.rename(columns = {'clean_unit': 'from_unit'}, copy = False) # Rename the clean_unit column to from_unit (new columns are not added to the input df)
 
     # Add the reference unit to the lab dataframe
     conversion_short = conversion[['codi_prova', 'to_unit']].drop_duplicates()
@@ -64,15 +169,20 @@ def convert_reference_unit(df, conversion, conversion_factors_dict):
     # 1. Add factor when from_unit is equal to to_unit
     merged_df.loc[merged_df['from_unit'] == merged_df['to_unit'], 'factor'] = 1
 
-    # 2. Add factor when it is not in the conversion file but the factor is in the conversion factors dict
+    # 2. Add factor when it is not in the conversion file but the units can be converted with the conversion factors dict,
+    #    directly or chaining factors (also with the factors of the same test in the conversion file)
     mask = merged_df['factor'].isna()
-    merged_df.loc[mask, 'factor'] = merged_df[mask].apply(
-        lambda row: conversion_factors_dict.get((row['from_unit'], row['to_unit']), pd.NA),
-        axis=1
-    )
+    if unit_factors is None:
+        unit_factors = build_unit_factors(conversion, conversion_factors_dict)
+    tests = unit_factors.index.get_indexer(as_text(merged_df.loc[mask, 'codi_prova']))
+    units = unit_factors.columns.get_indexer(merged_df.loc[mask, 'from_unit'])
+    found = (tests >= 0) & (units >= 0)
+    factors = np.full(len(tests), np.nan)
+    factors[found] = unit_factors.to_numpy()[tests[found], units[found]]
+    merged_df.loc[mask, 'factor'] = factors
 
     # FINAL: Convert the result using the factor
-    merged_df['converted_result'] = merged_df.apply(apply_conversion, axis=1)
+    merged_df['converted_result'] = apply_conversion(merged_df['clean_result'], merged_df['factor'])
 
     # ADD group
     conversion_group = conversion[['codi_prova', 'group']].drop_duplicates()
@@ -80,21 +190,21 @@ def convert_reference_unit(df, conversion, conversion_factors_dict):
     
     return result_df
 
-def prepare_lab_unified(df):
-    """ Prepare the lab data to be output. """
+def prepare_lab_unified(df, copy = True):
+    """ Prepare the lab data to be output. With copy = False the selected columns share the data of df. """
     # Identify the individual identificator col
     id_col = df.columns[0]
     # Select relevant columns
+    columns = [id_col, 'peticio_id', 'any', 'data', 'codi_prova', 'prova','clean_result', 'from_unit', 'converted_result', 'to_unit']
     if 'group' in df.columns:
-        df = df[[id_col, 'peticio_id', 'any', 'data', 'codi_prova', 'prova','clean_result', 'from_unit', 'converted_result', 'to_unit', 'group']].copy()
-    else:
-        df = df[[id_col, 'peticio_id', 'any', 'data', 'codi_prova', 'prova','clean_result', 'from_unit', 'converted_result', 'to_unit']].copy()
+        columns.append('group')
+    df = df[columns].copy() if copy else select_columns(df, columns)
 
     # If there is no unit, converted_result is empty
     df.loc[df['from_unit'].isna(),'converted_result'] = pd.NA
     
     #Rename columns
-    df = df.rename(columns = {'from_unit': 'unit', 'to_unit': 'converted_unit'})
+    df = df.rename(columns = {'from_unit': 'unit', 'to_unit': 'converted_unit'}, copy = copy)
 
     return df
 
@@ -19,16 +19,25 @@ patterns_common_words = {
         r"^(?:.*s[in|ense].*).*alteraci[oóóò]n.*$",	
     ],
     'baix': [
-        r".*(?!.*\bno\b).*\b(?:ba(?:jo|ix))\b.*"
+        r"(?=\b(?:ba(?:jo|ix))\b)(?!.*\bno\b).*"  # Same matches as ".*(?!.*\bno\b).*\b(?:ba(?:jo|ix))\b.*" without the quadratic backtracking
     ],
     'alt': [
-        r".*(?!.*\bno\b).*\b(?:alt(?:o)?)\b.*"
+        r"(?=\b(?:alt(?:o)?)\b)(?!.*\bno\b).*"  # Same matches as ".*(?!.*\bno\b).*\b(?:alt(?:o)?)\b.*" without the quadratic backtracking
     ],
     'microorganisme' : [
         r".*microorganisme\s?a[ïi]llat.*"
     ]
 }
 
+# Bits used to store the cleaning comments of the results, in the order they are written in 'comentari'
+cleaning_comments = {
+    'literal': 1,
+    'units': 2,
+    'flag': 4,
+    'percent': 8,
+    'exponents': 16,
+}
+
 numeric_patterns = {
     'n1': r"(?!:\d+[\.,]\d+[\.,]\d{1,2})-?([\.,]?[0-9]+)+",  # General number pattern
     'n2': r"[<>]\s*(=?\s*)(([0-9]+([\.,][0-9]+)?)|([0-9]*[\.,][0-9]+))",  # Optional sign pattern and number, e.g., >100
@@ -2,14 +2,17 @@
 from source.classes.common import CommonData
 from source.utils.mesures_info import unitats 
 import pandas as pd
+import numpy as np
 
 class Mesures(CommonData):
     """
     Processes measurement-related data from the PADRIS dataset.
     Includes filtering by relevant codes and acceptable value ranges.
+    The processed data can also be written wide: one row per individual and date with the BMI (see to_wide).
     """
+    height_tolerance = 365 # to_wide(): maximum days between a weight and the height used for its BMI
 
-    def __init__(self, df, column_casts, ranges, codis):
+    def __init__(self, df, column_casts, ranges, codis, unitats_mesures = None):
         """
         Initialize Measures class.
         
@@ -18,10 +21,13 @@ class Mesures(CommonData):
             column_casts (dict): Dictionary of column type mappings.
             ranges (dict): Valid value ranges for each code.
             codis (dict): Dictionary of relevant measurement codes.
+            unitats_mesures (dict): [Optional] Unit of each code (the units of mesures_info by default).
         """
         super().__init__(df, column_casts)
         self.ranges = ranges
         self.codis = codis
+        self.unitats = unitats if unitats_mesures is None else unitats_mesures
+        self.out_of_range = {} # Rows removed by the range filter per code: [out of range, without a numeric value]
 
     def _check_if_mesures(self):
         """Check if the columns correspond to a Mesures file; if not, raise an error."""
@@ -34,28 +40,32 @@ class Mesures(CommonData):
         self.df = self.df[self.df['Prova_codi'].isin(self.codis.keys())]
         return self.df
 
-    @staticmethod
-    def _filter_by_range(row, ranges):
-        """Check if a value falls within a valid range for its code."""
-        codi = row['Prova_codi']
-        value = row['Prova_resultat']
-        valid_range = ranges.get(codi)
-
-        try:
-            if pd.isna(value):
-                return False
-            value = float(value)
-            if valid_range:
-                return valid_range[0] <= value <= valid_range[1]
-        except (ValueError, TypeError):
-            # You can log or print a warning here if needed
-            return False
-
-        return False
+    def _range_bounds(self, codes, uniques):
+        """Lower and upper bound of each row from the factorized codes (NaN for codes without a range, so no value is valid)."""
+        bounds = np.array([self.ranges.get(codi, [np.nan, np.nan]) for codi in uniques] + [[np.nan, np.nan]], dtype=float).reshape(-1, 2)
+        return bounds[codes, 0], bounds[codes, 1] # Code -1 (missing) takes the last row
 
     def _apply_range_filter(self):
-        """Filter rows where the measurement value is within allowed range."""
-        self.df = self.df[self.df.apply(self._filter_by_range, axis=1, args=(self.ranges,))]
+        """
+        Filter rows where the measurement value is within allowed range (bounds included).
+        Rows without a numeric value or whose code has no range are removed as well. The removed rows are counted per code.
+        """
+        codes, uniques = pd.factorize(self.df['Prova_codi'])
+        lower, upper = self._range_bounds(codes, uniques)
+        values = pd.to_numeric(self.df['Prova_resultat'], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        valid = (values >= lower) & (values <= upper)
+
+        # Count the removed rows per code
+        missing = np.isnan(values)
+        out_of_range = np.bincount(codes[~valid & ~missing & (codes >= 0)], minlength=len(uniques))
+        without_value = np.bincount(codes[missing & (codes >= 0)], minlength=len(uniques))
+        for codi, out, na in zip(uniques, out_of_range, without_value):
+            if out or na:
+                counts = self.out_of_range.setdefault(codi, [0, 0])
+                counts[0] += int(out)
+                counts[1] += int(na)
+
+        self.df = self.df[valid]
         return self.df
 
     def _add_unit(self, unitats_mesures):
@@ -63,14 +73,87 @@ class Mesures(CommonData):
         self.df['unitat'] = self.df['Prova_codi'].map(unitats_mesures)
         return self.df
 
+    @staticmethod
+    def _bmi(wide, id_codes, tolerance):
+        """
+        BMI (kg/m2) of each wide row with a weight, with the height of the same individual nearest in time
+        (as-of join within `tolerance` days). NaN if there is no weight or no height close enough.
+        """
+        dated = wide['data'].notna().to_numpy() & (id_codes >= 0)
+        keys = pd.DataFrame({'row': np.arange(len(wide)), 'individual': id_codes, 'data': wide['data'],
+                             'Pes': wide['Pes'], 'Talla': wide['Talla'].where(wide['Talla'] > 0)})
+        weights = keys.loc[dated & keys['Pes'].notna().to_numpy(), ['row', 'individual', 'data', 'Pes']]
+        heights = keys.loc[dated & keys['Talla'].notna().to_numpy(), ['individual', 'data', 'Talla']]
+
+        matched = pd.merge_asof(weights.sort_values('data', kind='stable'), heights.sort_values('data', kind='stable'),
+                                on='data', by='individual', direction='nearest', tolerance=pd.Timedelta(days=tolerance))
+        bmi = np.full(len(wide), np.nan)
+        bmi[matched['row'].to_numpy()] = (matched['Pes'] / (matched['Talla'] / 100) ** 2).round(2).to_numpy()
+
+        return bmi
+
+    def to_wide(self, height_tolerance = None):
+        """
+        Pivot the processed (long) data to one row per individual and date, sorted by both,
+        with a column per measurement (the mean if it was measured more than once that day) and the BMI (IMC)
+        from the weight and the height nearest in time (see _bmi), if both are measured.
+        The individual id is the first column. Returns a new dataframe.
+        """
+        tolerance = self.height_tolerance if height_tolerance is None else height_tolerance
+        id_col = self.df.columns[0]
+
+        # Sort by one integer key per (individual, date), both in order (missing ones first), and number the groups
+        id_codes, _ = pd.factorize(self.df[id_col], sort=True)
+        date_codes, dates = pd.factorize(self.df['data'], sort=True)
+        key = (id_codes.astype(np.int64) + 1) * (len(dates) + 1) + (date_codes + 1)
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        new_group = np.r_[True, key[1:] != key[:-1]] if len(order) else np.zeros(0, dtype=bool)
+        group = np.cumsum(new_group) - 1
+        first = order[new_group] # First row of each group in self.df
+        groups = len(first)
+
+        wide = {id_col: self.df[id_col].to_numpy()[first], 'data': self.df['data'].to_numpy()[first]}
+        codi_codes, codis = pd.factorize(self.df['codi_prova'])
+        codi_codes = codi_codes[order]
+        values = pd.to_numeric(self.df['resultat'], errors='coerce').to_numpy(dtype=float, na_value=np.nan)[order]
+        for codi, name in self.codis.items():
+            measured = codi_codes == (codis.get_loc(codi) if codi in codis else -2)
+            counts = np.bincount(group[measured], minlength=groups)
+            sums = np.bincount(group[measured], weights=values[measured], minlength=groups)
+            wide[name] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        wide = pd.DataFrame(wide)
+
+        if {'Talla', 'Pes'}.issubset(wide.columns):
+            wide['IMC'] = self._bmi(wide, id_codes[first], tolerance)
+
+        self.df = wide
+        return self.df
+
+    def hold_last_individual(self, held = None):
+        """
+        For wide output of a file read in chunks and sorted by individual id (see check_sorted_ids): add the rows held from
+        the previous chunk and hold back the rows of the last individual, which may continue in the next chunk. Returns the rows held.
+        """
+        if held is not None and len(held):
+            self.df = pd.concat([held, self.df], ignore_index=True)
+        ids = self.df[self.df.columns[0]]
+        if ids.empty:
+            return held
+
+        last = (ids == ids.iloc[-1]).fillna(False).to_numpy() if pd.notna(ids.iloc[-1]) else ids.isna().to_numpy()
+        held = self.df[last]
+        self.df = self.df[~last]
+        return held
+
     def process(self):
         """Run full processing pipeline for Measures data."""
         self._check_if_mesures()
-        self.df = self.unify_missing()
-        self.df = self.cast_columns()
-        self.df = self._filter_by_codes()
-        self.df = self._apply_range_filter()
-        self.df = self._add_unit(unitats)
+        self._run_step('unify_missing', self.unify_missing)
+        self._run_step('cast_columns', self.cast_columns)
+        self._run_step('filter_by_codes', self._filter_by_codes)
+        self._run_step('apply_range_filter', self._apply_range_filter)
+        self._run_step('add_unit', self._add_unit, self.unitats)
         self.df.rename(columns={"Prova_data": "data", "Prova_resultat": "resultat", 
                                 "Prova_codi": "codi_prova", "Prova_descripcio":"prova"}, inplace=True)
 
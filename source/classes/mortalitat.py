@@ -1,11 +1,14 @@
 # Class for the mortalitat table from PADRIS
 from source.classes.common import CommonData
 import numpy as np
+from source.utils.harmonizer import LabelHarmonizer
 
 class Mortalitat(CommonData):
     """
     This class will deal with the processes related to the mortalitat table from PADRIS.
     """
+    # Raw columns needed to count the causes of death
+    label_columns = ['Causa_CIM9_codi', 'AS_Causa_CIM9', 'Causa_CIM10_codi', 'Causa_CIM10']
 
     def __init__(self, df, column_casts):
         """ Constructor for the Assegurats class. """
@@ -40,20 +43,34 @@ class Mortalitat(CommonData):
 
         return self.df
 
-    def _harmonize_diagnostics(self):
+    def count_labels(self, harmonizer = None):
+        """ Add the cause of death counts of this data to a LabelHarmonizer (first pass when reading in chunks)."""
+        if harmonizer is None:
+            harmonizer = LabelHarmonizer(['causa_defuncio_c', 'catalegcim'], 'causa_defuncio')
+        self.df = self.unify_missing()
+        self.df = self._modify_dx_columns()
+
+        return harmonizer.update(self.df)
+
+    def _harmonize_diagnostics(self, harmonizer = None):
         """Harmonize diagnostics by selecting the most frequent diagnosis for each group."""
-        # Safely get the most frequent cause for each (causa_defuncio_c, catalegcim) combination
-        most_common_causa = self.df.groupby(['causa_defuncio_c', 'catalegcim'])['causa_defuncio'].agg(lambda x: x.mode().iloc[0] if not x.mode().empty else None)
+        # Get the most frequent cause for each (causa_defuncio_c, catalegcim) combination
+        if harmonizer is None:
+            harmonizer = LabelHarmonizer(['causa_defuncio_c', 'catalegcim'], 'causa_defuncio').update(self.df)
         # Map back to the original dataframe
-        return self.df.set_index(['causa_defuncio_c', 'catalegcim']).index.map(most_common_causa.to_dict())
+        return harmonizer.apply(self.df)
 
-    def process(self):
-        """ Function to process Assegurats data."""
+    def process(self, harmonizer = None):
+        """ 
+        Function to process Mortalitat data.
+        `harmonizer` (LabelHarmonizer) can be given when the causes were counted on the whole file (chunked reading).
+        """
         self._check_if_mortalitat()
-        self.df = self.unify_missing()
-        self.df = self.cast_columns()
-        self.df = self._add_year_col('Data_defuncio')
-        self.df = self._modify_dx_columns()
-        self.df['causa_defuncio'] = self._harmonize_diagnostics()
+        self._run_step('unify_missing', self.unify_missing)
+        self._run_step('cast_columns', self.cast_columns)
+        self._run_step('add_year_col', self._add_year_col, 'Data_defuncio')
+        self._run_step('modify_dx_columns', self._modify_dx_columns)
+        with self.profile('harmonize_diagnostics'):
+            self.df['causa_defuncio'] = self._harmonize_diagnostics(harmonizer)
         self.df.rename(columns={"Data_defuncio": "data_defuncio"}, inplace=True)
         return self.df
\ No newline at end of file
@@ -1,5 +1,6 @@
 # Class for the Primaria tables from PADRIS
 from source.classes.common import CommonData
+from source.utils.outliers_primaria.functions import remove_non_coherent_cie, remove_date_outliers
 
 class Primaria(CommonData):
     """
@@ -34,12 +35,24 @@ class Primaria(CommonData):
         
         return self.df
 
-    def process(self):
-        """ Function to process Primaria data."""
+    def remove_outliers(self, cie_codes, patients):
+        """
+        Remove diagnostics with a code that is not in the CIE-9/CIE-10 references and diagnostics not possible by date
+        (see outliers_primaria). cie_codes comes from load_cie_codes and patients is the PatientIndex with the death dates.
+        """
+        self._run_step('remove_non_coherent_cie', remove_non_coherent_cie, self.df, cie_codes['cie9'], cie_codes['cie10'])
+        self._run_step('remove_date_outliers', remove_date_outliers, self.df, patients)
+
+        return self.df
+
+    def process(self, cie_codes = None, patients = None):
+        """ Function to process Primaria data. If the CIE codes and the patient index are given, the outliers are removed too."""
         self._check_if_primaria()
-        self.df = self.unify_missing()
-        self.df = self.cast_columns()
-        self.df = self._rename_columns()
-        self.df = self._correct_cim_values()
+        self._run_step('unify_missing', self.unify_missing)
+        self._run_step('cast_columns', self.cast_columns)
+        self._run_step('rename_columns', self._rename_columns)
+        self._run_step('correct_cim_values', self._correct_cim_values)
+        if patients is not None:
+            self.remove_outliers(cie_codes, patients)
 
         return self.df
\ No newline at end of file
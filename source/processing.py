@@ -6,11 +6,24 @@ from source.classes.farmacia import Farmacia
 from source.classes.primaria import Primaria
 from source.classes.mesures import Mesures
 from source.classes.mortalitat import Mortalitat
+from source.classes.lab_processing.cache import CleaningCache
+from source.classes.lab_processing.filter_lab import read_conversion_file, filter_lab_codi, match_codi_dtype, build_unit_factors
+from source.classes.lab_processing.convert import conversion_factors_dict
 from source.utils.mesures_info import *
+from source.utils.valid_entities import STREAMABLE_ENTITIES
+from source.utils.memory import MemoryTracker
+from source.utils.output import OutputWriter, report_path, profile_path
+from source.utils.dates import DateParser
+from source.utils.profiling import StepProfiler
+from source.utils.episodi_index import EpisodiIndex
+from source.utils.outliers_primaria.cie_codes import load_cie_codes
+from source.utils.patient_index import PatientIndex
 
 import pandas as pd
 import os
-import csv 
+import csv
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 def detect_separator(inpath):
     """ Read first row of the file to detect the separator"""
@@ -23,80 +36,247 @@ def detect_separator(inpath):
         else:
             raise ValueError("Separator must be '|'.")
     
-def generate_report(df, entity, report_path, preprocessing_df):
-    """ If --report is on, a report will be generated in the same outpath."""
-    def count_na(df):
-        na_counts = df.isna().sum()
-        total_rows = len(df)
+def _write_report(entity, report_path, rows_before, rows_after, na_before, na_after, dtypes, memory_steps = None, date_failures = None, compaction = None, profile_steps = None, duplicates = None, out_of_range = None):
+    """
+    Write the report file from already computed row counts, missing values and data types
+    (and the memory after each step, the dates that could not be parsed, the memory saved by compaction,
+    the time, rows and memory change of each processing step, the duplicated rows removed
+    and the Mesures rows removed by the range filter, if recorded).
+    """
+    def count_na(na_counts, total_rows):
         for col, na in na_counts.items():
             pct = (na / total_rows) * 100 if total_rows else 0
             f.write(f"  - {col}: {na} ({pct:.2f}%)\n\n")
-    
+
     with open(report_path, "w", encoding="utf-8") as f:
         f.write(f"Report for entity: {entity}\n")
         f.write("-"*50 + "\n")
-        f.write(f"Rows before processing: {len(preprocessing_df)}\n")
-        f.write(f"Rows after processing: {len(df)}\n\n")
+        f.write(f"Rows before processing: {rows_before}\n")
+        f.write(f"Rows after processing: {rows_after}\n\n")
 
         f.write("Missing values per column (before processing):\n")
-        count_na(preprocessing_df)
+        count_na(na_before, rows_before)
 
         f.write("Missing values per column (after processing):\n")
-        count_na(df)
+        count_na(na_after, rows_after)
 
         f.write("\nData types:\n")  # Now works with utf-8!
-        for col, dtype in df.dtypes.items():
+        for col, dtype in dtypes.items():
             f.write(f"  - {col}: {dtype}\n")
 
-def process_dataframe(df, outpath, entity, column_casts, lab_option = None, lab_conversion = None, episodis = None, report = False):
-    """
-    Function to process a dataframe based on the entity type.
-    
-    Args:
-        inpath (str): Path to the input file.
-        outpath (str): Path to the output file.
-        entity (str): Type of entity ('Assegurats', 'Episodis', 'Diagnostics', 'Procediments', 'Mortalitat', 'Laboratori').
-        column_casts (dict): Dictionary of columns and their target data types.
-        episodis (str): Path to episodis file whn option is Diagnostics or Procediments.
-        lab_option (str): Used only if entity == 'Laboratori'. If set to 'filter', applies filtering before processing.
-        lab_conversion (str): Used only if entity == 'Laboratori'. If set to 'filter' add path to conversion file.
-    """
-    # In case of Diagnostics or Procediments, check if episodis exist.
-    if entity in ['Diagnostics', 'Procediments'] and episodis is None:
-        raise ValueError(f"Entity '{entity}' requires an episodis file.")
-    elif entity in ['Diagnostics', 'Procediments'] and not os.path.exists(episodis):
-        raise ValueError(f'The episodis file does not exist.')
+        if memory_steps:
+            f.write("\nMemory (RSS) after each step (the highest if it ran several times):\n")
+            for step, peak in memory_steps.items():
+                f.write(f"  - {step}: {peak / 1024**2:.1f} MB\n")
 
-    # Process the dataframe based on the entity type
+        if duplicates:
+            key, removed = duplicates
+            f.write(f"\nDuplicated rows removed (same {', '.join(key)}): {removed}\n")
+
+        if out_of_range:
+            f.write("\nRows removed by the range filter per code (out of range, without a numeric value):\n")
+            for codi, (out, missing) in sorted(out_of_range.items()):
+                f.write(f"  - {codi}: {out}, {missing}\n")
+
+        if date_failures:
+            f.write("\nDates that could not be parsed (set to missing):\n")
+            for col, failed in date_failures.items():
+                f.write(f"  - {col}: {failed}\n")
+
+        if compaction:
+            before, after = compaction
+            f.write(f"\nMemory of compacted columns (categories and smaller integers): {before / 1024**2:.1f} MB -> {after / 1024**2:.1f} MB "
+                    f"(saved {(before - after) / 1024**2:.1f} MB)\n")
+
+        if profile_steps:
+            f.write("\nProcessing steps (time, rows in -> rows out, memory change):\n")
+            for step, stats in profile_steps.items():
+                memory_delta = f", {stats['memory_delta'] / 1024**2:+.1f} MB" if stats['memory_delta'] is not None else ""
+                f.write(f"  - {step}: {stats['seconds']:.2f} s, {stats['rows_in']} -> {stats['rows_out']} rows{memory_delta}\n")
+
+def generate_report(df, entity, report_path, preprocessing_df, memory_steps = None, date_failures = None, compaction = None, profile_steps = None, duplicates = None, out_of_range = None):
+    """ If --report is on, a report will be generated in the same outpath."""
+    _write_report(entity, report_path, len(preprocessing_df), len(df),
+                  preprocessing_df.isna().sum(), df.isna().sum(), df.dtypes, memory_steps, date_failures, compaction, profile_steps, duplicates, out_of_range)
+
+def build_processor(df, entity, column_casts, lab_option = None, episodis = None, memory = None, range_table = None):
+    """ Return the data processor for the entity type."""
     if entity == 'Assegurats':
         data_processor = Assegurats(df, column_casts['Assegurats'])
-    if entity == 'Mortalitat':
+    elif entity == 'Mortalitat':
         data_processor = Mortalitat(df, column_casts['Mortalitat'])
     elif entity == 'Episodis':
         data_processor = Episodis(df, column_casts['Episodis'])
-    elif entity == 'Diagnostics':
-        # Read the header to identify the id column.
-        cols = pd.read_csv(episodis, sep="|", nrows=0).columns
-        id_col = cols[0]
-        episodis_small= pd.read_csv(episodis, sep = "|", usecols = [id_col, 'episodi_id', 'any_referencia'])
-        data_processor = DiagnosticsProcediments(df, column_casts['Diagnostics'], entity, episodis_small)
-    elif entity == 'Procediments':
-        # Read the header to identify the id column.
-        cols = pd.read_csv(episodis, sep="|", nrows=0).columns
-        id_col = cols[0]
-        episodis_small= pd.read_csv(episodis, sep = "|", usecols = [id_col, 'episodi_id', 'any_referencia'])
-        data_processor = DiagnosticsProcediments(df, column_casts['Procediments'], entity, episodis_small)
+    elif entity in ['Diagnostics', 'Procediments']:
+        # Individual id and year of each episode, built once from the Episodis file and reused while it does not change
+        index = episodis if isinstance(episodis, EpisodiIndex) else EpisodiIndex.load(episodis)
+        data_processor = DiagnosticsProcediments(df, column_casts[entity], entity, index)
     elif entity == 'Laboratori':
-        if lab_option == "filter":
-            data_processor = Lab(df, column_casts['Filtered_laboratori'])
+        if lab_option in ["filter", "clean_filter"]:
+            data_processor = Lab(df, column_casts['Filtered_laboratori'], memory)
         else:
-            data_processor = Lab(df, column_casts['Laboratori'])
+            data_processor = Lab(df, column_casts['Laboratori'], memory)
     elif entity == 'Farmacia':
         data_processor = Farmacia(df, column_casts['Farmacia'])
     elif entity == 'Primaria':
         data_processor = Primaria(df, column_casts['Primaria'])
     elif entity == 'Mesures':
-       data_processor = Mesures(df, column_casts['Mesures'], ranges, codi_mesures)
+        # Codes, ranges and units of a user table (see read_range_table) or of mesures_info
+        if isinstance(range_table, str):
+            range_table = read_range_table(range_table)
+        if range_table is not None:
+            table_codis, table_ranges, table_unitats = range_table
+            data_processor = Mesures(df, column_casts['Mesures'], table_ranges, table_codis, table_unitats)
+        else:
+            data_processor = Mesures(df, column_casts['Mesures'], ranges, codi_mesures)
+
+    return data_processor
+
+def _check_episodis(entity, episodis):
+    """ In case of Diagnostics or Procediments, check if episodis exist."""
+    if entity in ['Diagnostics', 'Procediments'] and episodis is None:
+        raise ValueError(f"Entity '{entity}' requires an episodis file.")
+    elif entity in ['Diagnostics', 'Procediments'] and not isinstance(episodis, EpisodiIndex) and not os.path.exists(episodis):
+        raise ValueError(f'The episodis file does not exist.')
+
+def _load_outliers(entity, remove_outliers):
+    """ For Primaria with --remove-outliers, load the CIE reference codes and the patient index with the death dates once: (cie_codes, patients)."""
+    if entity != 'Primaria' or remove_outliers is None:
+        return None, None
+
+    return load_cie_codes(), PatientIndex.load(mortalitat=remove_outliers)
+
+def patient_id_columns(entity, columns, episodis = None):
+    """
+    Individual id columns of the processed output of an entity whose input file has `columns`: the first column, or for
+    Diagnostics and Procediments the id of the Episodis file (`episodis` is its EpisodiIndex): `<id>_x` from the episode
+    and `<id>_y` from the data. Raises a ValueError if the output has no individual id: Diagnostics and Procediments
+    without the id column in the data drop the id of the episode (see DiagnosticsProcediments._fix_inconsistencies).
+    """
+    if entity in ['Diagnostics', 'Procediments']:
+        if episodis.id_col not in columns:
+            raise ValueError(f"⚠️ The {entity} file has no individual id column ('{episodis.id_col}'): its output has no individual id to look up in the patient index.")
+        return [f"{episodis.id_col}_x", f"{episodis.id_col}_y"]
+
+    return [columns[0]]
+
+def to_surrogate_ids(df, patients, id_cols):
+    """
+    Replace the individual id columns (see patient_id_columns) with their int32 surrogate in the patient index (missing if it is not there).
+    Returns the new dataframe and the number of ids that are not in the index.
+    """
+    unknown = 0
+    df = df.copy(deep=False)
+    for col in id_cols:
+        ids = df[col]
+        surrogates = patients.surrogates(ids)
+        unknown += int(((surrogates < 0) & ids.notna().to_numpy()).sum())
+        df[col] = pd.arrays.IntegerArray(np.maximum(surrogates, 0), mask=surrogates < 0)
+
+    return df, unknown
+
+def add_patient_attributes(df, patients, id_col):
+    """
+    Add the attributes of the patient index (see PATIENT_ATTRIBUTES) of the individual of each row, gathered by its surrogate
+    instead of merging the Assegurats file. Columns already in the data are kept. Rows whose id is not in the index get missing values.
+    """
+    surrogates = patients.surrogates(df[id_col])
+    df = df.copy(deep=False)
+    for name in patients.attributes:
+        if name not in df.columns:
+            df[name] = patients.attribute(name, surrogates)
+
+    return df
+
+def _warn_unknown_ids(unknown):
+    """ Warn about the individual ids that are not in the patient index."""
+    if unknown:
+        print(f"Warning: {unknown} individual ids are not in the patient index: they are missing in the output.")
+
+def entity_columns(inpath, sep, entity, lab_option = None):
+    """ 
+    Columns of the input file used by the entity, or None to read them all.
+    Only Laboratori (raw data) has a fixed output: the other entities keep every input column.
+    """
+    if entity == 'Laboratori' and lab_option != 'filter':
+        header = pd.read_csv(inpath, sep=sep, nrows=0).columns
+        return [col for col in header if col == header[0] or col in Lab.raw_columns] # The id column is the first one
+
+    return None
+
+def read_entity(inpath, sep, entity, lab_option = None, engine = None):
+    """ 
+    Read the input file of an entity with only the columns it uses (see entity_columns).
+    The data types are cast after reading, by cast_columns. `engine` can be set to 'pyarrow' to parse the file with several threads.
+    """
+    options = {'sep': sep, 'usecols': entity_columns(inpath, sep, entity, lab_option)}
+    if engine:
+        options['engine'] = engine
+    else:
+        options['low_memory'] = False
+
+    return pd.read_csv(inpath, **options)
+
+def read_lab_tests(inpath, sep, conversion, chunksize = 1000000):
+    """ 
+    Read raw lab data keeping only the tests (lab_prova_c) in the conversion dataframe.
+    The file is read in chunks and filtered at read time, so memory depends on the rows kept.
+    Every chunk is read with the data types of the whole file (see infer_dtypes), as the raw data read at once.
+    """
+    kept = []
+    usecols = entity_columns(inpath, sep, 'Laboratori', 'clean_filter')
+    dtypes = infer_dtypes(inpath, sep, chunksize, usecols)
+    with pd.read_csv(inpath, sep=sep, chunksize=chunksize, dtype=dtypes, usecols=usecols) as reader:
+        for chunk in reader:
+            kept.append(filter_lab_codi(chunk, match_codi_dtype(conversion, chunk['lab_prova_c']), 'lab_prova_c'))
+
+    return pd.concat(kept, ignore_index=True)
+
+def _open_lab_cache(entity, lab_option, lab_cache):
+    """ Open the CleaningCache if it was requested and raw lab data is going to be cleaned."""
+    if entity == 'Laboratori' and lab_cache and lab_option != 'filter':
+        return CleaningCache(lab_cache)
+    return None
+
+def process_dataframe(df, outpath, entity, column_casts, lab_option = None, lab_conversion = None, episodis = None, report = False, workers = None, lab_cache = None, memory_budget = None, compression = None, partition_by_year = False, range_table = None, wide = False, height_tolerance = None, remove_outliers = None, surrogate_ids = None, patient_attributes = None):
+    """
+    Function to process a dataframe based on the entity type.
+    
+    Args:
+        inpath (str): Path to the input file.
+        outpath (str): Path to the output file.
+        entity (str): Type of entity ('Assegurats', 'Episodis', 'Diagnostics', 'Procediments', 'Mortalitat', 'Laboratori').
+        column_casts (dict): Dictionary of columns and their target data types.
+        episodis (str | EpisodiIndex): Path to episodis file whn option is Diagnostics or Procediments (or its index already loaded).
+        lab_option (str): Used only if entity == 'Laboratori'. If set to 'filter', filters and converts already processed data.
+                          If set to 'clean_filter', filters raw data with the conversion file and then processes and converts it.
+        lab_conversion (str | pd.DataFrame): Used only if entity == 'Laboratori'. With 'filter' or 'clean_filter', path to the conversion file (or the file already read).
+        workers (int): Used only if entity == 'Laboratori'. Number of processes used to clean the lab data.
+        lab_cache (str): Used only if entity == 'Laboratori'. Path to the SQLite file that caches the cleaning of results and units between runs.
+        memory_budget (int): Used only if entity == 'Laboratori'. Maximum memory of the process in bytes; the processing stops if it would be exceeded.
+        compression (str): Compression codec of Parquet or Feather output (see OutputWriter).
+        partition_by_year (bool): Partition Parquet or Feather output by the year column.
+        range_table (str | tuple): Used only if entity == 'Mesures'. Path to a CSV or JSON table of codes and valid ranges (or the table already read).
+        wide (bool): Used only if entity == 'Mesures'. Write one row per individual and date with the BMI (see Mesures.to_wide).
+        height_tolerance (int): Used only with `wide`. Maximum days between a weight and the height used for its BMI.
+        remove_outliers (str): Used only if entity == 'Primaria'. Path to the processed Mortalitat file: remove the diagnostics
+                               with codes not in the CIE references or not possible by date (see outliers_primaria).
+        surrogate_ids (str): Path to a processed Assegurats file: write the individual id as its int32 surrogate in the patient index built from it.
+        patient_attributes (str): Path to a processed Assegurats file: add the attributes of each individual from the patient index built from it
+                                  (see add_patient_attributes). For Diagnostics and Procediments, those of the individual of the episode.
+    """
+    _check_episodis(entity, episodis)
+    cie_codes, patients = _load_outliers(entity, remove_outliers)
+    id_index = PatientIndex.load(assegurats=surrogate_ids) if surrogate_ids is not None else None
+    attribute_index = PatientIndex.load(assegurats=patient_attributes) if patient_attributes is not None else None
+    cache = _open_lab_cache(entity, lab_option, lab_cache)
+    memory = MemoryTracker(memory_budget)
+    writer = OutputWriter(outpath, compression, partition_by_year) # Check the output options before processing
+
+    # Process the dataframe based on the entity type
+    data_processor = build_processor(df, entity, column_casts, lab_option, episodis, memory, range_table)
+    if id_index is not None or attribute_index is not None:
+        id_cols = patient_id_columns(entity, df.columns, getattr(data_processor, 'episodis', None)) # Before processing
 
     # Check table before processing
     preprocessing_df = data_processor.df
@@ -104,11 +284,299 @@ def process_dataframe(df, outpath, entity, column_casts, lab_option = None, lab_
     # Process the dataframe and save it to the output path
     if entity == 'Laboratori' and lab_option == 'filter':
         processed_df = data_processor.filter_lab(lab_conversion)
+    elif entity == 'Laboratori' and workers:
+        processed_df = data_processor.process_in_parallel(workers, lab_conversion if lab_option == 'clean_filter' else None, cache=cache)
+    elif entity == 'Laboratori' and lab_option == 'clean_filter':
+        processed_df = data_processor.process_and_filter(lab_conversion, cache=cache)
+    elif entity == 'Laboratori':
+        processed_df = data_processor.process(cache=cache)
+    elif entity == 'Primaria' and patients is not None:
+        processed_df = data_processor.process(cie_codes, patients)
     else:
         processed_df = data_processor.process()
 
-    if report: # If report option is true, print report file.
-        report_path = outpath.replace(".csv", "_report.txt")
-        generate_report(processed_df, entity, report_path, preprocessing_df)
+    if entity == 'Mesures' and wide:
+        processed_df = data_processor._run_step('to_wide', data_processor.to_wide, height_tolerance)
+
+    if attribute_index is not None:
+        data_processor.df = processed_df
+        with data_processor.profile('patient_attributes'):
+            processed_df = add_patient_attributes(processed_df, attribute_index, id_cols[0])
+
+    if id_index is not None:
+        data_processor.df = processed_df
+        with data_processor.profile('surrogate_ids'):
+            processed_df, unknown = to_surrogate_ids(processed_df, id_index, id_cols)
+        _warn_unknown_ids(unknown)
+
+    # Compact the processed data (categories and smaller integers) before the report and the output
+    data_processor.df = processed_df
+    with data_processor.profile('compact'):
+        processed_df = data_processor.compact()
+
+    # Save the processed dataframe (CSV, Parquet or Feather depending on the extension)
+    with data_processor.profile('write_output'):
+        writer.write(processed_df)
+        writer.close()
+
+    if report: # If report option is true, print report file and the processing steps as JSON.
+        generate_report(processed_df, entity, report_path(outpath), preprocessing_df, memory.steps, data_processor.dates.failures,
+                        data_processor.compaction, data_processor.profiler.steps, data_processor.duplicates,
+                        getattr(data_processor, 'out_of_range', None))
+        data_processor.profiler.write_json(profile_path(outpath), entity)
+
+def _combine_dtypes(first, second):
+    """ Data type pandas gives to a column read at once whose parts were read as `first` and `second`."""
+    if first == second:
+        return first
+    if first.kind in 'iuf' and second.kind in 'iuf':
+        return np.dtype('float64') # Integers with missing values (an all-missing part is float) or floats
+    return np.dtype(object)
+
+def infer_dtypes(inpath, sep, chunksize, usecols = None):
+    """ 
+    Data types of the columns of a file as if it were read at once (integer, float, bool or text), reading it in chunks.
+    Chunks read with these types hold the same values as the whole file read at once: e.g. a column with only
+    integers is not written as '70.0' in a chunk and '70' in the whole file, nor the other way around.
+    Returns the dtype argument of read_csv (text columns as str).
+    """
+    dtypes = {}
+    with pd.read_csv(inpath, sep=sep, chunksize=chunksize, usecols=usecols, low_memory=False) as reader:
+        for chunk in reader:
+            for col, dtype in chunk.dtypes.items():
+                dtypes[col] = _combine_dtypes(dtypes[col], dtype) if col in dtypes else dtype
+
+    return {col: str if dtype == object else dtype for col, dtype in dtypes.items()}
+
+def check_sorted_ids(inpath, sep, chunksize, dtypes):
+    """ 
+    Raise a ValueError if the individual ids (first column) of the file are not sorted, reading only that column in chunks
+    with its data type of the whole file (see infer_dtypes): numbers are compared as numbers, as in a one-pass run. Missing ids are ignored.
+    """
+    id_col = pd.read_csv(inpath, sep=sep, nrows=0).columns[0]
+    last = None # Last id of the previous chunk
+    with pd.read_csv(inpath, sep=sep, chunksize=chunksize, usecols=[id_col], dtype={id_col: dtypes.get(id_col, str)}) as reader:
+        for chunk in reader:
+            ids = chunk[id_col].dropna()
+            if ids.empty:
+                continue
+            if not ids.is_monotonic_increasing or (last is not None and ids.iloc[0] < last):
+                raise ValueError("⚠️ Wide output in chunks requires the input file sorted by the individual id (first column).")
+            last = ids.iloc[-1]
+
+def count_labels_in_chunks(inpath, sep, entity, column_casts, chunksize, conversion = None, dtypes = None):
+    """ 
+    Count the labels to harmonize over the whole file, reading only the label columns in chunks.
+    For Laboratori, if the conversion dataframe is given only its tests are counted.
+    `dtypes` are the data types the file is read with (see infer_dtypes), so the codes are counted as they are processed.
+    """
+    harmonizer = None
+    processor_class = Lab if entity == 'Laboratori' else Mortalitat
+    label_dtypes = {col: (dtypes or {}).get(col, str) for col in processor_class.label_columns}
+    with pd.read_csv(inpath, sep=sep, chunksize=chunksize, dtype=label_dtypes, usecols=processor_class.label_columns) as reader:
+        for chunk in reader:
+            if conversion is not None:
+                chunk = filter_lab_codi(chunk, match_codi_dtype(conversion, chunk['lab_prova_c']), 'lab_prova_c')
+            harmonizer = build_processor(chunk, entity, column_casts).count_labels(harmonizer)
+
+    return harmonizer
+
+def process_in_chunks(inpath, outpath, entity, column_casts, chunksize, lab_option = None, lab_conversion = None, report = False, workers = None, lab_cache = None, memory_budget = None, compression = None, partition_by_year = False, range_table = None, wide = False, height_tolerance = None, remove_outliers = None, surrogate_ids = None, patient_attributes = None):
+    """
+    Stream the input file in chunks of `chunksize` rows and append each processed chunk to the output file.
+    Only entities whose processing looks at one row at a time can be streamed.
+    A first pass finds the data types of the whole file (see infer_dtypes), so the chunks hold the same values as a one-pass read.
+    Columns whose type depends on the processed values of the chunk can still differ: e.g. the any_referencia of Episodis,
+    taken from data_alta, is written as a float (2016.0) only by the chunks with a missing data_alta.
+    The chunks are not compacted (see CommonData.compact): each chunk could choose smaller types than a later chunk needs,
+    so Parquet and Feather output keeps text as strings and integers as Int64.
+
+    Args:
+        inpath (str): Path to the input file.
+        outpath (str): Path to the output file.
+        entity (str): Type of entity (see STREAMABLE_ENTITIES).
+        column_casts (dict): Dictionary of columns and their target data types.
+        chunksize (int): Number of rows read and processed at once.
+        lab_option (str): Used only if entity == 'Laboratori'. 'filter' or 'clean_filter' (see process_dataframe).
+        lab_conversion (str): Used only if entity == 'Laboratori'. With 'filter' or 'clean_filter', path to the conversion file.
+        workers (int): Used only if entity == 'Laboratori'. Number of processes used to clean each chunk.
+        lab_cache (str): Used only if entity == 'Laboratori'. Path to the SQLite file that caches the cleaning of results and units between runs.
+        memory_budget (int): Used only if entity == 'Laboratori'. Maximum memory of the process in bytes; the processing stops if it would be exceeded.
+        compression (str): Compression codec of Parquet or Feather output (see OutputWriter).
+        partition_by_year (bool): Partition Parquet or Feather output by the year column.
+        range_table (str | tuple): Used only if entity == 'Mesures'. Path to a CSV or JSON table of codes and valid ranges (or the table already read).
+        wide (bool): Used only if entity == 'Mesures'. Write one row per individual and date with the BMI (see Mesures.to_wide).
+                     The input file must be sorted by the individual id (checked before processing, see check_sorted_ids):
+                     the rows of the last individual of a chunk are pivoted with the next one.
+        height_tolerance (int): Used only with `wide`. Maximum days between a weight and the height used for its BMI.
+        remove_outliers (str): Used only if entity == 'Primaria'. Path to the processed Mortalitat file (see process_dataframe).
+                               The CIE codes and death dates are loaded once and the outliers are removed from each chunk.
+        surrogate_ids (str): Path to a processed Assegurats file: write the individual id as its int32 surrogate (see process_dataframe).
+        patient_attributes (str): Path to a processed Assegurats file: add the attributes of each individual (see process_dataframe).
+    """
+    if entity not in STREAMABLE_ENTITIES:
+        raise ValueError(f"Entity '{entity}' needs the whole table to be processed and cannot be read in chunks.")
+
+    sep = detect_separator(inpath)
+    usecols = entity_columns(inpath, sep, entity, lab_option)
+    dtypes = infer_dtypes(inpath, sep, chunksize, usecols) # First pass: same data types in every chunk as in the whole file
+    if entity == 'Mesures' and wide:
+        check_sorted_ids(inpath, sep, chunksize, dtypes) # Before anything is written
+
+    # Label harmonization (most frequent label per code) is the only step that needs the whole file:
+    # the labels are counted in a first pass over the label columns.
+    harmonizer = None
+    conversion, unit_factors = None, None
+    if entity == 'Laboratori' and lab_option in ['filter', 'clean_filter']:
+        conversion = read_conversion_file(lab_conversion)
+        unit_factors = build_unit_factors(conversion, conversion_factors_dict) # Built once: each chunk only gathers its factors
+    if entity == 'Mortalitat' or (entity == 'Laboratori' and lab_option != 'filter'):
+        harmonizer = count_labels_in_chunks(inpath, sep, entity, column_casts, chunksize, conversion, dtypes)
+    cache = _open_lab_cache(entity, lab_option, lab_cache)
+    cie_codes, patients = _load_outliers(entity, remove_outliers)
+    id_index = PatientIndex.load(assegurats=surrogate_ids) if surrogate_ids is not None else None
+    attribute_index = PatientIndex.load(assegurats=patient_attributes) if patient_attributes is not None else None
+    id_cols = patient_id_columns(entity, pd.read_csv(inpath, sep=sep, nrows=0).columns)
+    unknown_ids = 0
+    memory = MemoryTracker(memory_budget) # Shared by all chunks: keeps the highest memory of each step
+    writer = OutputWriter(outpath, compression, partition_by_year)
+    dates = DateParser() # Shared by all chunks: same date format for the whole file and failures counted over it
+    profiler = StepProfiler() # Shared by all chunks: time and rows of each step added over the whole file
+    out_of_range = {} # Shared by all chunks: Mesures rows removed by the range filter per code
+    if isinstance(range_table, str):
+        range_table = read_range_table(range_table)
+
+    rows_before, rows_after = 0, 0
+    na_before, na_after, out_dtypes = None, None, None
+    held = None # Wide Mesures: rows of the last individual of the previous chunk
+
+    # Read every chunk with the data types of the whole file, so that all chunks share them and write the same values as one pass.
+    with pd.read_csv(inpath, sep=sep, chunksize=chunksize, dtype=dtypes, usecols=usecols) as reader:
+        for chunk in reader:
+            if report:
+                rows_before += len(chunk)
+                na_before = chunk.isna().sum() if na_before is None else na_before.add(chunk.isna().sum(), fill_value=0)
+
+            data_processor = build_processor(chunk, entity, column_casts, lab_option, memory=memory, range_table=range_table)
+            data_processor.dates = dates
+            data_processor.profiler = profiler
+            if entity == 'Mesures':
+                data_processor.out_of_range = out_of_range
+            if entity == 'Laboratori' and lab_option == 'filter':
+                processed_df = data_processor.filter_lab(conversion, unit_factors)
+            elif entity == 'Laboratori' and workers:
+                processed_df = data_processor.process_in_parallel(workers, conversion, harmonizer, cache, unit_factors)
+            elif entity == 'Laboratori' and lab_option == 'clean_filter':
+                processed_df = data_processor.process_and_filter(conversion, harmonizer, cache, unit_factors)
+            elif entity == 'Laboratori':
+                processed_df = data_processor.process(harmonizer, cache)
+            elif harmonizer is not None:
+                processed_df = data_processor.process(harmonizer)
+            elif entity == 'Primaria' and patients is not None:
+                processed_df = data_processor.process(cie_codes, patients)
+            else:
+                processed_df = data_processor.process()
+
+            if entity == 'Mesures' and wide:
+                held = data_processor.hold_last_individual(held)
+                processed_df = data_processor._run_step('to_wide', data_processor.to_wide, height_tolerance)
+
+            if attribute_index is not None:
+                data_processor.df = processed_df
+                with data_processor.profile('patient_attributes'):
+                    processed_df = add_patient_attributes(processed_df, attribute_index, id_cols[0])
+
+            if id_index is not None:
+                data_processor.df = processed_df
+                with data_processor.profile('surrogate_ids'):
+                    processed_df, unknown = to_surrogate_ids(processed_df, id_index, id_cols)
+                unknown_ids += unknown
+
+            with data_processor.profile('write_output'):
+                writer.write(processed_df)
+
+            if report:
+                rows_after += len(processed_df)
+                na_after = processed_df.isna().sum() if na_after is None else na_after.add(processed_df.isna().sum(), fill_value=0)
+                out_dtypes = processed_df.dtypes
+
+    if held is not None and len(held): # Rows of the last individual of the file
+        data_processor.df = held
+        processed_df = data_processor._run_step('to_wide', data_processor.to_wide, height_tolerance)
+        if attribute_index is not None:
+            processed_df = add_patient_attributes(processed_df, attribute_index, id_cols[0])
+        if id_index is not None:
+            processed_df, unknown = to_surrogate_ids(processed_df, id_index, id_cols)
+            unknown_ids += unknown
+        with data_processor.profile('write_output'):
+            writer.write(processed_df)
+        if report:
+            rows_after += len(processed_df)
+            na_after = na_after.add(processed_df.isna().sum(), fill_value=0)
+    writer.close()
+    _warn_unknown_ids(unknown_ids)
+
+    if report and out_dtypes is not None: # If report option is true, print report file and the processing steps as JSON.
+        _write_report(entity, report_path(outpath), rows_before, rows_after, na_before.astype(int), na_after.astype(int), out_dtypes,
+                      memory.steps, dates.failures, profile_steps=profiler.steps, out_of_range=out_of_range)
+        profiler.write_json(profile_path(outpath), entity)
+
+def cmbd_outputs(outpath):
+    """ Output paths of a CMBD run: <outpath>_diagnostics and <outpath>_procediments, with the extension of outpath."""
+    base, extension = os.path.splitext(outpath)
+    return {entity: f"{base}_{entity.lower()}{extension}" for entity in ['Diagnostics', 'Procediments']}
+
+def _process_cmbd_file(inpath, outpath, entity, column_casts, index, engine = None, options = None):
+    """ Read and process one CMBD file (Diagnostics or Procediments) with the episodi index already loaded."""
+    print(f"Processing {entity}...")
+    df = read_entity(inpath, detect_separator(inpath), entity, engine=engine)
+    process_dataframe(df, outpath, entity, column_casts, episodis=index, **(options or {}))
+
+    return outpath
+
+def process_cmbd(diagnostics, procediments, episodis, outpath, column_casts, report = False, workers = None, engine = None, compression = None, partition_by_year = False, surrogate_ids = None, patient_attributes = None):
+    """
+    Process the Diagnostics and Procediments files of the same delivery in one run.
+    The episodi index is loaded (or built) once and the two files are processed at the same time, in two processes.
+
+    Args:
+        diagnostics (str): Path to the Diagnostics file.
+        procediments (str): Path to the Procediments file.
+        episodis (str): Path to the raw Episodis file.
+        outpath (str): Base path of the outputs (see cmbd_outputs).
+        column_casts (dict): Dictionary of columns and their target data types.
+        workers (int): Number of files processed at the same time: 2 (default, if there are several CPUs) or 1 to process them one after the other.
+        engine (str): 'pyarrow' to parse the input files with the pyarrow engine (see read_entity).
+        compression (str): Compression codec of Parquet or Feather output (see OutputWriter).
+        partition_by_year (bool): Partition Parquet or Feather output by the year column.
+        surrogate_ids (str): Path to a processed Assegurats file: write the individual id as its int32 surrogate (see process_dataframe).
+        patient_attributes (str): Path to a processed Assegurats file: add the attributes of each individual (see process_dataframe).
+    """
+    _check_episodis('Diagnostics', episodis)
+    index = EpisodiIndex.load(episodis)
+    patient_indexes = [path for path in [surrogate_ids, patient_attributes] if path is not None]
+    if patient_indexes:
+        for entity, inpath in {'Diagnostics': diagnostics, 'Procediments': procediments}.items(): # Both files, before processing any
+            patient_id_columns(entity, pd.read_csv(inpath, sep=detect_separator(inpath), nrows=0).columns, index)
+    for path in patient_indexes:
+        PatientIndex.load(assegurats=path) # Built once here: each file memory-maps it
+    outputs = cmbd_outputs(outpath)
+    files = {'Diagnostics': diagnostics, 'Procediments': procediments}
+    options = {'report': report, 'compression': compression, 'partition_by_year': partition_by_year, 'surrogate_ids': surrogate_ids,
+               'patient_attributes': patient_attributes}
+
+    if workers is None:
+        workers = min(len(files), os.cpu_count() or 1)
+    if workers == 1:
+        for entity, inpath in files.items():
+            _process_cmbd_file(inpath, outputs[entity], entity, column_casts, index, engine, options)
+        return outputs
+
+    # The index is sent to each process as the directory of its memory-mapped arrays
+    with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+        futures = [executor.submit(_process_cmbd_file, inpath, outputs[entity], entity, column_casts, index, engine, options)
+                   for entity, inpath in files.items()]
+        for future in futures:
+            future.result()
 
-    processed_df.to_csv(outpath, index=False, sep = "|")  # Save the processed dataframe to CSV
+    return outputs
@@ -0,0 +1,60 @@
+# Functions to parse text dates once per distinct value.
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+# Text values that pd.to_datetime reads as missing and skips when it guesses the format
+SKIPPED_DATES = {'', 'NaT', 'nat', 'NAT', 'nan', 'NaN', 'NAN', 'now', 'today'}
+
+
+def first_date(values):
+    """ Return the first value that pd.to_datetime would use to guess the date format, or None."""
+    for value in values:
+        if pd.isna(value) or (isinstance(value, str) and value in SKIPPED_DATES):
+            continue
+        return value
+    return None
+
+
+class DateParser:
+    """
+    Parse date columns with pd.to_datetime one distinct value at a time and map the result back to the rows:
+    dates repeat a lot (a few thousand days over millions of rows), so most of the parsing is skipped.
+    The format of each column is detected once, from its first value, as pd.to_datetime does,
+    and reused for every chunk of the same file. The values that could not be parsed are counted per column.
+    """
+
+    def __init__(self):
+        """ Constructor for the DateParser class."""
+        self.formats = {}
+        self.failures = {}
+
+    def _format(self, col, uniques):
+        """ Return the format of a column, detecting it from the first value the first time ('mixed' if it cannot be detected)."""
+        if col not in self.formats:
+            first = first_date(uniques)
+            if first is None:
+                return None # Nothing to detect the format from yet
+            date_format = guess_datetime_format(first, dayfirst=False) if isinstance(first, str) else None
+            if date_format is None:
+                print(f"Warning: Could not detect the date format of column '{col}': each value is parsed on its own.")
+            self.formats[col] = date_format or 'mixed'
+
+        return self.formats[col]
+
+    def parse(self, col, values):
+        """ Parse a column of text dates. Values that cannot be parsed become NaT. Returns a datetime Series."""
+        if values.dtype != object and not isinstance(values.dtype, pd.CategoricalDtype):
+            return pd.to_datetime(values, errors='coerce', dayfirst=False) # Numbers or dates: nothing to cache
+
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques, dtype=object)
+        parsed = pd.to_datetime(uniques, errors='coerce', dayfirst=False, format=self._format(col, uniques))
+
+        # Count the rows with a value that is not missing but could not be parsed
+        failed = parsed.isna() & ~np.array([value in SKIPPED_DATES for value in uniques], dtype=bool)
+        if failed.any():
+            self.failures[col] = self.failures.get(col, 0) + int(failed[codes[codes >= 0]].sum())
+
+        return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=values.index, name=values.name)
@@ -0,0 +1,174 @@
+# Persistent index of the Episodis file: episodi_id -> (individual id, year).
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# Version of the index files: increase it if their layout changes
+INDEX_VERSION = 1
+
+
+def index_directory(episodis):
+    """ Directory of the index of an Episodis file (next to it)."""
+    return os.path.splitext(episodis)[0] + "_episodi_index"
+
+def _source_stamp(episodis):
+    """ Size and modification time of the Episodis file: the index is rebuilt when they change."""
+    stat = os.stat(episodis)
+    return {'version': INDEX_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class EpisodiIndex:
+    """
+    Sorted NumPy arrays of the episodi_id of the Episodis file with the individual id and year (any_referencia) of each one.
+    The arrays are saved as .npy files next to the Episodis file and memory-mapped by the next runs,
+    so Diagnostics and Procediments look up their episodes in them instead of reading Episodis and merging.
+    """
+    arrays = ['episodi_id', 'patient_code', 'year', 'patients']
+
+    def __init__(self, id_col, episodi_id, patient_code, year, patients):
+        """
+        Constructor for the EpisodiIndex class.
+
+        Args:
+            id_col (str): Name of the individual id column (first column) of the Episodis file.
+            episodi_id (np.ndarray): Sorted episodi_id (int64). Repeated ids keep their order in the file.
+            patient_code (np.ndarray): Position of the individual id of each episode in `patients` (-1 if missing).
+            year (np.ndarray): any_referencia of each episode (float64, NaN if missing).
+            patients (np.ndarray): Distinct individual ids (text).
+        """
+        self.id_col = id_col
+        self.episodi_id = episodi_id
+        self.patient_code = patient_code
+        self.year = year
+        self.patients = patients
+        self.directory = None # Directory of the saved arrays, if any
+        self._lookup = None
+
+    def __getstate__(self):
+        """ A saved index is sent to worker processes as its directory: each one memory-maps the same files."""
+        state = {**self.__dict__, '_lookup': None}
+        if self.directory is not None:
+            state.update({name: None for name in self.arrays})
+        return state
+
+    def __setstate__(self, state):
+        """ Memory-map the arrays of a saved index in the worker process."""
+        self.__dict__.update(state)
+        if self.directory is not None:
+            for name in self.arrays:
+                setattr(self, name, np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode='r'))
+
+    @classmethod
+    def build(cls, episodis):
+        """ Build the index from the Episodis file (only its id, episodi_id and any_referencia columns are read)."""
+        id_col = pd.read_csv(episodis, sep="|", nrows=0).columns[0]
+        df = pd.read_csv(episodis, sep="|", usecols=[id_col, 'episodi_id', 'any_referencia'], dtype={id_col: str})
+
+        episodi_id = pd.to_numeric(df['episodi_id'], errors='coerce')
+        valid = episodi_id.notna().to_numpy() # Rows without episodi_id cannot be looked up
+        episodi_id = episodi_id[valid].to_numpy(dtype=np.int64)
+        order = np.argsort(episodi_id, kind='stable') # Repeated ids keep their order in the file, as in a merge
+        df = df[valid].iloc[order]
+
+        patient_code, patients = pd.factorize(df[id_col])
+        return cls(id_col, episodi_id[order], patient_code.astype(np.int32),
+                   pd.to_numeric(df['any_referencia'], errors='coerce').to_numpy(dtype=np.float64),
+                   np.asarray(patients, dtype=str))
+
+    def save(self, directory, stamp):
+        """ Save the arrays as .npy files and the stamp of the Episodis file they come from."""
+        os.makedirs(directory, exist_ok=True)
+        for name in self.arrays:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f: # Written last: the index is complete
+            json.dump({**stamp, 'id_col': self.id_col}, f)
+
+    @classmethod
+    def _open(cls, directory, stamp):
+        """ Memory-map a saved index, or return None if there is none or it was built from another version of the file."""
+        try:
+            with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if any(meta.get(key) != value for key, value in stamp.items()):
+            return None
+
+        index = cls(meta['id_col'], *[np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in cls.arrays])
+        index.directory = directory
+
+        return index
+
+    @classmethod
+    def load(cls, episodis):
+        """ Return the index of an Episodis file, building and saving it if it does not exist or the file has changed."""
+        directory = index_directory(episodis)
+        stamp = _source_stamp(episodis)
+        index = cls._open(directory, stamp)
+        if index is not None:
+            return index
+
+        print("Building the episodi index...")
+        index = cls.build(episodis)
+        try:
+            if os.path.exists(os.path.join(directory, "meta.json")):
+                os.remove(os.path.join(directory, "meta.json")) # Invalid until the new arrays are saved
+            index.save(directory, stamp)
+            index.directory = directory
+        except OSError as e:
+            print(f"Warning: Could not save the episodi index in '{directory}' ({e}): it will be built again next time.")
+
+        return index
+
+    def match(self, episodi_id):
+        """
+        Match each episodi_id with its episodes, as a right merge of the Episodis file with the data on episodi_id.
+        Returns (rows, episodes): the position of the data row and of the episode of each output row, in the merge order.
+        Rows without an episode appear once, with episode -1.
+        """
+        if self._lookup is None:
+            # First position and number of episodes of each distinct episodi_id (the ids are sorted, so each one is a run)
+            ids = np.asarray(self.episodi_id)
+            first = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.zeros(0, dtype=np.intp)
+            self._lookup = (pd.Index(ids[first]), first, np.diff(np.r_[first, len(ids)]))
+        distinct, first, runs = self._lookup
+
+        # Hash lookup of the distinct ids: faster than a binary search for millions of unsorted keys
+        keys = pd.to_numeric(pd.Series(episodi_id), errors='coerce')
+        position = np.full(len(keys), -1, dtype=np.intp)
+        valid = keys.notna().to_numpy()
+        position[valid] = distinct.get_indexer(keys[valid].to_numpy(dtype=np.int64))
+        found = position >= 0
+        start = np.where(found, first[np.maximum(position, 0)] if len(first) else 0, 0)
+        matches = np.where(found, runs[np.maximum(position, 0)] if len(runs) else 0, 0)
+
+        counts = np.maximum(matches, 1) # Rows without an episode are kept (right merge)
+        rows = np.repeat(np.arange(len(valid)), counts)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        episodes = np.where(np.repeat(matches > 0, counts), np.repeat(start, counts) + offsets, -1)
+
+        return rows, episodes
+
+    @staticmethod
+    def _take(values, positions, fill):
+        """ values[positions], with `fill` where the position is -1."""
+        values = np.asarray(values)
+        if len(values) == 0:
+            return np.full(len(positions), np.nan if fill is None else fill, dtype=object if fill is None else np.float64)
+        taken = values[np.maximum(positions, 0)]
+        if fill is None:
+            taken[positions < 0] = np.nan
+            return taken
+
+        return np.where(positions >= 0, taken, fill)
+
+    def patient_ids(self, episodes):
+        """ Individual id of each episode position (NaN for -1 or a missing id)."""
+        codes = self._take(self.patient_code, episodes, -1).astype(np.int64)
+        return self._take(np.asarray(self.patients, dtype=object), codes, None) # One text object per individual, shared by the rows
+
+    def years(self, episodes):
+        """ any_referencia of each episode position (NaN for -1)."""
+        return self._take(self.year, episodes, np.nan)
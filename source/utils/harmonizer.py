@@ -0,0 +1,69 @@
+# Class to harmonize the label of a code to its most frequent label.
+
+import warnings
+import pandas as pd
+import numpy as np
+
+
+class LabelHarmonizer:
+    """
+    Keep the most frequent label for each code.
+    The (code, label) counts can be built per chunk or per worker and merged, so the
+    result does not depend on how the data was split. Ties are broken as Series.mode() does:
+    the lowest label is kept.
+    """
+
+    def __init__(self, keys, label):
+        """
+        Constructor for the LabelHarmonizer class.
+
+        Args:
+            keys (str | list): Column or columns that identify the code.
+            label (str): Column with the label to harmonize.
+        """
+        self.keys = [keys] if isinstance(keys, str) else list(keys)
+        self.label = label
+        self.counts = None
+        self._winners = None
+
+    def update(self, df):
+        """ Add the (code, label) counts of a dataframe or chunk. Rows with a missing code or label are not counted."""
+        counts = df.groupby(self.keys + [self.label], observed=True).size()
+        return self.merge(counts)
+
+    def merge(self, other):
+        """ Merge the counts of another LabelHarmonizer (or a counts series) into this one."""
+        counts = other.counts if isinstance(other, LabelHarmonizer) else other
+        if counts is not None:
+            with warnings.catch_warnings(): # Codes of mixed types (e.g. CIM9 numbers and CIM10 text) cannot be sorted: they are kept unsorted
+                warnings.filterwarnings("ignore", message=".*unorderable.*", category=RuntimeWarning)
+                self.counts = counts if self.counts is None else self.counts.add(counts, fill_value=0)
+            self._winners = None
+        return self
+
+    def winners(self):
+        """ Return a series with the most frequent label indexed by code."""
+        if self._winners is None:
+            if self.counts is None or self.counts.empty:
+                self._winners = pd.Series(dtype=object)
+            else:
+                counts = self.counts.rename('n').reset_index()
+                counts = counts.sort_values(self.keys + ['n', self.label], ascending=[True] * len(self.keys) + [False, True])
+                self._winners = counts.drop_duplicates(self.keys).set_index(self.keys)[self.label]
+        return self._winners
+
+    def apply(self, df):
+        """ Return the most frequent label for the code of each row of df (NaN if the code has no label)."""
+        winners = self.winners()
+        if winners.empty:
+            return pd.Series(np.nan, index=df.index, dtype=object)
+
+        if len(self.keys) == 1:
+            codes = pd.Index(df[self.keys[0]])
+        else:
+            codes = pd.MultiIndex.from_frame(df[self.keys])
+        positions = winners.index.get_indexer(codes)
+        labels = winners.to_numpy(dtype=object)[positions]
+        labels[positions < 0] = np.nan
+
+        return pd.Series(labels, index=df.index, dtype=object)
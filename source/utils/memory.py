@@ -0,0 +1,52 @@
+# Functions to follow and limit the memory used while processing.
+
+import pandas as pd
+
+try:
+    import psutil # Optional: current memory of the process
+except ImportError:
+    psutil = None
+
+
+def current_rss():
+    """ Memory used by the process now (resident set size) in bytes, or None if psutil is not installed."""
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+def select_columns(df, columns):
+    """ Select (and order) the columns of a dataframe without copying the data."""
+    return pd.DataFrame({col: df[col] for col in columns}, index=df.index, copy=False)
+
+
+class MemoryTracker:
+    """
+    Record the memory (RSS) of the process after each processing step and stop the
+    processing with a clear message as soon as it goes, or would go, over the memory budget.
+    The memory is measured now, not as the peak of the process, so memory freed by a step is no longer counted.
+    When the same steps run several times (chunks) the highest value of each step is kept.
+    """
+
+    def __init__(self, budget = None):
+        """
+        Constructor for the MemoryTracker class.
+
+        Args:
+            budget (int): Maximum memory of the process in bytes (None for no limit). Requires psutil.
+        """
+        if budget and psutil is None:
+            raise ValueError("⚠️ --memory-budget requires psutil to measure the memory of the process (pip install psutil).")
+        self.budget = budget
+        self.steps = {}
+
+    def check(self, step, needed = 0):
+        """ Record the memory after a step. Raise a MemoryError if it, plus `needed` bytes still to allocate, is over the budget."""
+        rss = current_rss()
+        if rss is None:
+            return
+        self.steps[step] = max(self.steps.get(step, 0), rss)
+
+        if self.budget and rss + needed > self.budget:
+            needed_text = f" and about {needed / 1024**3:.2f} GB more are needed" if needed else ""
+            raise MemoryError(f"⚠️ Memory budget of {self.budget / 1024**3:.2f} GB exceeded at step '{step}': "
+                              f"the process uses {rss / 1024**3:.2f} GB{needed_text}. Use --chunksize to process the file in smaller parts.")
@@ -1,3 +1,7 @@
+import json
+import os
+import pandas as pd
+
 # Dictionary of codes used to define PAS, PAD, Talla and Pes
 
 codi_mesures= {
@@ -22,4 +26,37 @@ unitats = {
     'TT102' : 'kg', # Unit for pes
     'EK201' : 'mmHg', # Unit for PAS
     'EK202' : 'mmHg' # Unit for PAD
-}
\ No newline at end of file
+}
+
+def read_range_table(path):
+    """
+    Read a table of measurement codes and valid ranges (CSV or JSON) to use instead of the dictionaries above.
+    CSV: one row per code with the columns codi, min, max and optionally nom and unitat (separated by ',', ';' or '|').
+    JSON: {"TT101": {"nom": "Talla", "min": 110, "max": 250, "unitat": "cm"}, ...}.
+    An empty min or max leaves the range open on that side.
+    Returns the dictionaries (codis, ranges, unitats) with the same structure as codi_mesures, ranges and unitats.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path, encoding="utf-8") as f:
+            table = pd.DataFrame([{'codi': codi, **values} for codi, values in json.load(f).items()])
+    elif extension in ['.csv', '.txt']:
+        table = pd.read_csv(path, sep=None, engine='python', dtype={'codi': str, 'nom': str, 'unitat': str})
+    else:
+        raise ValueError(f"⚠️ Range table '{path}' must be a CSV or JSON file.")
+
+    missing_cols = {'codi', 'min', 'max'} - set(table.columns)
+    if missing_cols:
+        raise ValueError(f"⚠️ Range table '{path}' does not have the columns: {', '.join(sorted(missing_cols))}.")
+
+    table['min'] = pd.to_numeric(table['min'], errors='coerce').fillna(float('-inf'))
+    table['max'] = pd.to_numeric(table['max'], errors='coerce').fillna(float('inf'))
+    codis, table_ranges, table_unitats = {}, {}, {}
+    for row in table.to_dict('records'):
+        codi = str(row['codi']).strip()
+        codis[codi] = row['nom'] if pd.notna(row.get('nom')) else codi
+        table_ranges[codi] = [row['min'], row['max']]
+        if pd.notna(row.get('unitat')):
+            table_unitats[codi] = row['unitat']
+
+    return codis, table_ranges, table_unitats
@@ -0,0 +1,29 @@
+# Natural key of each entity: the columns that identify a row, used to remove duplicates.
+
+import numpy as np
+import pandas as pd
+
+NATURAL_KEYS = {
+    'Diagnostics': ['episodi_id', 'dx_posicio', 'dx_c', 'catalegcim_dx'],
+    'Procediments': ['episodi_id', 'px_posicio', 'px_c', 'catalegcim_px']
+}
+
+
+def duplicated_key(df, columns):
+    """
+    Mark the rows whose key columns repeat those of an earlier row (as df.duplicated(subset=columns)).
+    Each column is factorized to integer codes and the codes are combined into one int64 key per row,
+    so only the key columns are hashed (missing values are equal to each other). Returns a boolean array.
+    """
+    key = np.zeros(len(df), dtype=np.int64)
+    size = 1 # Number of possible key values
+    for col in columns:
+        codes, uniques = pd.factorize(df[col])
+        values = len(uniques) + 1 # Code 0 for missing values
+        if size * values >= 2**63:
+            key, distinct = pd.factorize(key) # Renumber the keys so far to fit in int64
+            size = len(distinct)
+        key = key * values + (codes + 1)
+        size *= values
+
+    return pd.Series(key, copy=False).duplicated(keep='first').to_numpy()
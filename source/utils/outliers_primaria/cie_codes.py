@@ -0,0 +1,91 @@
+# Compiled CIE-9 and CIE-10 code sets used to remove non-existing diagnostics in primaria data.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cie_reference")
+STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cie_reference_codes")
+
+# Version of the store files: increase it if their layout or the normalization of the codes changes
+STORE_VERSION = 1
+
+# Spreadsheet, sheet and code column of each reference table
+# From https://www.eciemaps.sanidad.gob.es/documentation at 09/04/2025 -> Tablas de Referencia
+CIE_SOURCES = {
+    'cie10': ("Diagnosticos_ES2024_TablaReferencia_30_06_2023.xlsx", 'ES2024 Finales', 'Código'),
+    'cie9': ("CIE9MC_9_2014_REF_20210601_2362183957514564327.xls", 'cie9mc2014', 'Tab.D')
+}
+
+
+def normalize_codes(codes):
+    """ Codes as text without dots or surrounding spaces, sorted and without repeats (NumPy array of str)."""
+    codes = pd.Series(codes, dtype=object).dropna().astype(str).str.strip().str.replace('.', '', regex=False)
+    return np.unique(codes[codes != ''].to_numpy(dtype=str))
+
+def _source_stamp(path):
+    """ Size and modification time of a reference spreadsheet (None if it does not exist): the codes are compiled again when they change."""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {'version': STORE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_cie_codes(name, reference_dir = REFERENCE_DIR):
+    """ Read the codes of a reference table ('cie9' or 'cie10') from its spreadsheet and normalize them."""
+    filename, sheet, column = CIE_SOURCES[name]
+    reference = pd.read_excel(os.path.join(reference_dir, filename), sheet_name=sheet, usecols=[column], dtype=str)
+    return normalize_codes(reference[column])
+
+def load_cie_codes(reference_dir = REFERENCE_DIR, store_dir = STORE_DIR):
+    """
+    Return the sorted code arrays {'cie9': ..., 'cie10': ...}.
+    They are read from the compiled store (.npy files in store_dir) and the spreadsheets are only parsed
+    the first time or when they change. If a spreadsheet is missing, its last compiled codes are used.
+    """
+    try:
+        with open(os.path.join(store_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+
+    codes, rebuilt = {}, False
+    for name, (filename, _, _) in CIE_SOURCES.items():
+        stamp = _source_stamp(os.path.join(reference_dir, filename))
+        stored = os.path.join(store_dir, f"{name}.npy")
+        if (stamp is None or meta.get(name) == stamp) and name in meta and os.path.exists(stored):
+            if stamp is None:
+                print(f"Warning: Reference file '{filename}' not found: using its compiled codes.")
+            codes[name] = np.load(stored)
+        elif stamp is None:
+            raise FileNotFoundError(f"⚠️ Reference file '{filename}' not found in '{reference_dir}'.")
+        else:
+            print(f"Compiling the {name.upper()} reference codes...")
+            codes[name] = read_cie_codes(name, reference_dir)
+            meta[name] = stamp
+            rebuilt = True
+
+    if rebuilt:
+        try:
+            os.makedirs(store_dir, exist_ok=True)
+            for name, values in codes.items():
+                np.save(os.path.join(store_dir, f"{name}.npy"), values)
+            with open(os.path.join(store_dir, "meta.json"), "w", encoding="utf-8") as f: # Written last: the store is complete
+                json.dump(meta, f)
+        except OSError as e:
+            print(f"Warning: Could not save the compiled codes in '{store_dir}' ({e}): they will be compiled again next time.")
+
+    return codes
+
+def in_codes(values, codes):
+    """ Whether each value is in the sorted code array: one binary search per distinct value. Returns a boolean array."""
+    positions, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques, dtype=object)
+    found = np.zeros(len(uniques) + 1, dtype=bool) # Last one for missing values (position -1)
+    text = np.array([isinstance(value, str) for value in uniques], dtype=bool)
+    if text.any() and len(codes):
+        candidates = uniques[text].astype(str)
+        index = np.minimum(np.searchsorted(codes, candidates), len(codes) - 1)
+        found[:-1][text] = codes[index] == candidates
+
+    return found[positions]
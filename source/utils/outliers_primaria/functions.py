@@ -1,73 +1,61 @@
 # Functions to remove outliers in primaria data
 import pandas as pd
 from datetime import datetime
+from source.utils.outliers_primaria.cie_codes import in_codes
+from source.utils.text import as_text
 
-def remove_non_coherent_cie(df, cie9_df, cie10_df):
-    """ Remove non-existing or non-coherent diagnostics based on CIE-10 standard codes."""
+TRUST_YEAR = 1909 # First birth year in CORDELIA - CAN BE MODIFIED
+
+def remove_non_coherent_cie(df, cie9_codes, cie10_codes):
+    """ Remove non-existing or non-coherent diagnostics based on CIE-10 standard codes (sorted code arrays, see load_cie_codes)."""
         
     # REMOVE NON-EXISTING CIM-10 AND CIM-9
-    # Step 1: Prepare the reference dataframes to be used
-    # For CIE9 dataframe
-    cie9_df.rename(columns={"Tab.D": "codi"}, inplace=True)
-    # For CIE10 dataframe
-    cie10_df.rename(columns={"Código": "codi"}, inplace=True)
-
-    # Display the first few rows to understand the structure of the dataframe
-    cie10_df['codi'] = cie10_df['codi'].str.replace('.', '', regex=False)
-    cie9_df['codi'] = cie9_df['codi'].str.replace('.', '', regex=False)
-
-    # Step 2: Prepare the DX_C column
-    df['dx_c'] = df['dx_c'].str.replace('-', '', regex=False)
+    # Step 1: Prepare the DX_C column (as text: a file or chunk with only CIE-9 codes is read as numbers)
+    df['dx_c'] = as_text(df['dx_c']).str.replace('-', '', regex=False)
 
-    # Step 3:  Update 'catalegcim' to "CIM10MC" where 'problema_salut_c' exists in CIE10 dataframe
+    # Step 2: Update 'catalegcim' to "CIM10MC" where 'problema_salut_c' exists in CIE10 codes
     df.loc[
         (df['catalegcim_dx'] == 'CIM10') & 
-        (df['dx_c'].isin(cie10_df['codi'])),
+        in_codes(df['dx_c'], cie10_codes),
         'catalegcim_dx'
     ] = 'CIM10MC'
 
-    # Step 4: Update 'catalegcim' to "CIM9MC" where 'problema_salut_c' exists in CIE9 dataframe
+    # Step 3: Update 'catalegcim' to "CIM9MC" where 'problema_salut_c' exists in CIE9 codes
     df.loc[
         (df['catalegcim_dx'] == 'CIM10') & 
-        (df['dx_c'].isin(cie9_df['codi'])),
+        in_codes(df['dx_c'], cie9_codes),
         'catalegcim_dx'
     ] = 'CIM9MC'
 
-    # Step 5: Remove all those problemes in which catalegcim != CIM10MC or CIM9MC
+    # Step 4: Remove all those problemes in which catalegcim != CIM10MC or CIM9MC
     df = df[df['catalegcim_dx'].isin(["CIM10MC", "CIM9MC"])]
 
     return df
 
-def remove_date_outliers(df, mortalitat):
-    """ Remove from primaria all those diagnostics that are not possible based on date."""
+def remove_date_outliers(df, patients):
+    """
+    Remove from primaria all those diagnostics that are not possible based on date.
+    patients is the PatientIndex with the death date of each individual: it is gathered by the id (first column) of each row.
+    """
     # REMOVE NON-COHERENT DATES
-    # Step 1: Merge the two dataframes based on 'codi_p' both mortalitat and bd_cordelia
-    merged_df = pd.merge(df, mortalitat[['codi_p', 'data_defuncio']], on='codi_p', how='left')
-
-    # Fill NaN values in 'anaix' with a default value (e.g., 1920) before comparison
-    merged_df['trust_year'] = 1909 # First birth year in CORDELIA - CAN BE MODIFIED
+    # Step 1: Gather the death date of each individual from the patient index
+    data_defuncio = pd.Series(patients.death_dates(patients.surrogates(df[df.columns[0]])), index=df.index)
 
     # Convert the date columns to datetime format
-    merged_df['data_defuncio'] = pd.to_datetime(merged_df['data_defuncio'], errors='coerce', dayfirst=False, format = "%Y-%m-%d")
-    merged_df['data_ingres'] = pd.to_datetime(merged_df['data_ingres'], errors='coerce', dayfirst=False, format = "%Y-%m-%d")
-    merged_df['data_alta'] = pd.to_datetime(merged_df['data_alta'], errors='coerce', dayfirst=False, format = "%Y-%m-%d")
+    data_ingres = pd.to_datetime(df['data_ingres'], errors='coerce', dayfirst=False, format = "%Y-%m-%d")
+    data_alta = pd.to_datetime(df['data_alta'], errors='coerce', dayfirst=False, format = "%Y-%m-%d")
 
     # Apply the first condition: data_ingres can be at most 7 days later than data_defuncio
-    condition1 = (merged_df['data_defuncio'].isna()) | (merged_df['data_ingres'] < merged_df['data_defuncio'] + pd.Timedelta(days=7))
+    condition1 = (data_defuncio.isna()) | (data_ingres < data_defuncio + pd.Timedelta(days=7))
 
-    # Apply the second condition: any_referencia >= anaix (cast anaix to int)
-    condition2 = merged_df['any_referencia'].astype(int) > merged_df['trust_year']
+    # Apply the second condition: any_referencia after the first birth year in CORDELIA (rows without year are removed)
+    condition2 = (pd.to_numeric(df['any_referencia'], errors='coerce') > TRUST_YEAR).fillna(False)
 
     # Apply the third condition: data_ingres ha de ser abans que la data_alta
-    condition3 = (merged_df['data_alta'].isna()) | (merged_df['data_ingres'] < merged_df['data_alta'])
-
-    # Filter the dataframe based on both conditions
-    filtered_df = merged_df[condition1 & condition2 & condition3].copy()
-
-    # Drop the columns 'data_defuncio' and 'anaix'
-    filtered_df = filtered_df.drop(['data_defuncio', 'trust_year'], axis=1)
+    condition3 = (data_alta.isna()) | (data_ingres < data_alta)
 
-    return filtered_df
+    # Filter the dataframe based on all conditions
+    return df[condition1 & condition2 & condition3]
 
 def generate_report(df, entity, report_path, preprocessing_df):
     """ If --report is on, a report will be generated in the same outpath."""
@@ -1,6 +1,10 @@
 # Main function to use to remove date and diagnostic outliers in Primaria - PADRIS
+# Run from the repository root: python3 -m source.utils.outliers_primaria.remove_outliers <primaria> <mortalitat> <outpath>
+# (or use main.py with the Primaria entity and --remove-outliers <mortalitat>, which reads Primaria in chunks)
 import pandas as pd
-from functions import *
+from source.utils.outliers_primaria.functions import *
+from source.utils.outliers_primaria.cie_codes import load_cie_codes
+from source.utils.patient_index import PatientIndex
 import sys
 import time
 
@@ -10,7 +14,7 @@ def main():
     args = sys.argv[1:]
 
     if len(args) != 3:
-        print("Usage: python3 main.py <inpath primaria> <inpath mortalitat> <oupath>")
+        print("Usage: python3 -m source.utils.outliers_primaria.remove_outliers <inpath primaria> <inpath mortalitat> <oupath>")
         sys.exit(1)
 
     primaria_path, mortalitat_path, outpath = args[0], args[1], args[2]
@@ -18,19 +22,17 @@ def main():
     print("Reading input...")
     # Read csv
     primaria = pd.read_csv(primaria_path, sep = "|")
-    mortalitat = pd.read_csv(mortalitat_path, sep = "|")
+    patients = PatientIndex.load(mortalitat=mortalitat_path) # Death date of each individual
 
-    # Read the reference for CIM10 and CIM9
-    cie10_df = pd.read_excel(r"source\utils\outliers_primaria\cie_reference\Diagnosticos_ES2024_TablaReferencia_30_06_2023.xlsx", sheet_name='ES2024 Finales', usecols=['Código'])
-    cie9_df = pd.read_excel(r"source\utils\outliers_primaria\cie_reference\CIE9MC_9_2014_REF_20210601_2362183957514564327.xls", sheet_name='cie9mc2014', usecols=['Tab.D'])
-    # From https://www.eciemaps.sanidad.gob.es/documentation at 09/04/2025 -> Tablas de Referencia
+    # Codes of the CIM10 and CIM9 references, compiled from cie_reference/ the first time they are used
+    cie_codes = load_cie_codes()
 
     print("Processing primaria...")
     # Remove non coherent cie codes
-    primaria_first_filt = remove_non_coherent_cie(primaria, cie9_df, cie10_df)
+    primaria_first_filt = remove_non_coherent_cie(primaria, cie_codes['cie9'], cie_codes['cie10'])
 
     # Remove non coherent dates
-    primaria_filt = remove_date_outliers(primaria_first_filt, mortalitat)
+    primaria_filt = remove_date_outliers(primaria_first_filt, patients)
 
     # Write report 
     generate_report(primaria_filt, "Primaria", outpath.replace(".csv", "_report.txt"), primaria)
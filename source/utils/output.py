@@ -0,0 +1,163 @@
+# Functions to write the processed data as CSV, Parquet or Feather (Arrow IPC).
+
+import os
+import json
+import shutil
+
+try:
+    import pyarrow as pa # Optional: needed for Parquet and Feather output
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Output format for each file extension
+OUTPUT_FORMATS = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'feather'
+}
+
+# Compression codecs available for each columnar format
+COMPRESSIONS = {
+    'parquet': ['snappy', 'gzip', 'brotli', 'zstd', 'lz4', 'none'],
+    'feather': ['lz4', 'zstd', 'uncompressed']
+}
+
+# Year columns used to partition the output (the first one found in the data)
+YEAR_COLUMNS = ['any_referencia', 'any', 'any_defuncio']
+
+
+def output_format(outpath):
+    """ Return the output format ('csv', 'parquet' or 'feather') from the extension of the output path. Other extensions (e.g. .txt) are written as CSV."""
+    extension = os.path.splitext(outpath)[1].lower()
+
+    return OUTPUT_FORMATS.get(extension, 'csv')
+
+def report_path(outpath):
+    """ Path of the report file of an output file."""
+    return os.path.splitext(outpath)[0] + "_report.txt"
+
+def profile_path(outpath):
+    """ Path of the JSON file with the processing steps of an output file."""
+    return os.path.splitext(outpath)[0] + "_profile.json"
+
+def _to_table(df):
+    """
+    Convert a processed dataframe to an Arrow table with the same schema for every chunk:
+    text (object) columns are written as strings, as in the CSV output, and categories with 32-bit codes.
+    """
+    df = df.assign(**{col: df[col].astype('string') for col in df.columns if df[col].dtype == object})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = [pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type)) if pa.types.is_dictionary(field.type) else field
+              for field in table.schema]
+
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+
+class OutputWriter:
+    """
+    Write processed data to the output path, in one go or chunk by chunk.
+    The format comes from the extension of the output path: .csv, .parquet or .feather/.arrow (Arrow IPC).
+    Parquet and Feather keep the data types built by cast_columns and can be compressed and partitioned by year:
+    the output is then a directory with one subdirectory per year (e.g. any=2019/).
+    """
+
+    def __init__(self, outpath, compression = None, partition_by_year = False):
+        """
+        Constructor for the OutputWriter class.
+
+        Args:
+            outpath (str): Path to the output file (or directory, if partitioned).
+            compression (str): [Optional] Compression codec for Parquet (snappy, gzip, brotli, zstd, lz4, none) or Feather (lz4, zstd, uncompressed).
+            partition_by_year (bool): [Optional] Partition Parquet or Feather output by the year column.
+        """
+        self.outpath = outpath
+        self.format = output_format(outpath)
+        self.compression = compression
+        self.partition_by_year = partition_by_year
+        self.chunks = 0
+        self._writer = None
+        self._schema = None
+
+        if self.format == 'csv' and (compression or partition_by_year):
+            raise ValueError("⚠️ --compression and --partition-by-year are only available for Parquet or Feather output.")
+        if self.format != 'csv' and pa is None:
+            raise ValueError("⚠️ Parquet and Feather output require pyarrow (pip install pyarrow).")
+        if compression and self.format != 'csv' and compression not in COMPRESSIONS[self.format]:
+            raise ValueError(f"⚠️ Compression '{compression}' is not available for {self.format} output. Use one of: {', '.join(COMPRESSIONS[self.format])}.")
+
+    def _feather_compression(self):
+        """ Compression codec of Feather output (lz4 by default, as pandas to_feather)."""
+        compression = self.compression or 'lz4'
+        return None if compression == 'uncompressed' else compression
+
+    def _year_column(self, df):
+        """ Return the year column to partition by, or None (with a warning) if the data has none."""
+        year_col = next((col for col in YEAR_COLUMNS if col in df.columns), None)
+        if year_col is None:
+            print(f"⚠️ No year column ({', '.join(YEAR_COLUMNS)}) found: the output is not partitioned.")
+            self.partition_by_year = False
+
+        return year_col
+
+    def _write_partitioned(self, table, year_col):
+        """
+        Write a table to the partitioned dataset directory: one subdirectory per year (e.g. any=2019/), with the year as int32.
+        The year is read back from the directory names, so it is removed from the pandas metadata of the files.
+        Rows without year are written in the dataset directory itself and read back with a missing year
+        (pyarrow cannot read a __HIVE_DEFAULT_PARTITION__ directory together with the years).
+        """
+        if self.format == 'parquet':
+            file_options = ds.ParquetFileFormat().make_write_options(compression=self.compression or 'snappy')
+        else:
+            file_options = ds.IpcFileFormat().make_write_options(compression=self._feather_compression())
+        options = {'format': 'parquet' if self.format == 'parquet' else 'ipc', 'file_options': file_options,
+                   'existing_data_behavior': 'overwrite_or_ignore'}
+
+        pandas_metadata = json.loads(table.schema.metadata[b'pandas'])
+        pandas_metadata['columns'] = [column for column in pandas_metadata['columns'] if column['name'] != year_col]
+        table = table.replace_schema_metadata({**table.schema.metadata, b'pandas': json.dumps(pandas_metadata).encode()})
+
+        has_year = pc.is_valid(table[year_col])
+        ds.write_dataset(table.filter(has_year), self.outpath, partitioning=ds.partitioning(pa.schema([(year_col, pa.int32())]), flavor='hive'),
+                         basename_template=f"part-{self.chunks}-{{i}}.{self.format}", **options)
+        if not pc.all(has_year).as_py():
+            without_year = table.filter(pc.invert(has_year))
+            ds.write_dataset(without_year.remove_column(without_year.schema.get_field_index(year_col)), self.outpath,
+                             basename_template=f"part-{self.chunks}-no-year-{{i}}.{self.format}", **options)
+
+    def write(self, df):
+        """ Write the processed data, or append it if it is not the first chunk."""
+        if self.format == 'csv':
+            df.to_csv(self.outpath, index=False, sep = "|", mode = "w" if self.chunks == 0 else "a", header = self.chunks == 0)
+            self.chunks += 1
+            return
+
+        table = _to_table(df)
+        if self._schema is None:
+            self._schema = table.schema
+        else:
+            table = table.cast(self._schema) # Same schema as the first chunk
+
+        year_col = self._year_column(df) if self.partition_by_year else None
+        if year_col is not None:
+            if self.chunks == 0 and os.path.isdir(self.outpath):
+                shutil.rmtree(self.outpath) # Replace the output of a previous run
+            self._write_partitioned(table, year_col)
+        else:
+            if self._writer is None:
+                if self.format == 'parquet':
+                    self._writer = pq.ParquetWriter(self.outpath, self._schema, compression=self.compression or 'snappy')
+                else:
+                    self._writer = pa.ipc.new_file(self.outpath, self._schema, options=pa.ipc.IpcWriteOptions(compression=self._feather_compression()))
+            self._writer.write_table(table)
+        self.chunks += 1
+
+    def close(self):
+        """ Finish the output file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
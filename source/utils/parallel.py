@@ -0,0 +1,66 @@
+# Functions to process a dataframe in parallel, split in shards by a key column.
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pyarrow # Optional: shards are passed to the workers as Arrow (Feather) files instead of being pickled
+except ImportError:
+    pyarrow = None
+
+
+def _store(df, directory, name):
+    """
+    Write a dataframe to an Arrow (Feather) file in directory and return its path.
+    Without pyarrow, or if the data cannot be stored as Arrow, the dataframe itself is returned (and pickled).
+    """
+    if pyarrow is None or directory is None:
+        return df
+    path = os.path.join(directory, name)
+    try:
+        df.to_feather(path)
+    except (pyarrow.ArrowException, ValueError, TypeError):
+        return df
+
+    return path
+
+def _load(shard):
+    """ Return the dataframe of a shard stored with _store."""
+    if isinstance(shard, str):
+        return pd.read_feather(shard)
+    return shard
+
+def _run_shard(function, shard, args, directory, name):
+    """ Worker: load the shard, apply the function and store the result."""
+    return _store(function(_load(shard), *args), directory, name)
+
+def run_sharded(df, key, workers, function, *args):
+    """
+    Split df by the hash of the key column, apply function(shard, *args) to each shard in a pool of `workers`
+    processes and concatenate the results in the original row order.
+    All the rows with the same key go to the same shard, so steps grouped by the key see all the rows of each key.
+    The function must keep the index of the rows it returns.
+    """
+    if workers is None or workers <= 1 or df.empty:
+        return function(df, *args)
+
+    # Use row positions as index to restore the original order
+    index = df.index
+    df = df.set_axis(pd.RangeIndex(len(df)))
+    shard_ids = pd.util.hash_pandas_object(df[key], index=False).to_numpy() % workers
+
+    with tempfile.TemporaryDirectory() as directory, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for i in range(workers):
+            shard = df.iloc[np.flatnonzero(shard_ids == i)]
+            if not shard.empty:
+                futures.append(executor.submit(_run_shard, function, _store(shard, directory, f"shard_{i}.feather"), args, directory, f"result_{i}.feather"))
+        results = [_load(future.result()) for future in futures]
+
+    result = pd.concat(results).sort_index()
+    result.index = index[result.index]
+
+    return result
@@ -0,0 +1,241 @@
+# Persistent index of the individuals: individual id -> dense int32 surrogate (stable between builds) and per-individual attributes.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from source.utils.text import as_text
+
+# Version of the index files: increase it if their layout changes
+INDEX_VERSION = 1
+
+# Columns of the processed Assegurats file kept for each individual (as category codes)
+PATIENT_ATTRIBUTES = ['sexe', 'situacio_assegurat_c', 'abs_c', 'rs_c', 'municipi_c', 'provincia_c']
+
+
+def index_directory(path):
+    """ Directory of the index built from a file (next to it)."""
+    return os.path.splitext(path)[0] + "_patient_index"
+
+def _source_stamp(path):
+    """ Size and modification time of a source file (None if it is not used): the index is rebuilt when they change."""
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _smallest_codes(codes, categories):
+    """ Category codes with the smallest integer type that holds them."""
+    for dtype in [np.int8, np.int16, np.int32]:
+        if len(categories) < np.iinfo(dtype).max:
+            return codes.astype(dtype)
+    return codes.astype(np.int64)
+
+def read_death_dates(mortalitat_path):
+    """
+    Read the death date of each individual from a processed Mortalitat file (only its id and data_defuncio columns).
+    Returns a Series of dates indexed by the individual id (the first death date if an individual appears more than once),
+    without the individuals that have no death date.
+    """
+    header = pd.read_csv(mortalitat_path, sep="|", nrows=0).columns
+    id_col = header[0]
+    date_col = 'data_defuncio' if 'data_defuncio' in header else 'Data_defuncio' # Processed or raw Mortalitat
+    mortalitat = pd.read_csv(mortalitat_path, sep="|", usecols=[id_col, date_col], dtype=str)
+
+    dates = pd.to_datetime(mortalitat[date_col], errors='coerce', dayfirst=False, format = "%Y-%m-%d")
+    death_dates = dates.groupby(mortalitat[id_col].to_numpy()).min().dropna()
+    death_dates.name = 'data_defuncio'
+
+    return death_dates
+
+
+class PatientIndex:
+    """
+    NumPy array of the individual ids of the Assegurats and/or Mortalitat files, with compact arrays of their attributes:
+    the death date and the Assegurats columns of PATIENT_ATTRIBUTES as category codes.
+    The position of an id in the array is its surrogate (int32), so the attributes of any rows are gathered by position.
+    The arrays are saved as .npy files next to the source file and memory-mapped by the next runs.
+    When the source file changes the index is built again keeping the surrogates: the ids already in the saved index keep
+    their position (even if they are no longer in the file, then without attributes) and the new ones are added at the end,
+    so outputs written with earlier surrogates still decode to the same individuals.
+    """
+
+    def __init__(self, id_col, ids, data_defuncio, attributes):
+        """
+        Constructor for the PatientIndex class.
+
+        Args:
+            id_col (str): Name of the individual id column (first column) of the source files.
+            ids (np.ndarray): Distinct individual ids in surrogate order (bytes if they are ASCII, else text).
+            data_defuncio (np.ndarray): Death date of each individual (datetime64[ns], NaT if not dead).
+            attributes (dict): Name -> (codes, categories) of each attribute: the category code of each individual (-1 if missing).
+        """
+        self.id_col = id_col
+        self.ids = ids
+        self.data_defuncio = data_defuncio
+        self.attributes = attributes
+        self.directory = None # Directory of the saved arrays, if any
+        self._lookup = None
+
+    @classmethod
+    def build(cls, assegurats = None, mortalitat = None, previous_ids = None):
+        """
+        Build the index from a processed Assegurats file (id, attributes and death date) and/or a Mortalitat file (death date).
+        The death date of Mortalitat is used when both have one. An individual repeated in Assegurats keeps its first row.
+        `previous_ids` are the ids of an earlier build, in surrogate order: they keep their surrogates and the new ids
+        are added after them (sorted). Without them the ids are sorted.
+        """
+        id_col, frames = None, {}
+        if assegurats is not None:
+            header = pd.read_csv(assegurats, sep="|", nrows=0).columns
+            id_col = header[0]
+            usecols = [id_col] + [col for col in PATIENT_ATTRIBUTES + ['data_defuncio'] if col in header]
+            frames['assegurats'] = pd.read_csv(assegurats, sep="|", usecols=usecols, dtype=str).dropna(subset=[id_col]).drop_duplicates(subset=[id_col])
+        death_dates = read_death_dates(mortalitat) if mortalitat is not None else None
+        if id_col is None:
+            id_col = pd.read_csv(mortalitat, sep="|", nrows=0).columns[0]
+
+        # Distinct ids of both files: the position is the surrogate. `positions` is the surrogate of each row read
+        all_ids = [frames['assegurats'][id_col]] if 'assegurats' in frames else []
+        if death_dates is not None:
+            all_ids.append(pd.Series(death_dates.index))
+        if all_ids:
+            ids, positions = np.unique(pd.concat(all_ids, ignore_index=True).astype(str).to_numpy(dtype=str), return_inverse=True)
+        else:
+            ids, positions = np.zeros(0, dtype=str), np.zeros(0, dtype=np.intp)
+        if previous_ids is not None and len(previous_ids):
+            # Earlier ids keep their surrogate, new ids go after them
+            previous_ids = np.asarray(previous_ids).astype(str)
+            surrogates = pd.Index(previous_ids.astype(object)).get_indexer(ids.astype(object))
+            new = surrogates < 0
+            surrogates[new] = len(previous_ids) + np.arange(new.sum())
+            ids, positions = np.concatenate([previous_ids, ids[new]]), surrogates[positions]
+        if len(ids) > np.iinfo(np.int32).max:
+            raise ValueError("⚠️ Too many individuals for an int32 surrogate.")
+        try:
+            stored_ids = ids.astype('S') # One byte per character instead of four (same order)
+        except UnicodeEncodeError:
+            stored_ids = ids
+
+        data_defuncio = np.full(len(ids), np.datetime64('NaT'), dtype='datetime64[ns]')
+        attributes = {}
+        if 'assegurats' in frames:
+            df = frames['assegurats']
+            rows = positions[:len(df)]
+            for col in PATIENT_ATTRIBUTES:
+                if col in df.columns:
+                    codes, categories = pd.factorize(df[col], sort=True)
+                    values = np.full(len(ids), -1, dtype=np.int64)
+                    values[rows] = codes
+                    attributes[col] = (_smallest_codes(values, categories), np.asarray(categories, dtype=str))
+            if 'data_defuncio' in df.columns:
+                data_defuncio[rows] = pd.to_datetime(df['data_defuncio'], errors='coerce', format="%Y-%m-%d").to_numpy(dtype='datetime64[ns]')
+        if death_dates is not None and len(death_dates):
+            data_defuncio[positions[-len(death_dates):]] = death_dates.to_numpy(dtype='datetime64[ns]')
+
+        return cls(id_col, stored_ids, data_defuncio, attributes)
+
+    def _arrays(self):
+        """ File name and array of each saved array."""
+        arrays = {'ids': self.ids, 'data_defuncio': self.data_defuncio}
+        for name, (codes, categories) in self.attributes.items():
+            arrays[name] = codes
+            arrays[f"{name}_categories"] = categories
+        return arrays
+
+    def save(self, directory, stamp):
+        """ Save the arrays as .npy files and the stamp of the source files they come from."""
+        os.makedirs(directory, exist_ok=True)
+        for name, values in self._arrays().items():
+            # Written aside and then replaced: runs that memory-map the previous arrays keep reading them
+            path = os.path.join(directory, f"{name}.npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, values)
+            os.replace(path + ".tmp", path)
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f: # Written last: the index is complete
+            json.dump({**stamp, 'id_col': self.id_col, 'attributes': list(self.attributes)}, f)
+
+    @classmethod
+    def _open(cls, directory, stamp):
+        """ Memory-map a saved index, or return None if there is none or it was built from other versions of the files."""
+        try:
+            with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if any(meta.get(key) != value for key, value in stamp.items()):
+            return None
+
+        def load(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+
+        attributes = {name: (load(name), np.load(os.path.join(directory, f"{name}_categories.npy"))) for name in meta['attributes']}
+        index = cls(meta['id_col'], load('ids'), load('data_defuncio'), attributes)
+        index.directory = directory
+
+        return index
+
+    @staticmethod
+    def _saved_ids(directory):
+        """
+        Ids of the index saved in a directory (in surrogate order), or None if there is none.
+        meta.json is not needed: each saved ids.npy starts with the ids of the previous one, so even after an interrupted save it holds them.
+        """
+        try:
+            return np.load(os.path.join(directory, "ids.npy"))
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def load(cls, assegurats = None, mortalitat = None):
+        """
+        Return the index of a processed Assegurats and/or Mortalitat file, building and saving it
+        (next to the Assegurats file, or the Mortalitat file if there is no Assegurats) if it does not exist or the files have changed.
+        """
+        directory = index_directory(assegurats if assegurats is not None else mortalitat)
+        stamp = {'version': INDEX_VERSION, 'assegurats': _source_stamp(assegurats), 'mortalitat': _source_stamp(mortalitat)}
+        index = cls._open(directory, stamp)
+        if index is not None:
+            return index
+
+        print("Building the patient index...")
+        index = cls.build(assegurats, mortalitat, cls._saved_ids(directory))
+        try:
+            if os.path.exists(os.path.join(directory, "meta.json")):
+                os.remove(os.path.join(directory, "meta.json")) # Invalid until the new arrays are saved
+            index.save(directory, stamp)
+            index.directory = directory
+        except OSError as e:
+            print(f"Warning: Could not save the patient index in '{directory}' ({e}): it will be built again next time.")
+
+        return index
+
+    def surrogates(self, ids):
+        """ Surrogate (int32 position in the index) of each individual id, -1 if it is not in the index: one hash lookup per distinct id."""
+        if self._lookup is None:
+            # Hash table of the ids, built the first time: faster than a binary search for millions of unsorted ids
+            stored = np.asarray(self.ids)
+            self._lookup = pd.Index((stored.astype(str) if stored.dtype.kind == 'S' else stored).astype(object))
+
+        positions, uniques = pd.factorize(pd.Series(ids, copy=False))
+        found = np.full(len(uniques) + 1, -1, dtype=np.int32) # Last one for missing ids (position -1)
+        uniques = np.asarray(uniques, dtype=object)
+        if pd.api.types.infer_dtype(uniques, skipna=True) != 'string':
+            uniques = as_text(pd.Series(uniques)).to_numpy() # Ids read as numbers (floats if some are missing): 1.0 -> '1'
+        found[:-1] = self._lookup.get_indexer(uniques)
+
+        return found[positions]
+
+    def death_dates(self, surrogates):
+        """ Death date of each surrogate (NaT for -1 or an individual without death date)."""
+        dates = np.asarray(self.data_defuncio)
+        if len(dates) == 0:
+            return np.full(len(surrogates), np.datetime64('NaT'), dtype='datetime64[ns]')
+        return np.where(surrogates >= 0, dates[np.maximum(surrogates, 0)], np.datetime64('NaT'))
+
+    def attribute(self, name, surrogates):
+        """ Attribute of PATIENT_ATTRIBUTES of each surrogate as a Categorical (missing for -1)."""
+        codes, categories = self.attributes[name]
+        codes = np.asarray(codes)
+        gathered = np.where(surrogates >= 0, codes[np.maximum(surrogates, 0)], -1) if len(codes) else np.full(len(surrogates), -1)
+        return pd.Categorical.from_codes(gathered, categories=categories)
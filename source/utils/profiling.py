@@ -0,0 +1,32 @@
+# Functions to profile the processing steps (time, rows and memory of each step).
+
+import json
+
+
+class StepProfiler:
+    """
+    Record the wall time, rows in and out and memory change (RSS) of each named processing step.
+    When the same steps run several times (chunks) the times and rows are added and the largest memory change is kept.
+    """
+
+    def __init__(self):
+        """ Constructor for the StepProfiler class."""
+        self.steps = {}
+
+    def record(self, step, seconds, rows_in, rows_out, memory_delta = None):
+        """ Add a run of a step. `memory_delta` is the change of the process memory in bytes (None if it cannot be measured)."""
+        if step not in self.steps:
+            self.steps[step] = {'runs': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0, 'memory_delta': None}
+        stats = self.steps[step]
+        stats['runs'] += 1
+        stats['seconds'] += seconds
+        stats['rows_in'] += rows_in
+        stats['rows_out'] += rows_out
+        if memory_delta is not None:
+            stats['memory_delta'] = memory_delta if stats['memory_delta'] is None else max(stats['memory_delta'], memory_delta)
+
+    def write_json(self, path, entity):
+        """ Write the steps to a JSON file (one object per step, in the order they ran)."""
+        steps = [{'step': step, **stats} for step, stats in self.steps.items()]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({'entity': entity, 'total_seconds': sum(stats['seconds'] for stats in self.steps.values()), 'steps': steps}, f, indent=2)
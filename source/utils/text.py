@@ -0,0 +1,24 @@
+# Codes and ids read as numbers, as the text written in the file.
+
+import numpy as np
+import pandas as pd
+
+
+def _as_text(value):
+    """ Text of one value: whole floats without decimals (250.0 -> '250'), as they are written in the file."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+def as_text(values):
+    """
+    Values of a Series as text (object Series with the same index, missing values kept as NaN), converting each distinct value once.
+    pandas reads a column of codes or ids with only numbers as integers, or as floats if it has missing values:
+    they are written back as text without the decimals pandas added, so they match the same codes or ids read as text.
+    """
+    codes, uniques = pd.factorize(values)
+    text = np.array([_as_text(value) for value in uniques] + [np.nan], dtype=object) # Last one for missing values (code -1)
+
+    return pd.Series(text[codes], index=values.index, name=values.name)
@@ -8,5 +8,25 @@ VALID_ENTITIES = {
     'Primaria',
     'Mesures',
     'Assegurats',
+    'Mortalitat',
+    'CMBD' # Diagnostics and Procediments together
+}
+
+# Set with the entities whose processing is row-local and can be read in chunks (--chunksize)
+
+STREAMABLE_ENTITIES = {
+    'Episodis',
+    'Laboratori',
+    'Primaria',
+    'Mesures',
+    'Assegurats',
     'Mortalitat'
+}
+
+
+# Set with the processing options for Laboratori
+
+LAB_OPTIONS = {
+    'filter',
+    'clean_filter'
 }
\ No newline at end of file
@@ -0,0 +1,67 @@
+# Files larger than the type inference buffer of pandas give the same output in chunks as in one pass.
+
+import numpy as np
+import pandas as pd
+import pytest
+from source.processing import process_dataframe, process_in_chunks, read_entity
+from source.utils.column_casts import column_casts
+
+
+def _assegurats_file(tmp_path, rows = 20000):
+    """
+    Assegurats file of about 1 MB (several read buffers of pandas) whose uncast columns change type along the file:
+    situacio_assegurat_c is an integer code missing only in the last rows (float in the whole file) and
+    ss a number in the first rows and text in the last ones.
+    """
+    rng = np.random.default_rng(0)
+    situacio = rng.integers(0, 3, rows).astype(object)
+    situacio[-10:] = None
+    ss = rng.integers(1, 9, rows).astype(str).astype(object)
+    ss[-10:] = 'Barcelona'
+    df = pd.DataFrame({
+        'codi_p': [f"P{i:06d}" for i in range(rows)],
+        'situacio_assegurat_c': situacio,
+        'sexe': rng.choice(['H', 'D'], rows),
+        'abs_c': rng.integers(1, 400, rows), 'abs': 'ABS',
+        'ss_c': rng.integers(1, 9, rows), 'ss': ss,
+        'rs_c': rng.integers(1, 9, rows), 'rs': 'RS',
+        'municipi_c': rng.integers(8000, 9000, rows), 'municipi': 'Municipi',
+        'comarca_c': rng.integers(1, 40, rows), 'comarca': 'Comarca',
+        'provincia_c': 8, 'provincia': 'Barcelona',
+        'data_defuncio': rng.choice(['2019-01-02', '', '2021-03-01'], rows),
+    })
+    path = tmp_path / "assegurats.csv"
+    df.to_csv(path, sep="|", index=False)
+    assert path.stat().st_size > 4 * 256 * 1024
+
+    return path
+
+def _first_difference(first, second):
+    """ First line that differs between two output files (None if they are equal): short failure messages for large files."""
+    first, second = open(first, encoding="utf-8").read().splitlines(), open(second, encoding="utf-8").read().splitlines()
+    for i, (a, b) in enumerate(zip(first, second)):
+        if a != b:
+            return i, a, b
+    return None if len(first) == len(second) else (min(len(first), len(second)), len(first), len(second))
+
+@pytest.mark.parametrize('chunksize', [5000, 19995])
+def test_large_file_in_chunks_matches_one_pass(tmp_path, chunksize):
+    path = _assegurats_file(tmp_path)
+    process_dataframe(read_entity(str(path), "|", 'Assegurats'), str(tmp_path / "one.csv"), 'Assegurats', column_casts)
+    process_in_chunks(str(path), str(tmp_path / "chunks.csv"), 'Assegurats', column_casts, chunksize)
+
+    assert "|0.0|" in open(tmp_path / "one.csv", encoding="utf-8").read() # situacio_assegurat_c as float, as pandas reads the whole file
+    assert _first_difference(tmp_path / "chunks.csv", tmp_path / "one.csv") is None
+
+def test_only_one_pass_is_compacted(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = _assegurats_file(tmp_path)
+    process_dataframe(read_entity(str(path), "|", 'Assegurats'), str(tmp_path / "one.parquet"), 'Assegurats', column_casts)
+    process_in_chunks(str(path), str(tmp_path / "chunks.parquet"), 'Assegurats', column_casts, 5000)
+    one, chunks = pd.read_parquet(tmp_path / "one.parquet"), pd.read_parquet(tmp_path / "chunks.parquet")
+
+    # Same values, but only the one-pass output keeps the categories and smaller integers of compact()
+    assert isinstance(one['sexe'].dtype, pd.CategoricalDtype) and str(one['abs_c'].dtype) == 'Int16'
+    assert str(chunks['sexe'].dtype) == 'string' and str(chunks['abs_c'].dtype) == 'Int64'
+    columns = ['codi_p', 'sexe', 'abs_c', 'abs', 'municipi_c', 'provincia', 'any_defuncio']
+    pd.testing.assert_frame_equal(chunks[columns], one[columns], check_dtype=False, check_categorical=False)
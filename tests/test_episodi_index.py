@@ -0,0 +1,64 @@
+# Compare the episode lookup of the episodi index with the pd.merge it replaces.
+
+import numpy as np
+import pandas as pd
+import pytest
+from source.classes.cmbd import DiagnosticsProcediments
+from source.utils.episodi_index import EpisodiIndex
+
+
+def _random_files(tmp_path, seed, shared_columns):
+    """ Random Episodis file (repeated and missing episodi_id, missing ids and years) and Diagnostics rows (episodes found, missing and repeated)."""
+    rng = np.random.default_rng(seed)
+    n_episodes, n_rows = rng.integers(0, 40), rng.integers(0, 60)
+    episodis = pd.DataFrame({
+        'codi_p': rng.choice(['P001', 'P002', 'P003', None], n_episodes),
+        'episodi_id': rng.choice([-3, -1, 1, 2, 5, 8, 13, np.nan], n_episodes),
+        'up_c': rng.integers(0, 5, n_episodes),
+        'any_referencia': rng.choice([2016, 2017, 2018, 2019, np.nan], n_episodes),
+    })
+    path = tmp_path / f"episodis_{seed}.csv"
+    episodis.to_csv(path, sep="|", index=False)
+
+    df = pd.DataFrame({
+        'episodi_id': rng.choice([-3, -1, 1, 2, 4, 5, 8, 13, 21], n_rows),
+        'dx_posicio': rng.integers(1, 4, n_rows),
+        'dx_c': rng.choice(['E11', 'I10', '250'], n_rows),
+    })
+    if shared_columns: # Columns also in Episodis get the _x and _y suffixes
+        df.insert(0, 'codi_p', rng.choice(['P001', 'P009'], n_rows))
+        df['any_referencia'] = rng.choice([2015, 2020], n_rows)
+
+    return path, df
+
+@pytest.mark.parametrize('shared_columns', [False, True])
+@pytest.mark.parametrize('seed', range(50))
+def test_merge_episodes_matches_pd_merge(tmp_path, seed, shared_columns):
+    path, df = _random_files(tmp_path, seed, shared_columns)
+    episodis = pd.read_csv(path, sep="|", usecols=['codi_p', 'episodi_id', 'any_referencia'])
+    expected = pd.merge(episodis, df, on="episodi_id", how="right")
+
+    merged = DiagnosticsProcediments(df, {}, 'Diagnostics', EpisodiIndex.build(path))._merge_episodes()
+
+    # Same columns, order, rows and values (the index keeps the ids as text and the years as floats)
+    pd.testing.assert_frame_equal(merged, expected, check_dtype=False)
+
+def test_saved_index_matches_built_index(tmp_path):
+    path, df = _random_files(tmp_path, 7, False)
+    built = DiagnosticsProcediments(df, {}, 'Diagnostics', EpisodiIndex.build(path))._merge_episodes()
+    EpisodiIndex.load(path) # Builds and saves it
+    saved = EpisodiIndex.load(path)
+
+    assert saved.directory is not None
+    pd.testing.assert_frame_equal(DiagnosticsProcediments(df, {}, 'Diagnostics', saved)._merge_episodes(), built)
+
+def test_missing_episodi_id_has_no_episode(tmp_path):
+    # pd.merge would match the row without episodi_id with the episode without episodi_id (P2)
+    path = tmp_path / "episodis.csv"
+    pd.DataFrame({'codi_p': ['P1', 'P2'], 'episodi_id': [1, np.nan], 'any_referencia': [2016, 2017]}).to_csv(path, sep="|", index=False)
+    df = pd.DataFrame({'episodi_id': [1, np.nan], 'dx_c': ['E11', 'I10']})
+
+    merged = DiagnosticsProcediments(df, {}, 'Diagnostics', EpisodiIndex.build(path))._merge_episodes()
+
+    assert merged['codi_p'].tolist()[0] == 'P1' and pd.isna(merged['codi_p'].iloc[1])
+    assert merged['any_referencia'].tolist()[0] == 2016 and np.isnan(merged['any_referencia'].iloc[1])
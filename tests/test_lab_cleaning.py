@@ -0,0 +1,100 @@
+# Lab results cleaned with the vectorized functions give the same values as the original per-row functions.
+# The expected values were produced by the per-row code (clear_typos, handle_extra_variables, classify_numeric_results,
+# standardize_numeric_results with standardize_number / standardize_n2, and standardize_unit) on the same inputs.
+
+import numpy as np
+import pandas as pd
+from source.classes.lab_processing.classifier import ResultClassifier
+from source.classes.lab_processing.clean_lab import (clean_distinct_results, clear_typos, comentari_text, standardize_distinct_units,
+                                                     standardize_n2_series, standardize_number_series)
+from source.classes.lab_processing.patterns import cleaning_comments, numeric_patterns, patterns_common_words, unit_patterns
+
+# Typos, interpretative flags, units next to the number, signs, percents, exponents, '<'/'>' results,
+# thousands separators, leading commas and zeros, more than 4 decimals, ranges and ratios
+RESULTS = ['Positiu', 'NEGATIU', 'no calculable', 'abc', '12 mg/dL', 'mg/dL 12', '+5', '45 %', '1,000,000', '10,000', ',5', '007',
+           '1,23456', '<0,5', '> = 10', '100-200', '200-100', '1/1000', '(12)', '=5=', '  7 ', '2x10^9', 'nocalc', '12,3,4', '+ 12,5 %']
+# Units written in different ways that map to the same unit, missing, empty and unknown
+UNITS = ['mg/dl', 'MG/DL', 'mmol/L', None, '', 'µg/dl', 'x10^9/L', 'mL/min', '10^3/uL', 'uu'] * 3
+
+EXPECTED = {
+    'clean_result': ['positiu', 'negatiu', 'nc', 'abc', '12.0', '12.0', '5.0', '45.0', '1000000.0', '10000.0', '0.5', '7.0', '1.2346', '<0.5',
+                     '>=10.0', '100-200', '200-100', '1:1000', '12.0', '5.0', '7.0', '2x10^9', 'nc', '12,3,4', '+ 12,5 %'],
+    'num_type': [None, None, None, None, 'n1', 'n1', 'n1', 'n1', 'n1', 'n1', 'n1', 'n1', 'n1', 'n2', 'n2', 'n3', None, 'n4', 'n1', 'n1', 'n1',
+                 None, None, 'other', None],
+    'comentari': ['literal', 'literal', 'literal', 'literal', 'units', 'units', 'flag', 'percent', None, None, None, None, None, None, None,
+                  None, None, None, None, None, None, 'exponents', 'literal', None, None],
+    'unitat_mesura': ['mg/dl', 'MG/DL', 'mmol/L', None, 'mg/dL', 'mg/dL', 'x10^9/L', '%', '10^3/uL', 'uu', 'mg/dl', 'MG/DL', 'mmol/L', None, '',
+                      'µg/dl', 'x10^9/L', 'mL/min', '10^3/uL', 'uu', 'mg/dl', 'MG/DL', 'mmol/L', None, ''],
+    'clean_unit': ['mg/dL', 'mg/dL', 'mmol/L', None, 'mg/dL', 'mg/dL', '10*9/L', '%', '10*3/uL', 'uu', 'mg/dL', 'mg/dL', 'mmol/L', None, '',
+                   'ug/dL', '10*9/L', 'mL/min', '10*3/uL', 'uu', 'mg/dL', 'mg/dL', 'mmol/L', None, ''],
+    'comentari_unitat': ['done', 'done', 'done', None, 'done', 'done', 'done', 'done', 'done', None, 'done', 'done', 'done', None, None,
+                         'done', 'done', 'done', 'done', None, 'done', 'done', 'done', None, None],
+}
+
+
+def _values(series):
+    """ Values of a Series as a list, with missing values as None."""
+    return [None if pd.isna(value) else value for value in series]
+
+def test_distinct_results_match_per_row_cleaning():
+    # The results are repeated with other units to check that the distinct values are broadcast back to the right rows
+    rows = len(RESULTS)
+    df = pd.DataFrame({'lab_resultat': RESULTS * 2, 'unitat_mesura': UNITS[:rows] + UNITS[5:5 + rows]})
+    df = clean_distinct_results(df, patterns_common_words, numeric_patterns)
+    df = standardize_distinct_units(df, unit_patterns)
+    df['comentari'] = comentari_text(df['comentari_flags'])
+
+    for col in ['clean_result', 'num_type', 'comentari']:
+        assert _values(df[col]) == EXPECTED[col] * 2, col
+    first = df.iloc[:rows]
+    for col in ['unitat_mesura', 'clean_unit', 'comentari_unitat']:
+        assert _values(first[col]) == EXPECTED[col], col
+
+def test_classifier_matches_per_row_steps():
+    # Results before standardizing the numbers, as handle_extra_variables and classify_numeric_results left them
+    results = ['Positiu', 'resultat NEGATIU', 'no calculable', 'abc', '12 mg/dL', 'mg/dL 12', '+5', '45 %', '1,000,000', '<0,5', '> = 10',
+               '100-200', '1/1000', '(12)', '=5=', '2x10^9', '12,3,4', '+ 12,5 %', 'alt', '--', 'nocalc']
+    df = clear_typos(pd.DataFrame({'lab_resultat': results, 'unitat_mesura': 'mmol/L'}))
+    df = ResultClassifier(patterns_common_words, numeric_patterns).classify(df)
+
+    assert _values(df['clean_result']) == ['positiu', 'negatiu', 'nc', 'abc', '12', '12', '5', '45', '1,000,000', '<0,5', '> = 10', '100-200',
+                                           '1/1000', '12', '5', '2x10^9', '12,3,4', '+ 12,5 %', 'alt', 'nc', 'nc']
+    assert _values(df['num_type']) == [None, None, None, None, 'n1', 'n1', 'n1', 'n1', 'n1', 'n2', 'n2', 'n3', 'n4', 'n1', 'n1', None, 'other',
+                                       None, None, None, None]
+    assert _values(comentari_text(df['comentari_flags'])) == ['literal', 'literal', 'literal', 'literal', 'units', 'units', 'flag', 'percent',
+                                                              None, None, None, None, None, None, None, 'exponents', None, None, 'literal',
+                                                              'literal', 'literal']
+    assert _values(df['unitat_mesura']) == ['mmol/L'] * 4 + ['mg/dL', 'mg/dL', 'mmol/L', '%'] + ['mmol/L'] * 13
+
+def test_number_standardization_matches_per_row():
+    # Thousands separators, leading commas and dots, leading zeros, rounding to 4 decimals, text and values that are not strings
+    values = pd.Series(['1,000,000', '10,000', '100,000', '2,000', ',1234', '.5', '007', '01,23', '1,23456', '3.14159', 'abc', '', '0',
+                        '12,3,4', None, 5], dtype=object)
+    expected = ['1000000.0', '10000.0', '100000.0', '2.0', '0.1234', '0.5', '7.0', '1.23', '1.2346', '3.1416', 'abc', '', '0.0', '12.3.4',
+                None, 5]
+    assert _values(standardize_number_series(values)) == expected
+    numbers = standardize_number_series(values, numeric=True)
+    np.testing.assert_array_equal(numbers, [1000000, 10000, 100000, 2, 0.1234, 0.5, 7, 1.23, 1.2346, 3.1416, np.nan, np.nan, 0, np.nan, np.nan, 5])
+
+    n2 = pd.Series(['<0,5', '> = 10', '>=007', '< ,25', '>1,000,000'])
+    assert standardize_n2_series(n2).tolist() == ['<0.5', '>=10.0', '>=7.0', '<0.25', '>1000000.0']
+
+def _add_cleaning_comment(comentari, comment):
+    """ The per-row helper of handle_extra_variables: append the comment to the text if it is not already there."""
+    if pd.isna(comentari):
+        return comment
+    return f"{comentari}, {comment}".strip(', ') if comment not in comentari else comentari
+
+def test_comment_bits_match_per_row_comments():
+    # Every combination of comments, each one added twice as the two unit steps did, in the order the steps add them
+    expected = []
+    for code in range(2 ** len(cleaning_comments)):
+        comentari = pd.NA
+        for comment, bit in cleaning_comments.items():
+            if code & bit:
+                comentari = _add_cleaning_comment(_add_cleaning_comment(comentari, comment), comment)
+        expected.append(comentari)
+    flags = pd.Series(range(2 ** len(cleaning_comments)), dtype=np.uint8)
+
+    assert _values(comentari_text(flags)) == _values(pd.Series(expected, dtype=object))
+    assert comentari_text(flags)[cleaning_comments['units'] | cleaning_comments['percent']] == 'units, percent'
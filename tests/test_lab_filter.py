@@ -0,0 +1,53 @@
+# Unit conversion of processed Laboratori data ('filter' mode) in one pass and in chunks.
+
+import pandas as pd
+import pytest
+import source.classes.lab_processing.filter_lab as filter_lab
+from source.processing import process_dataframe, process_in_chunks, read_entity
+from source.utils.column_casts import column_casts
+
+pytest.importorskip('openpyxl')
+
+
+def _files(tmp_path):
+    """ Processed lab data with numeric test codes and its conversion file (units converted by the file, by chaining the dict or not at all)."""
+    lab = pd.DataFrame({
+        'codi_p': ['P1', 'P1', 'P2', 'P2', 'P3', 'P3'],
+        'peticio_id': [1, 2, 3, 4, 5, 6],
+        'any': 2020,
+        'data': '2020-05-06',
+        'codi_prova': [101, 101, 102, 101, 102, 103],
+        'prova': ['Glucosa', 'Glucosa', 'Creat', 'Glucosa', 'Creat', 'Altres'],
+        'clean_result': ['1.5', '2000', '0.9', '7', '<0.5', '3'],
+        'clean_unit': ['g/L', 'ug/dL', 'mg/dL', 'mmol/L', 'mg/dL', 'g/L'],
+        'num_type': ['n1', 'n1', 'n1', 'n1', 'n2', 'n1'],
+    })
+    conversion = pd.DataFrame({
+        'codi_prova': [101, 102],
+        'from_unit': ['g/L', 'mg/dL'],
+        'factor': [100, 'value*88.4'],
+        'to_unit': ['mg/dL', 'umol/L'],
+        'group': ['glu', 'cre'],
+    })
+    lab_path, conversion_path = tmp_path / "lab.csv", tmp_path / "conversion.xlsx"
+    lab.to_csv(lab_path, sep="|", index=False)
+    conversion.to_excel(conversion_path, index=False)
+
+    return str(lab_path), str(conversion_path)
+
+def test_unit_factors_built_once_in_chunks(tmp_path, monkeypatch):
+    lab, conversion = _files(tmp_path)
+    process_dataframe(read_entity(lab, "|", 'Laboratori', 'filter'), str(tmp_path / "one.csv"), 'Laboratori', column_casts,
+                      lab_option='filter', lab_conversion=conversion)
+    one = pd.read_csv(tmp_path / "one.csv", sep="|")
+    # g/L from the file (x100), ug/dL chained (ug/dL -> mg/L -> mg/dL) and mmol/L not convertible
+    assert one.loc[one['codi_prova'] == 101, 'converted_result'].fillna(-1).tolist() == [150.0, 2.0, -1]
+    assert one.loc[one['codi_prova'] == 102, 'converted_result'].tolist() == [79.56]
+
+    # The chunks only gather the factors of the table built once for the run
+    def build_again(*args):
+        raise AssertionError("The unit factors are built again for a chunk.")
+    monkeypatch.setattr(filter_lab, 'build_unit_factors', build_again)
+    process_in_chunks(lab, str(tmp_path / "chunks.csv"), 'Laboratori', column_casts, 2, lab_option='filter', lab_conversion=conversion)
+
+    assert open(tmp_path / "chunks.csv", encoding="utf-8").read() == open(tmp_path / "one.csv", encoding="utf-8").read()
@@ -0,0 +1,80 @@
+# Mesures processed in one pass and in chunks give the same output and report.
+
+import numpy as np
+import pandas as pd
+import pytest
+from source.processing import process_dataframe, process_in_chunks, read_entity
+from source.utils.column_casts import column_casts
+from source.utils.output import report_path
+
+
+def _mesures_file(tmp_path, seed, rows = 300, ids = None):
+    """ Random Mesures file: codes in and out of mesures_info, values in and out of range, decimals, text and missing values."""
+    rng = np.random.default_rng(seed)
+    values = rng.choice(['170', '72.5', '5', '300', '120', '80', '45', 'n/a', '', '1,5e3'], rows)
+    df = pd.DataFrame({
+        'codi_p': np.sort(rng.choice(ids if ids is not None else np.arange(1, 13), rows)),
+        'Prova_data': rng.choice(['2019-01-02', '2019-06-30', '2020-05-06', '2021-03-01', ''], rows),
+        'Prova_codi': rng.choice(['TT101', 'TT102', 'EK201', 'EK202', 'XX999'], rows),
+        'Prova_descripcio': 'x',
+        'Prova_resultat': values,
+    })
+    path = tmp_path / f"mesures_{seed}.csv"
+    df.to_csv(path, sep="|", index=False)
+
+    return path
+
+def _range_section(path):
+    """ Lines of the range filter counts in a report."""
+    lines = open(report_path(str(path)), encoding="utf-8").read().split("\n\n")
+    return [block for block in lines if block.startswith("Rows removed by the range filter")]
+
+def _run(path, outpath, chunksize = None, **options):
+    """ Process a Mesures file in one pass (chunksize None) or in chunks, with a report. Returns the output text."""
+    if chunksize is None:
+        process_dataframe(read_entity(str(path), "|", 'Mesures'), str(outpath), 'Mesures', column_casts, report=True, **options)
+    else:
+        process_in_chunks(str(path), str(outpath), 'Mesures', column_casts, chunksize, report=True, **options)
+
+    return open(outpath, encoding="utf-8").read()
+
+@pytest.mark.parametrize('chunksize', [1, 7, 64, 1000])
+@pytest.mark.parametrize('seed', range(3))
+def test_range_filter_in_chunks_matches_one_pass(tmp_path, seed, chunksize):
+    path = _mesures_file(tmp_path, seed)
+
+    assert _run(path, tmp_path / "chunks.csv", chunksize) == _run(path, tmp_path / "one.csv")
+    assert _range_section(tmp_path / "chunks.csv") == _range_section(tmp_path / "one.csv")
+
+def test_range_table_in_chunks_matches_one_pass(tmp_path):
+    path = _mesures_file(tmp_path, 11)
+    table = tmp_path / "ranges.csv"
+    table.write_text("codi;nom;min;max;unitat\nTT101;Talla;100;;cm\nEK201;PAS;70;200;mmHg\n", encoding="utf-8")
+
+    one = _run(path, tmp_path / "one.csv", range_table=str(table))
+    assert _run(path, tmp_path / "chunks.csv", 13, range_table=str(table)) == one
+    assert _range_section(tmp_path / "chunks.csv") == _range_section(tmp_path / "one.csv")
+    assert "TT102" not in one # Only the codes of the table are kept
+
+@pytest.mark.parametrize('chunksize', [1, 5, 37, 1000])
+@pytest.mark.parametrize('seed', range(3))
+def test_wide_in_chunks_matches_one_pass(tmp_path, seed, chunksize):
+    # Ids 1 to 12 sorted as numbers (not as text: '10' < '2')
+    path = _mesures_file(tmp_path, seed)
+
+    one = _run(path, tmp_path / "one.csv", wide=True, height_tolerance=200)
+    assert _run(path, tmp_path / "chunks.csv", chunksize, wide=True, height_tolerance=200) == one
+
+def test_wide_in_chunks_with_text_ids(tmp_path):
+    path = _mesures_file(tmp_path, 5, ids=np.array(['P01', 'P02', 'P10', 'P2']))
+
+    assert _run(path, tmp_path / "chunks.csv", 9, wide=True) == _run(path, tmp_path / "one.csv", wide=True)
+
+def test_wide_in_chunks_unsorted_writes_nothing(tmp_path):
+    path = _mesures_file(tmp_path, 3)
+    df = pd.read_csv(path, sep="|")
+    df.iloc[::-1].to_csv(path, sep="|", index=False) # Ids in decreasing order
+
+    with pytest.raises(ValueError, match="sorted by the individual id"):
+        process_in_chunks(str(path), str(tmp_path / "wide.csv"), 'Mesures', column_casts, 50, wide=True)
+    assert not (tmp_path / "wide.csv").exists()
@@ -0,0 +1,54 @@
+# The Primaria outliers are removed the same way whatever data type the reader gives to the codes.
+
+import numpy as np
+import pandas as pd
+import pytest
+import source.processing
+from source.processing import process_dataframe, process_in_chunks, read_entity
+from source.utils.column_casts import column_casts
+from source.utils.outliers_primaria.functions import remove_non_coherent_cie
+
+CIE9 = np.array(sorted(['250', '410']), dtype=str)
+CIE10 = np.array(sorted(['E119', 'I210']), dtype=str)
+
+
+def test_numeric_codes_match_text_codes():
+    rows = {'catalegcim_dx': ['CIM10', 'CIM10', 'CIM10', 'CIM9MC', 'CIM10'], 'dx_c': [250, 410, 999, 250, None]}
+    expected = remove_non_coherent_cie(pd.DataFrame(rows).astype({'dx_c': object}).assign(dx_c=['250', '410', '999', '250', np.nan]), CIE9, CIE10)
+    for dx_c in [pd.Series(rows['dx_c'], dtype='Int64'), pd.Series(rows['dx_c'], dtype=object)]:
+        result = remove_non_coherent_cie(pd.DataFrame(rows).assign(dx_c=dx_c), CIE9, CIE10)
+        pd.testing.assert_frame_equal(result, expected)
+    assert expected['catalegcim_dx'].tolist() == ['CIM9MC', 'CIM9MC', 'CIM9MC']
+
+def _primaria_files(tmp_path, codes):
+    """ Primaria file with the given codes and its Mortalitat file."""
+    df = pd.DataFrame({
+        'codi_p': [f"P{i}" for i in range(len(codes))],
+        'any_problema_salut': 2019,
+        'data_problema_salut': '2019-01-02',
+        'data_problema_salut_baixa': '',
+        'catalegcim_problema_salut_c': 'CIM10',
+        'problema_salut_c': codes,
+        'problema_salut': 'desc',
+    })
+    primaria, mortalitat = tmp_path / "primaria.csv", tmp_path / "mortalitat.csv"
+    df.to_csv(primaria, sep="|", index=False)
+    pd.DataFrame({'codi_p': ['P0', 'P6'], 'data_defuncio': ['2018-01-01', '2020-01-01']}).to_csv(mortalitat, sep="|", index=False)
+
+    return str(primaria), str(mortalitat)
+
+# First rows with only CIE-9 codes (numbers) and then CIE-10 codes, or only CIE-9 codes
+@pytest.mark.parametrize('codes, kept', [
+    (['250', '410', '250', '410', '999', 'I21.0', 'E11.9', 'J45', 'I21-0', '410'], ['P1', 'P2', 'P3', 'P8', 'P9']),
+    (['250', '410', '250', '410', '999', '250', '', '410', '250', '410'], ['P1', 'P2', 'P3', 'P5', 'P7', 'P8', 'P9']),
+])
+@pytest.mark.parametrize('chunksize', [2, 4, 100])
+def test_numeric_chunk_in_chunks_matches_one_pass(tmp_path, monkeypatch, chunksize, codes, kept):
+    monkeypatch.setattr(source.processing, 'load_cie_codes', lambda: {'cie9': CIE9, 'cie10': CIE10})
+    primaria, mortalitat = _primaria_files(tmp_path, codes)
+    process_dataframe(read_entity(primaria, "|", 'Primaria'), str(tmp_path / "one.csv"), 'Primaria', column_casts, remove_outliers=mortalitat)
+    process_in_chunks(primaria, str(tmp_path / "chunks.csv"), 'Primaria', column_casts, chunksize, remove_outliers=mortalitat)
+
+    one = pd.read_csv(tmp_path / "one.csv", sep="|", dtype=str)
+    assert one['codi_p'].tolist() == kept # P0 died before the diagnostic, the others are not in the references
+    assert open(tmp_path / "chunks.csv", encoding="utf-8").read() == open(tmp_path / "one.csv", encoding="utf-8").read()
@@ -0,0 +1,51 @@
+# Output written by OutputWriter reads back with pandas, in one go or in chunks and partitioned by year.
+
+import numpy as np
+import pandas as pd
+import pytest
+from source.utils.output import OutputWriter
+
+pytest.importorskip('pyarrow')
+
+
+def _processed(rows = 60):
+    """ Processed data with the data types of cast_columns and compact: nullable integers, a category, text and dates, with missing years."""
+    rng = np.random.default_rng(0)
+    year = pd.array(rng.choice([2016, 2017, 2019], rows), dtype='Int16')
+    year[::7] = pd.NA
+    return pd.DataFrame({
+        'codi_p': [f"P{i:03d}" for i in range(rows)],
+        'any_referencia': year,
+        'up_c': pd.array(rng.integers(0, 500, rows), dtype='Int64'),
+        'tipus_activitat': pd.Categorical(rng.choice(['Hosp', 'Urg'], rows)),
+        'data_alta': pd.to_datetime(rng.choice(['2019-01-02', '2020-05-06'], rows)),
+    })
+
+def _write(df, outpath, chunks, **options):
+    """ Write the data in the given number of chunks."""
+    writer = OutputWriter(str(outpath), **options)
+    for chunk in np.array_split(np.arange(len(df)), chunks):
+        writer.write(df.iloc[chunk])
+    writer.close()
+
+def _sorted(df):
+    """ Rows in id order, with the year as a float (missing as NaN), to compare data read back in another order and type."""
+    df = df.assign(any_referencia=df['any_referencia'].astype('float64'), tipus_activitat=df['tipus_activitat'].astype(str))
+    return df.sort_values('codi_p').reset_index(drop=True)[['codi_p', 'any_referencia', 'up_c', 'tipus_activitat', 'data_alta']]
+
+@pytest.mark.parametrize('chunks', [1, 4])
+@pytest.mark.parametrize('partition_by_year', [False, True])
+def test_parquet_reads_back(tmp_path, chunks, partition_by_year):
+    df = _processed()
+    _write(df, tmp_path / "out.parquet", chunks, partition_by_year=partition_by_year)
+    read = pd.read_parquet(tmp_path / "out.parquet")
+
+    assert len(read) == len(df) and read['any_referencia'].isna().sum() == df['any_referencia'].isna().sum()
+    pd.testing.assert_frame_equal(_sorted(read), _sorted(df), check_dtype=False)
+
+def test_unknown_extension_is_csv(tmp_path):
+    df = _processed()
+    _write(df, tmp_path / "out.txt", 3)
+    read = pd.read_csv(tmp_path / "out.txt", sep="|", parse_dates=['data_alta'])
+
+    pd.testing.assert_frame_equal(_sorted(read), _sorted(df), check_dtype=False)
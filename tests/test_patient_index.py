@@ -0,0 +1,110 @@
+# The patient index keeps the surrogates of the individuals when it is built again, and its ids and attributes are looked up for the rows of each entity.
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from source.processing import process_dataframe, process_in_chunks, read_entity
+from source.utils.column_casts import column_casts
+from source.utils.patient_index import PatientIndex, index_directory
+
+
+def _assegurats(path, ids, sexe):
+    """ Processed Assegurats file with the given ids and sexe, with a later modification time so the index is built again."""
+    pd.DataFrame({'codi_p': ids, 'sexe': sexe, 'abs_c': '001'}).to_csv(path, sep="|", index=False)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+def _decode(patients, surrogates):
+    """ Text id of each surrogate."""
+    return np.asarray(patients.ids).astype(str)[surrogates]
+
+def test_surrogates_round_trip(tmp_path):
+    path = tmp_path / "assegurats.csv"
+    _assegurats(path, ['P3', 'P1', 'P2'], ['H', 'D', 'H'])
+    patients = PatientIndex.load(assegurats=str(path))
+    surrogates = patients.surrogates(pd.Series(['P2', 'P9', 'P3', None]))
+    assert surrogates.tolist()[1::2] == [-1, -1]
+    assert _decode(patients, surrogates[[0, 2]]).tolist() == ['P2', 'P3']
+    assert patients.attribute('sexe', surrogates).tolist()[::2] == ['H', 'H']
+
+def test_surrogates_stable_after_rebuild(tmp_path):
+    path = tmp_path / "assegurats.csv"
+    _assegurats(path, ['P5', 'P2', 'P8', 'P4'], ['H', 'D', 'H', 'D'])
+    before = PatientIndex.load(assegurats=str(path))
+    old = before.surrogates(pd.Series(['P2', 'P4', 'P5', 'P8']))
+
+    # P2 leaves, P1 and P9 arrive and the sexe of P5 changes
+    _assegurats(path, ['P9', 'P5', 'P8', 'P4', 'P1'], ['D', 'D', 'H', 'D', 'H'])
+    after = PatientIndex.load(assegurats=str(path))
+    assert after.surrogates(pd.Series(['P2', 'P4', 'P5', 'P8'])).tolist() == old.tolist()
+    new = after.surrogates(pd.Series(['P1', 'P9']))
+    assert sorted(new.tolist()) == [4, 5]
+    assert _decode(after, new).tolist() == ['P1', 'P9']
+    assert after.attribute('sexe', old).tolist()[1:] == ['D', 'D', 'H'] # P2 has no attributes any more
+    assert pd.isna(after.attribute('sexe', old)[0])
+
+def test_saved_index_matches_built(tmp_path):
+    path = tmp_path / "assegurats.csv"
+    _assegurats(path, ['P2', 'P1'], ['H', 'D'])
+    PatientIndex.load(assegurats=str(path))
+    loaded = PatientIndex.load(assegurats=str(path)) # From the saved arrays
+    assert loaded.directory == index_directory(str(path))
+    built = PatientIndex.build(assegurats=str(path))
+    assert np.asarray(loaded.ids).tolist() == np.asarray(built.ids).tolist()
+    assert loaded.attribute('sexe', np.arange(2)).tolist() == built.attribute('sexe', np.arange(2)).tolist()
+
+def _diagnostics(tmp_path, with_id):
+    """ Episodis and Diagnostics files, with or without the individual id in the Diagnostics data."""
+    episodis = tmp_path / "episodis.csv"
+    pd.DataFrame({'codi_p': ['P1', 'P2', 'P3'], 'episodi_id': [10, 20, 30], 'any_referencia': 2019}).to_csv(episodis, sep="|", index=False)
+    df = pd.DataFrame({'episodi_id': [10, 20, 30, 40], 'dx_posicio': 1, 'dx_c': 'E11', 'dx': 'DM2', 'catalegcim_dx': 'CIM10MC'})
+    if with_id:
+        df.insert(0, 'codi_p', ['P3', 'P2', 'P9', 'P1'])
+    return str(episodis), df
+
+def test_surrogate_ids_of_diagnostics(tmp_path):
+    path = tmp_path / "assegurats.csv"
+    _assegurats(path, ['P1', 'P2', 'P3'], ['H', 'D', 'H'])
+    episodis, df = _diagnostics(tmp_path, with_id=True)
+    process_dataframe(df, str(tmp_path / "out.csv"), 'Diagnostics', column_casts, episodis=episodis, surrogate_ids=str(path))
+    out = pd.read_csv(tmp_path / "out.csv", sep="|", dtype=str, keep_default_na=False)
+    # Id of the episode (_x) and id of the data (_y), each one as its surrogate or missing if it is not in the index
+    assert out[['codi_p_x', 'episodi_id', 'codi_p_y']].values.tolist() == [['0', '10', '2'], ['1', '20', '1'], ['2', '30', ''], ['', '40', '0']]
+
+def test_surrogate_ids_without_id_column(tmp_path):
+    path = tmp_path / "assegurats.csv"
+    _assegurats(path, ['P1', 'P2', 'P3'], ['H', 'D', 'H'])
+    episodis, df = _diagnostics(tmp_path, with_id=False)
+    with pytest.raises(ValueError, match="no individual id"):
+        process_dataframe(df, str(tmp_path / "out.csv"), 'Diagnostics', column_casts, episodis=episodis, surrogate_ids=str(path))
+    assert not (tmp_path / "out.csv").exists()
+
+def test_patient_attributes_match_merge(tmp_path):
+    path = tmp_path / "assegurats.csv"
+    _assegurats(path, ['P1', 'P2', 'P3'], ['H', 'D', 'H'])
+    episodis, df = _diagnostics(tmp_path, with_id=True)
+    process_dataframe(df, str(tmp_path / "out.csv"), 'Diagnostics', column_casts, episodis=episodis, patient_attributes=str(path))
+    process_dataframe(df, str(tmp_path / "ref.csv"), 'Diagnostics', column_casts, episodis=episodis)
+    out = pd.read_csv(tmp_path / "out.csv", sep="|", dtype=str)
+    ref = pd.read_csv(tmp_path / "ref.csv", sep="|", dtype=str)
+    # Attributes of the individual of the episode, as merging the Assegurats file
+    assegurats = pd.read_csv(path, sep="|", dtype=str).rename(columns={'codi_p': 'codi_p_x'})
+    pd.testing.assert_frame_equal(out, ref.merge(assegurats, on='codi_p_x', how='left'))
+
+@pytest.mark.parametrize('chunksize', [None, 2])
+def test_numeric_ids(tmp_path, chunksize):
+    path = tmp_path / "assegurats.csv"
+    _assegurats(path, [1, 2, 3], ['H', 'D', 'H'])
+    # Numeric ids with a missing one are read as floats (1.0, 2.0, ...)
+    mesures = tmp_path / "mesures.csv"
+    pd.DataFrame({'codi_p': [1, 2, None, 3], 'Prova_data': '2019-01-02', 'Prova_codi': 'TT101', 'Prova_descripcio': 'x',
+                  'Prova_resultat': '170', 'Prova_unitat': 'cm'}).to_csv(mesures, sep="|", index=False)
+    options = {'surrogate_ids': str(path), 'patient_attributes': str(path)}
+    if chunksize is None:
+        process_dataframe(read_entity(str(mesures), "|", 'Mesures'), str(tmp_path / "out.csv"), 'Mesures', column_casts, **options)
+    else:
+        process_in_chunks(str(mesures), str(tmp_path / "out.csv"), 'Mesures', column_casts, chunksize, **options)
+
+    out = pd.read_csv(tmp_path / "out.csv", sep="|", dtype=str, keep_default_na=False)
+    assert out[['codi_p', 'sexe', 'abs_c']].values.tolist() == [['0', 'H', '001'], ['1', 'D', '001'], ['', '', ''], ['2', 'H', '001']]